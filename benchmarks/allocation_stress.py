@@ -0,0 +1,87 @@
+#!/bin/env python
+''' allocation_stress
+Allocates hosts from several processes sharing a database and reports the
+allocation rate for each number of workers as JSON, along with a check that
+no address was handed out twice.  Each worker allocates on a vlan of its own
+and on one shared by all of them.
+
+usage: PYTHONPATH=src python benchmarks/allocation_stress.py \
+    [database uri] [hosts per worker] [max workers]
+'''
+from multiprocessing import Process
+import json
+import os
+import sys
+import tempfile
+import time
+
+from banchi import setup, settings, db, models
+
+SHARED = 1000
+
+
+def worker(app, index, hosts):
+    db.session.remove()
+    client = app.test_client()
+    for i in range(hosts):
+        response = client.post("/host/", data={
+            "name": "w{}-{}".format(index, i), "vlan": [index, SHARED]})
+        if response.status_code != 201:
+            sys.exit(1)
+
+
+def run(app, workers, hosts):
+    ''' run
+    Allocates `hosts` hosts from each of `workers` processes on an empty
+    database, returning the hosts created per second and whether every
+    address is distinct.
+    '''
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([models.Vlan(
+            name="v{}".format(n), number=n, cidr=(10 << 24) + (n << 12),
+            length=20) for n in range(workers) + [SHARED]])
+        db.session.commit()
+
+    start = time.time()
+    processes = [Process(target=worker, args=(app, i, hosts))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.time() - start
+
+    with app.app_context():
+        ips = db.session.query(models.Ip.vlan_id, models.Ip.number).all()
+        distinct = len(set(ips)) == len(ips) == workers * hosts * 2
+        db.session.remove()
+
+    return {"workers": workers, "hosts": workers * hosts,
+            "failed": sum(1 for p in processes if p.exitcode),
+            "distinct": distinct, "rate": workers * hosts / elapsed}
+
+
+def main(uri=None, hosts=100, workers=8):
+    path = None
+    if not uri:
+        path = tempfile.mktemp(suffix=".db")
+        uri = "sqlite:///" + path
+    settings.DATABASE_URI = uri
+    settings.DEBUG = False
+    settings.CACHE_BACKEND = "null"
+    app = setup()
+
+    try:
+        count = 1
+        while count <= int(workers):
+            print json.dumps(run(app, count, int(hosts)))
+            count *= 2
+    finally:
+        if path:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:4])
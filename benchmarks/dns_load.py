@@ -0,0 +1,104 @@
+#!/bin/env python
+''' dns_load
+Drives the DNS responder with a UDP load generator on the local machine.  A
+temporary database is seeded with hosts spread over a few vlans, the
+responder is started in its own process and the generator keeps a window of
+queries outstanding, printing the sustained rate as JSON.
+
+usage: PYTHONPATH=src python benchmarks/dns_load.py [hosts] [seconds]
+'''
+from multiprocessing import Process
+import json
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from banchi import setup, settings, db, dns
+from banchi.models import Host, Ip, Vlan
+from banchi.utils import ip2int
+
+VLANS = 4
+WINDOW = 64
+PORT = 15353
+
+
+def seed(hosts):
+    ''' seed
+    Fills the database with `hosts` hosts, each with an IP on every vlan.
+    '''
+    db.create_all()
+    vlans = [Vlan(number=n, name="vlan{}".format(n), length=16,
+                  cidr=ip2int("10.{}.0.0".format(n))) for n in range(VLANS)]
+    db.session.add_all(vlans)
+    db.session.flush()
+    for i in range(hosts):
+        host = Host(name="host{}".format(i))
+        db.session.add(host)
+        db.session.add_all([Ip(number=vlan.cidr + i, vlan_id=vlan.id,
+                               host=host) for vlan in vlans])
+    db.session.commit()
+
+
+def query(ident, name):
+    return struct.pack('!HHHHHH', ident, dns.FLAG_RECURSION, 1, 0, 0, 0) + \
+        dns.encode_name([name, "banchi"]) + struct.pack('!HH', dns.TYPE_A, 1)
+
+
+def load(hosts, seconds):
+    ''' load
+    Sends queries for random hosts, keeping WINDOW of them in flight, and
+    returns the number answered in `seconds`.
+    '''
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.setblocking(False)
+    target = ("127.0.0.1", PORT)
+    packets = [query(i & 0xFFFF, "host{}".format(random.randrange(hosts)))
+               for i in range(4096)]
+
+    answered, sent, outstanding = 0, 0, 0
+    end = time.time() + seconds
+    while time.time() < end:
+        while outstanding < WINDOW:
+            client.sendto(packets[sent % len(packets)], target)
+            sent, outstanding = sent + 1, outstanding + 1
+        if not select.select([client], [], [], 0.1)[0]:
+            outstanding = 0  # dropped, refill the window
+            continue
+        try:
+            while True:
+                client.recv(512)
+                answered, outstanding = answered + 1, outstanding - 1
+        except socket.error:
+            pass
+    return answered
+
+
+def main(hosts=10000, seconds=10):
+    path = tempfile.mktemp(suffix=".db")
+    settings.DATABASE_URI = "sqlite:///" + path
+    settings.DNS_ANSWER_CACHE = hosts * VLANS
+    app = setup()
+    with app.app_context():
+        seed(hosts)
+
+    server = Process(target=dns.serve, args=(app, "127.0.0.1", PORT))
+    server.start()
+    time.sleep(1)
+    try:
+        answered = load(hosts, seconds)
+    finally:
+        server.terminate()
+        os.unlink(path)
+
+    print json.dumps({"hosts": hosts, "seconds": seconds,
+                      "answered": answered, "qps": answered / seconds})
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
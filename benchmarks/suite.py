@@ -0,0 +1,455 @@
+#!/bin/env python
+''' suite
+Times the hot paths of the service on a realistic dataset and writes the
+results as JSON, so runs on different commits can be compared.  A temporary
+database is seeded (through the snapshot importer) with thousands of /24
+vlans and a few /16 vlans filled close to capacity, hundreds of thousands of
+IPs in all, then these are timed:
+
+    utils.*       IP string conversions, per conversion
+    allocator.*   Vlan.get_next, get_free and reserve on full, empty and IPv6
+                  ranges
+    serialize.*   model serializers and the `datatype` JSON and stream paths
+    endpoint.*    every endpoint, through the Flask test client
+
+Each benchmark runs for about --seconds (and at least a few times) and
+reports the call count and the mean, median, 95th percentile and fastest
+call in milliseconds.  With --baseline, the medians are compared to an
+earlier results file and the run fails if any got slower than --threshold
+times the baseline.  Endpoints not covered by any benchmark are listed as
+`uncovered` in the results.
+
+usage: PYTHONPATH=src python benchmarks/suite.py [--output results.json]
+    [--baseline old.json] [--threshold 1.25] [--scale 1.0] [--seconds 1.0]
+    [--only prefix] [--database uri] [--cache]
+'''
+from datetime import datetime
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from banchi import setup, settings, db, changes, allocator, snapshot
+from banchi import models
+from banchi.decorators import datatype
+from banchi.utils import ip2int, int2ip
+
+LARGE = 2  # vlans filled to FILL of their addresses
+FILL = 0.92
+SMALL = 2000  # /24 vlans, each with up to SMALL_HOSTS hosts
+SMALL_HOSTS = 200
+WRITES = 98  # number of the vlan the write endpoints allocate on
+HEADERS = [("Accept", "application/json")]
+
+
+class Dataset(object):
+    ''' Dataset
+    Sizes and names of the seeded data, scaled down from the full sizes for
+    quicker runs.
+    '''
+    def __init__(self, scale):
+        self.length = 16 + max(0, int(round(-math.log(scale, 2))))
+        self.large = ["large{}".format(n) for n in range(LARGE)]
+        self.small = max(1, int(SMALL * scale))
+        self.per_large = int(((1 << (32 - self.length)) - 2) * FILL)
+        self.hosts = self.per_large * LARGE
+
+    def host(self, i):
+        return "host{:06d}.example.com".format(i)
+
+    def records(self):
+        ''' Dataset::records
+        Generates the snapshot records of the data, every host has an IP on
+        one of the large vlans and most also one on a small vlan.
+        '''
+        yield ["snapshot", snapshot.VERSION]
+        for (n, name) in enumerate(self.large):
+            yield ["vlan", n + 1, name,
+                   "10.{}.0.0/{}".format(n, self.length)]
+        for n in range(self.small):
+            yield ["vlan", 100 + n, "small{}".format(n),
+                   "172.{}.{}.0/24".format(16 + n // 256, n % 256)]
+
+        for i in range(self.hosts):
+            yield ["host", self.host(i)]
+        for i in range(self.hosts):
+            large, offset = i % LARGE, i // LARGE + 1
+            yield ["ip", self.host(i), large + 1, int2ip(
+                ip2int("10.{}.0.0".format(large)) + offset)]
+            offset = i // self.small + 1
+            if offset <= SMALL_HOSTS:
+                yield ["ip", self.host(i), 100 + i % self.small,
+                       "172.{}.{}.{}".format(16 + (i % self.small) // 256,
+                                             (i % self.small) % 256, offset)]
+
+    def seed(self):
+        lines = (json.dumps(record) for record in self.records())
+        counts = snapshot.Loader(db.session).load(lines)
+        db.session.flush()
+        changes.bump(db.session)
+        db.session.commit()
+        return counts
+
+
+def summary(times, ops=1):
+    ''' summary
+    Reduces the durations of the calls of a benchmark (each doing `ops`
+    operations) to milliseconds per operation.
+    '''
+    times = sorted(t / ops * 1000 for t in times)
+    return {
+        "calls": len(times),
+        "ops": len(times) * ops,
+        "mean_ms": sum(times) / len(times),
+        "median_ms": times[len(times) // 2],
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "min_ms": times[0],
+    }
+
+
+class Suite(object):
+    ''' Suite
+    Runs the benchmarks whose names start with `only` for about `seconds`
+    each, collecting their summaries.
+    '''
+    def __init__(self, app, data, seconds, only=None):
+        self.app = app
+        self.data = data
+        self.seconds = seconds
+        self.only = only
+        self.results = {}
+        self.client = app.test_client()
+        self.covered = set()  # (endpoint, method) pairs requested
+        self.serial = 0
+
+    def timed(self, name, func, ops=1, after=None, minimum=3, limit=None):
+        ''' Suite::timed
+        Calls `func` repeatedly and records its durations under `name`,
+        `after` is called (untimed) after every call.
+        '''
+        if self.only and not name.startswith(self.only):
+            return
+        times = []
+        end = timeit.default_timer() + self.seconds
+        while len(times) < minimum or timeit.default_timer() < end:
+            if limit is not None and len(times) >= limit:
+                break
+            start = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - start)
+            if after:
+                after()
+        self.results[name] = summary(times, ops)
+        sys.stderr.write("{:<45} {:>10.3f} ms\n".format(
+            name, self.results[name]["median_ms"]))
+
+    def unique(self, prefix):
+        self.serial += 1
+        return "{}{}".format(prefix, self.serial)
+
+    def run(self):
+        for group in (self.utils, self.allocator, self.serialize,
+                      self.read_endpoints, self.write_endpoints):
+            with self.app.test_request_context(headers=HEADERS):
+                group()
+                db.session.remove()
+        return self.results
+
+    def utils(self):
+        numbers = range(ip2int("10.0.0.0"), ip2int("10.0.0.0") + 1000)
+        ips = map(int2ip, numbers)
+        self.timed("utils.ip2int", lambda: map(ip2int, ips), ops=1000)
+        self.timed("utils.int2ip", lambda: map(int2ip, numbers), ops=1000)
+        numbers6 = range(ip2int("2001:db8::"), ip2int("2001:db8::") + 1000)
+        ips6 = map(int2ip, numbers6)
+        self.timed("utils.ip2int.ipv6", lambda: map(ip2int, ips6), ops=1000)
+        self.timed("utils.int2ip.ipv6", lambda: map(int2ip, numbers6),
+                   ops=1000)
+
+    def allocator(self):
+        full = models.Vlan.query.filter_by(name=self.data.large[0]).one()
+        empty = models.Vlan(number=99, name="empty", cidr=ip2int("10.99.0.0"),
+                            length=self.data.length,
+                            cidr6=ip2int("2001:db8:99::"), length6=64)
+        db.session.add(empty)
+        db.session.commit()
+        for vlan in (full, empty):  # builds their free space indexes
+            vlan.get_next()
+        db.session.commit()
+        rollback = db.session.rollback
+
+        def cold():
+            allocator.drop(db.session, [full.id])
+            full.get_next()
+
+        for (label, vlan) in [("full", full), ("empty", empty)]:
+            self.timed("allocator.get_next." + label, vlan.get_next,
+                       after=rollback)
+            self.timed("allocator.get_free_100." + label,
+                       lambda: vlan.get_free(100), after=rollback)
+            self.timed("allocator.reserve_64." + label,
+                       lambda: vlan.reserve(64, 64), after=rollback)
+        self.timed("allocator.get_next.rebuild", cold, after=rollback)
+        self.timed("allocator.get_next.ipv6", lambda: empty.get_next(6),
+                   after=rollback)
+        self.timed("allocator.get_free_100.ipv6",
+                   lambda: empty.get_free(100, 6), after=rollback)
+
+        db.session.delete(empty)
+        db.session.commit()
+
+    def serialize(self):
+        hosts = models.Host.query.options(db.subqueryload('vlans')).limit(
+            500).all()
+        ips = models.Host.query.options(db.subqueryload('ips').joinedload(
+            'vlan')).limit(500).all()
+        vlans = models.Vlan.query.limit(500).all()
+        data = [host.__simple__() for host in hosts]
+
+        self.timed("serialize.host_simple",
+                   lambda: [host.__simple__() for host in hosts], ops=500)
+        self.timed("serialize.host_full",
+                   lambda: [host.__full__() for host in ips], ops=500)
+        self.timed("serialize.vlan_simple",
+                   lambda: [vlan.__simple__() for vlan in vlans], ops=500)
+        self.timed("serialize.datatype_package",
+                   datatype(lambda: data), ops=500)
+        self.timed("serialize.datatype_stream",
+                   lambda: datatype(lambda: (item for item in data))()
+                   .get_data(), ops=500)
+
+    def request(self, method, path, **kwargs):
+        adapter = self.app.url_map.bind("localhost")
+        self.covered.add((adapter.match(path.split("?")[0], method)[0],
+                          method))
+        response = self.client.open(path, method=method, headers=HEADERS,
+                                    **kwargs)
+        response.get_data()  # drains streamed responses
+        if response.status_code >= 400:
+            raise RuntimeError("{} {} returned {}".format(
+                method, path, response.status_code))
+        return response
+
+    def endpoint(self, method, path, label=None, minimum=3, **kwargs):
+        self.timed("endpoint.{} {}".format(method, label or path),
+                   lambda: self.request(method, path, **kwargs),
+                   minimum=minimum)
+
+    def read_endpoints(self):
+        host, large = self.data.host(0), self.data.large[0]
+        key = "{}_{}_ip".format(host, large)
+        self.endpoint("GET", "/")
+        self.endpoint("GET", "/version/")
+        self.endpoint("GET", "/cache/")
+        self.endpoint("GET", "/database/")
+        self.endpoint("GET", "/host/")
+        self.endpoint("GET", "/host/{}/".format(host), "/host/<name>/")
+        self.endpoint("GET", "/vlan/")
+        self.endpoint("GET", "/vlan/100/", "/vlan/<small number>/")
+        self.endpoint("GET", "/vlan/{}/".format(large), "/vlan/<large name>/")
+        self.endpoint("GET", "/vlan/1/block/", "/vlan/<number>/block/")
+        self.endpoint("GET", "/vlan/stats/")
+        self.endpoint("GET", "/vlan/{}/stats/".format(large),
+                      "/vlan/<large name>/stats/")
+        self.endpoint("GET", "/query/?ip=10.0.0.1", "/query/?ip=")
+        self.endpoint("GET", "/query/?hostname=" + host,
+                      "/query/?hostname=<exact>")
+        self.endpoint("GET", "/query/?hostname=00012",
+                      "/query/?hostname=<substring>")
+        self.endpoint("GET", "/query/range/?range=10.0.16.0/20",
+                      "/query/range/?range=<cidr /20>")
+        self.endpoint("GET", "/hiera/?key=" + key, "/hiera/?key=")
+        self.endpoint("GET", "/hiera/?host=" + host, "/hiera/?host=")
+        self.endpoint("GET", "/hiera/{}/".format(key), "/hiera/<key>/")
+        self.endpoint("POST", "/hiera/", data=json.dumps({
+            "keys": ["{}_{}_ip".format(self.data.host(i), large)
+                     for i in range(0, 200, 2)]}),
+            content_type="application/json", label="/hiera/ (100 keys)")
+        self.endpoint("POST", "/query/", data=json.dumps({
+            "ip": ["10.0.{}.{}".format(i // 250, i % 250 + 1)
+                   for i in range(500)],
+            "hostname": [self.data.host(i) for i in range(0, 1000, 2)]}),
+            content_type="application/json", label="/query/ (1000 items)")
+        self.endpoint("GET", "/snapshot/", minimum=1)
+
+    def write_endpoints(self):
+        self.request("POST", "/vlan/", data={
+            "number": WRITES, "name": "writes", "mask": "10.98.0.0/16"})
+        created = []
+
+        def create_host():
+            name = self.unique("bench-host")
+            created.append(name)
+            self.request("POST", "/host/", data={"name": name,
+                                                 "vlan": [WRITES]})
+
+        def delete_host():
+            self.request("DELETE", "/host/{}/".format(created.pop()))
+
+        self.timed("endpoint.POST /host/", create_host)
+        self.timed("endpoint.DELETE /host/<name>/", delete_host,
+                   limit=len(created), minimum=0)
+
+        def bulk():
+            names = [self.unique("bench-bulk") for _ in range(50)]
+            created.extend(names)
+            self.request("POST", "/host/bulk/", data=json.dumps([
+                {"name": name, "vlan": [WRITES]} for name in names]),
+                content_type="application/json")
+
+        def restore():
+            names = [self.unique("bench-import") for _ in range(50)]
+            created.extend(names)
+            self.request("POST", "/snapshot/", data="\n".join(
+                json.dumps(["host", name]) for name in names))
+
+        self.timed("endpoint.POST /host/bulk/ (50 hosts)", bulk, ops=50)
+        self.timed("endpoint.POST /snapshot/ (50 hosts)", restore, ops=50)
+        for name in created:
+            self.request("DELETE", "/host/{}/".format(name))
+
+        def create_vlan():
+            number = 10000 + self.serial
+            self.request("POST", "/vlan/", data={
+                "number": number, "name": self.unique("bench-vlan"),
+                "mask": "192.168.0.0/24"})
+            created.append(number)
+
+        def delete_vlan():
+            self.request("DELETE", "/vlan/{}/".format(created.pop()))
+
+        del created[:]
+        self.timed("endpoint.POST /vlan/", create_vlan)
+        self.timed("endpoint.DELETE /vlan/<number>/", delete_vlan,
+                   limit=len(created), minimum=0)
+
+        def reserve():
+            response = self.request("POST", "/vlan/{}/block/".format(WRITES),
+                                    data={"size": 16, "align": 16})
+            created.append(json.loads(response.data)["url"])
+
+        def release():
+            self.request("DELETE", created.pop())
+
+        self.timed("endpoint.POST /vlan/<number>/block/", reserve)
+        self.timed("endpoint.DELETE /vlan/<number>/block/<id>/", release,
+                   limit=len(created), minimum=0)
+        self.request("DELETE", "/vlan/{}/".format(WRITES))
+
+        since = changes.horizon(db.session)  # every change written above
+        self.endpoint("GET", "/changes/?since={}".format(since),
+                      "/changes/?since=")
+
+    def uncovered(self):
+        ''' Suite::uncovered
+        Lists the endpoints and methods no benchmark requested.
+        '''
+        routes = set((rule.endpoint, method) for rule in
+                     self.app.url_map.iter_rules() if rule.endpoint != 'static'
+                     for method in rule.methods - set(['HEAD', 'OPTIONS']))
+        return sorted("{} {}".format(method, endpoint)
+                      for (endpoint, method) in routes - self.covered)
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    ''' compare
+    Prints the change of every median from the baseline and returns the
+    names of the benchmarks that got slower than `threshold` times it.
+    '''
+    slower = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]["median_ms"] / max(
+            baseline[name]["median_ms"], 1e-9)
+        flag = ""
+        if ratio > threshold:
+            slower.append(name)
+            flag = "  SLOWER"
+        sys.stderr.write("{:<45} {:>8.2f}x{}\n".format(name, ratio, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the service on a seeded dataset.")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--baseline", help="results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="fraction of the full dataset size to seed")
+    parser.add_argument("--seconds", type=float, default=1.0,
+                        help="time spent on each benchmark")
+    parser.add_argument("--only", help="prefix of the benchmarks to run")
+    parser.add_argument("--database", help="database URI (default: a "
+                        "temporary SQLite file)")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the response cache on")
+    args = parser.parse_args()
+
+    path = None
+    if not args.database:
+        path = tempfile.mktemp(suffix=".db")
+        args.database = "sqlite:///" + path
+    settings.DATABASE_URI = args.database
+    settings.DEBUG = False
+    settings.CACHE_BACKEND = "local" if args.cache else "null"
+    app = setup()
+    data = Dataset(args.scale)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            seeded = timeit.default_timer()
+            counts = data.seed()
+            seeded = timeit.default_timer() - seeded
+        suite = Suite(app, data, args.seconds, args.only)
+        results = suite.run()
+    finally:
+        if path:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+    output = {
+        "commit": commit(),
+        "time": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "database": args.database.split(":")[0],
+        "cache": settings.CACHE_BACKEND,
+        "scale": args.scale,
+        "dataset": dict(counts, seconds=seeded),
+        "results": results,
+        "uncovered": suite.uncovered(),
+    }
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(text + "\n")
+    else:
+        print text
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            slower = compare(results, json.load(baseline)["results"],
+                             args.threshold)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,25 @@
 import settings
 
 __version__ = "0.1"
-__all__ = ["api", "vlan", "host", "query"]
+__all__ = ["api", "vlan", "host", "query", "hiera", "snapshot",
+           "feed"]
 
 from .decorators import BanchiFlask
-from flask.ext.sqlalchemy import SQLAlchemy
+from .database import Database, configure
+from . import metrics
 
 app = BanchiFlask(__name__)
 app.version = __version__
-db = SQLAlchemy()
+db = Database()
 
 
 def setup():
-    app.debug = settings.DEBUG
-    app.config['SQLALCHEMY_DATABASE_URI'] = settings.DATABASE_URI
+    app.debug = settings.DEBUG and settings.ENVIRONMENT != "production"
+    configure(app)
 
     db.init_app(app)
+    if settings.METRICS:
+        metrics.install()
 
     return app
 
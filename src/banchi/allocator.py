@@ -0,0 +1,444 @@
+''' allocator
+Maintains an index of the free address space of each vlan so that finding and
+releasing addresses does not require loading every allocated IP.  The free
+space is stored as a list of contiguous runs of offsets (relative to the cidr
+of the vlan) in the `free_block` table, alongside a `pool` row per vlan that
+marks the index as built and counts the allocated addresses.  Dual-stack
+vlans have an index for each IP version, and as free space is stored as runs
+the cost of an allocation does not depend on the size of the prefix, a /64
+is a single free block until addresses are taken from it.
+
+The index is kept current by a flush listener, so anything that creates or
+deletes `Ip` or `Block` rows through the session updates it without having to
+know about it.  Vlans that predate the index (or whose index was dropped) are
+rebuilt from their `Ip` and `Block` rows the first time they are written to,
+or all at once by `build` (which `bin/setup` runs).
+'''
+from . import db, settings
+from .database import Address
+from .utils import version as ip_version, IPV6_START
+from collections import defaultdict
+from sqlalchemy import event, select, and_
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+pools = db.Table(
+    'pool',
+    db.Column('vlan_id', db.Integer, db.ForeignKey('vlan.id'),
+              primary_key=True),
+    db.Column('version', db.Integer, primary_key=True, default=4),
+    db.Column('allocated', db.BigInteger, nullable=False, default=0),
+)
+
+free_blocks = db.Table(
+    'free_block',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('vlan_id', db.Integer, db.ForeignKey('vlan.id'),
+              nullable=False),
+    db.Column('version', db.Integer, nullable=False, default=4),
+    db.Column('first', Address, nullable=False),
+    db.Column('last', Address, nullable=False),
+    db.Column('size', Address, nullable=False),
+    db.Index('ix_free_block_vlan_first', 'vlan_id', 'version', 'first'),
+    db.Index('ix_free_block_vlan_size', 'vlan_id', 'version', 'size'),
+)
+
+
+def prefix(vlan, version=4):
+    ''' prefix
+    Returns the (cidr, length, address width) of the addresses of a version
+    on the vlan.
+    '''
+    if version == 6:
+        return vlan.cidr6, int(vlan.length6), 128
+    return vlan.cidr, int(vlan.length), 32
+
+
+def offset(vlan, number, version=4):
+    ''' offset
+    Converts an address into its offset within the vlan.
+    '''
+    return number & ~ prefix(vlan, version)[0]
+
+
+def address(vlan, offset, version=4):
+    ''' address
+    Converts an offset within the vlan back into an address.
+    '''
+    return offset | prefix(vlan, version)[0]
+
+
+def bounds(vlan, version=4):
+    ''' bounds
+    Returns the (first, last) offsets that can be handed out on the vlan, if
+    the network and broadcast addresses are reserved they are left out (except
+    on /31 and /32 vlans, which have neither, and IPv6 prefixes, which have
+    no broadcast address).
+    '''
+    _, length, width = prefix(vlan, version)
+    last = (1 << (width - length)) - 1
+    if version == 6:
+        return 0, last
+    if settings.RESERVE_NETWORK_BROADCAST and last > 2:
+        return 1, last - 1
+    return 0, last
+
+
+def runs(offsets):
+    ''' runs
+    Coalesces a collection of offsets into a sorted list of [first, last]
+    runs.
+    '''
+    result = []
+    for offset in sorted(set(offsets)):
+        if result and result[-1][1] + 1 == offset:
+            result[-1][1] = offset
+        else:
+            result.append([offset, offset])
+    return result
+
+
+def subtract(blocks, taken):
+    ''' subtract
+    Removes the runs in `taken` from the sorted runs in `blocks`.
+    '''
+    result = []
+    for first, last in blocks:
+        for t_first, t_last in taken:
+            if t_last < first or t_first > last:
+                continue
+            if t_first > first:
+                result.append([first, t_first - 1])
+            first = t_last + 1
+            if first > last:
+                break
+        if first <= last:
+            result.append([first, last])
+    return result
+
+
+def union(blocks, released):
+    ''' union
+    Merges the runs in `released` into the sorted runs in `blocks`.
+    '''
+    result = []
+    for first, last in sorted(map(list, blocks) + map(list, released)):
+        if result and result[-1][1] + 1 >= first:
+            result[-1][1] = max(result[-1][1], last)
+        else:
+            result.append([first, last])
+    return result
+
+
+def size(blocks):
+    ''' size
+    Returns the number of offsets covered by the runs in `blocks`.
+    '''
+    return sum(last - first + 1 for first, last in blocks)
+
+
+def clamp(vlan, blocks, version=4):
+    ''' clamp
+    Merges the runs in `blocks` and restricts them to the usable bounds of the
+    vlan.
+    '''
+    low, high = bounds(vlan, version)
+    return [[max(first, low), min(last, high)] for first, last in
+            union([], blocks) if last >= low and first <= high]
+
+
+def insert(session, vlan, blocks, version=4):
+    ''' insert
+    Adds the runs in `blocks` to the free space index of the vlan.
+    '''
+    if blocks:
+        session.execute(free_blocks.insert(), [{
+            "vlan_id": vlan.id, "version": version, "first": first,
+            "last": last, "size": last - first + 1} for first, last in blocks])
+
+
+def indexed(table, vlan_id, version):
+    ''' indexed
+    Returns the condition selecting the rows of the `pool` or `free_block`
+    table for one version of a vlan.
+    '''
+    return and_(table.c.vlan_id == vlan_id, table.c.version == version)
+
+
+def ensure(session, vlan, version=4):
+    ''' ensure
+    Makes sure the free space index exists for the vlan, rebuilding it from
+    the allocated IPs if it does not.
+    '''
+    exists = session.execute(select([pools.c.vlan_id]).where(
+        indexed(pools, vlan.id, version))).first()
+    if not exists:
+        rebuild(session, vlan, version)
+
+
+def build(session):
+    ''' build
+    Builds the free space index of every vlan lacking one, for databases
+    created before it existed.
+    '''
+    from .models import Vlan
+
+    for vlan in session.query(Vlan):
+        for version in [4] if vlan.cidr6 is None else [4, 6]:
+            ensure(session, vlan, version)
+
+
+def family(column, version):
+    ''' family
+    Returns the condition selecting the addresses of a version in a column.
+    '''
+    return column < IPV6_START if version == 4 else column >= IPV6_START
+
+
+def rebuild(session, vlan, version=4):
+    ''' rebuild
+    Regenerates the free space index of a vlan from its allocated IPs and
+    reserved blocks.
+    '''
+    from .models import Ip, Block
+
+    session.execute(free_blocks.delete().where(
+        indexed(free_blocks, vlan.id, version)))
+    session.execute(pools.delete().where(indexed(pools, vlan.id, version)))
+
+    numbers = session.execute(select([Ip.number]).where(and_(
+        Ip.vlan_id == vlan.id, family(Ip.number, version))))
+    reserved = session.execute(select([Block.start, Block.size]).where(and_(
+        Block.vlan_id == vlan.id, family(Block.start, version))))
+    allocated = clamp(vlan, runs(
+        [offset(vlan, n, version) for (n,) in numbers]) + [
+        [offset(vlan, start, version),
+         offset(vlan, start, version) + count - 1]
+        for (start, count) in reserved], version)
+
+    session.execute(pools.insert().values(
+        vlan_id=vlan.id, version=version, allocated=size(allocated)))
+    insert(session, vlan, subtract([list(bounds(vlan, version))], allocated),
+           version)
+
+
+def lock(session, vlan, version=4):
+    ''' lock
+    Claims the free space index of the vlan until the end of the transaction,
+    so concurrent allocations on the vlan wait for it to commit instead of
+    handing out the same addresses.  Touching the pool row takes a row lock
+    where the database has them and the write lock on SQLite.
+    '''
+    session.flush()
+    ensure(session, vlan, version)
+    session.execute(pools.update().where(
+        indexed(pools, vlan.id, version)).values(
+        allocated=pools.c.allocated))
+
+
+def peek(session, vlan, count=1, version=4):
+    ''' peek
+    Returns the lowest `count` free offsets of the vlan (fewer if the vlan
+    does not have enough room), without allocating them.  Pending changes are
+    flushed first so the index reflects them.
+    '''
+    session.flush()
+    ensure(session, vlan, version)
+
+    c = free_blocks.c
+    blocks = session.execute(select([c.first, c.last]).where(
+        indexed(free_blocks, vlan.id, version)).order_by(c.first).limit(count))
+
+    offsets = []
+    for first, last in blocks:
+        offsets.extend(range(first, min(last, first + count - len(offsets) - 1)
+                             + 1))
+        if len(offsets) == count:
+            break
+    return offsets
+
+
+def fit(session, vlan, count, align=1, version=4):
+    ''' fit
+    Finds room for a contiguous run of `count` offsets starting on a multiple
+    of `align`, using the smallest free block that can hold it so larger
+    blocks stay intact.  Returns the first offset of the run, or None if the
+    vlan has no room for it.
+    '''
+    session.flush()
+    ensure(session, vlan, version)
+
+    c = free_blocks.c
+    blocks = session.execute(select([c.first, c.last]).where(and_(
+        indexed(free_blocks, vlan.id, version), c.size >= count)).order_by(
+        c.size, c.first))
+
+    for first, last in blocks:
+        start = first + (-first % align)
+        if start + count - 1 <= last:
+            return start
+    return None
+
+
+def allocated(session, vlan, version=4):
+    ''' allocated
+    Returns the number of allocated addresses on the vlan.
+    '''
+    session.flush()
+    ensure(session, vlan, version)
+    return session.execute(select([pools.c.allocated]).where(
+        indexed(pools, vlan.id, version))).scalar()
+
+
+def window(session, vlan, first, last, version=4):
+    ''' window
+    Retrieves the free blocks of the vlan that overlap or touch the run of
+    offsets from `first` to `last`, with two index range lookups.
+    '''
+    c, where = free_blocks.c, indexed(free_blocks, vlan.id, version)
+    columns = [c.id, c.first, c.last]
+    below = session.execute(select(columns).where(and_(
+        where, c.first < first)).order_by(c.first.desc()).limit(1)).fetchall()
+    inside = session.execute(select(columns).where(and_(
+        where, c.first >= first, c.first <= last + 1)).order_by(
+        c.first)).fetchall()
+
+    return [row for row in below if row.last + 1 >= first] + inside
+
+
+def update(session, vlan, blocks, operation, version=4):
+    ''' update
+    Applies `operation` (either `subtract` or `union`) with the runs in
+    `blocks` to the affected free blocks of the vlan, rewriting only the
+    blocks that changed, and adjusts the allocated count.
+    '''
+    changes = clamp(vlan, blocks, version)
+    if not changes:
+        return
+
+    ensure(session, vlan, version)
+    old = window(session, vlan, changes[0][0], changes[-1][1], version)
+    new = operation([[row.first, row.last] for row in old], changes)
+
+    kept = set(map(tuple, new)) & set((row.first, row.last) for row in old)
+    stale = [row.id for row in old if (row.first, row.last) not in kept]
+    fresh = [(f, l) for f, l in new if (f, l) not in kept]
+
+    if stale:
+        session.execute(free_blocks.delete().where(
+            free_blocks.c.id.in_(stale)))
+    insert(session, vlan, fresh, version)
+
+    delta = size([[row.first, row.last] for row in old]) - size(new)
+    if delta:
+        session.execute(pools.update().where(
+            indexed(pools, vlan.id, version)).values(
+            allocated=pools.c.allocated + delta))
+
+
+def take(session, vlan, blocks, version=4):
+    ''' take
+    Marks the runs of offsets as allocated, offsets that are not free are
+    ignored.
+    '''
+    update(session, vlan, blocks, subtract, version)
+
+
+def release(session, vlan, blocks, version=4):
+    ''' release
+    Marks the runs of offsets as free, offsets that are already free are
+    ignored.
+    '''
+    update(session, vlan, blocks, union, version)
+
+
+def drop(session, vlan_ids):
+    ''' drop
+    Removes the free space index of the vlans.
+    '''
+    session.execute(free_blocks.delete().where(
+        free_blocks.c.vlan_id.in_(vlan_ids)))
+    session.execute(pools.delete().where(pools.c.vlan_id.in_(vlan_ids)))
+
+
+def span(obj):
+    ''' span
+    Returns the vlan id and the [first, last] addresses held by an IP or a
+    reserved block, or None if it is not attached to a vlan.
+    '''
+    start = getattr(obj, 'number', None)
+    if start is None:
+        start = getattr(obj, 'start', None)
+    if None in (obj.vlan_id, start):
+        return None
+    return obj.vlan_id, [start, start + getattr(obj, 'size', 1) - 1]
+
+
+def moves(session, models):
+    ''' moves
+    Collects the addresses freed and claimed by the IPs and blocks of a flush,
+    grouped by the id of their vlan and their IP version.
+    '''
+    taken, released = defaultdict(list), defaultdict(list)
+    for (objects, changes) in [(session.new, taken),
+                               (session.deleted, released)]:
+        for (vlan_id, addresses) in filter(None, [
+                span(obj) for obj in objects if isinstance(obj, models)]):
+            changes[vlan_id, ip_version(addresses[0])].append(addresses)
+
+    for ip in session.dirty:
+        if not isinstance(ip, models[0]):
+            continue
+        number = get_history(ip, 'number')
+        vlan_id = get_history(ip, 'vlan_id')
+        if not number.has_changes() and not vlan_id.has_changes():
+            continue
+        old_number = (number.deleted or number.unchanged or [None])[0]
+        old_vlan = (vlan_id.deleted or vlan_id.unchanged or [None])[0]
+        if None not in (old_vlan, old_number):
+            released[old_vlan, ip_version(old_number)].append(
+                [old_number, old_number])
+        if span(ip):
+            taken[ip.vlan_id, ip_version(ip.number)].append(span(ip)[1])
+
+    return taken, released
+
+
+@event.listens_for(Session, 'before_flush')
+def drop_deleted(session, flush_context, instances):
+    ''' drop_deleted
+    Flush listener that removes the free space index of the vlans deleted in
+    the flush, before the vlans themselves so their foreign keys hold.
+    '''
+    from .models import Vlan
+
+    dropped = [obj.id for obj in session.deleted if isinstance(obj, Vlan)]
+    if dropped:
+        drop(session, dropped)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_allocations(session, flush_context):
+    ''' track_allocations
+    Flush listener that applies the IPs and blocks created, moved and deleted
+    in the flush to the free space index of their vlans.
+    '''
+    from .models import Ip, Vlan, Block
+
+    dropped = [obj.id for obj in session.deleted if isinstance(obj, Vlan)]
+    created = [obj for obj in session.new if isinstance(obj, Vlan)]
+    for vlan in created:
+        for version in vlan.versions():
+            rebuild(session, vlan, version)
+
+    taken, released = moves(session, (Ip, Block))
+    skipped = set(dropped) | set(vlan.id for vlan in created)
+    for operation, changes in [(release, released), (take, taken)]:
+        for (vlan_id, version), blocks in changes.items():
+            vlan = None if vlan_id in skipped else \
+                session.query(Vlan).get(vlan_id)
+            if vlan and version in vlan.versions():
+                operation(session, vlan, [
+                    [offset(vlan, first, version),
+                     offset(vlan, first, version) + last - first]
+                    for (first, last) in blocks], version)
@@ -1,5 +1,7 @@
-from . import app
+from . import app, db
+from . import cache, database, metrics
 from .decorators import datatype
+from flask import Response
 import httplib
 
 
@@ -12,4 +14,39 @@ def index():
 @app.get('/version/')
 @datatype
 def get_version():
-    return app.__version__
+    return app.version
+
+
+@app.endpoint('/cache/')
+@datatype
+def cache_stats():
+    ''' cache_stats - GET /cache
+    Returns the counters of the response cache (hits, misses, evictions...)
+    '''
+    return cache.backend().stats()
+
+
+@app.endpoint('/database/')
+@datatype
+def database_stats():
+    ''' database_stats - GET /database
+    Returns the state of the database connection pool (checked out, waiting
+    and idle connections...)
+    '''
+    return database.stats(db.get_engine(app))
+
+
+app.before_request(metrics.start_request)
+app.after_request(metrics.finish_request)
+
+
+@app.endpoint('/metrics')
+@datatype
+def prometheus_metrics():
+    ''' prometheus_metrics - GET /metrics
+    Returns the request, SQL and allocation metrics in the Prometheus text
+    format, or NOT_FOUND if metrics are disabled.
+    '''
+    if not metrics.enabled:
+        return httplib.NOT_FOUND
+    return Response(metrics.collect(), mimetype="text/plain; version=0.0.4")
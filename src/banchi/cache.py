@@ -0,0 +1,247 @@
+''' cache
+An in-process cache of the responses of read endpoints.  Entries are keyed by
+the endpoint, its arguments and the negotiated mimetype, and are tagged with
+the data they were built from (see `changes`) so that `write_operation` can
+drop exactly the entries affected by what it committed.
+
+The storage is pluggable, settings.CACHE_BACKEND names one of `BACKENDS` or
+the import path ("package.module.Class") of a class with the same interface
+as `LocalCache`, which is a bounded LRU with a TTL kept by each process.
+
+Writes of other processes (the other workers of the pre-forking server, or
+`bin/banchi import`) cannot drop the entries of this one, so each entry also
+holds the revisions of the kinds of data it was built from, read by
+`datatype` as the response was built, and is rebuilt once any of them has
+advanced.  The revisions are read again at most every settings.CACHE_CHECK
+seconds, so hits usually do not touch the database and entries are stale for
+at most that long after a write elsewhere.
+'''
+from . import settings
+from collections import OrderedDict
+from functools import wraps
+from importlib import import_module
+from flask import request, Response
+from threading import Lock
+import time
+import httplib
+
+seen = {}  # kind -> (revision last read by the process, when it was read)
+
+
+class NullCache(object):
+    ''' NullCache
+    A backend that stores nothing, used to disable caching.
+    '''
+    def __init__(self, size=None, ttl=None):
+        self.generation = 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, tags, generation):
+        pass
+
+    def invalidate(self, tags):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class LocalCache(object):
+    ''' LocalCache
+    A backend holding up to `size` entries in memory for `ttl` seconds each,
+    evicting the least recently used entry when full.  The generation counts
+    invalidations so a response built while a write was being committed is
+    not stored over the invalidation.
+    '''
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()  # key -> (expires, tags, value)
+            self.tagged = {}  # tag -> set of keys
+            self.generation = 0
+            self.counters = dict.fromkeys(
+                ["hits", "misses", "evictions", "expirations",
+                 "invalidations"], 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] < time.time():
+                self.forget(key, entry)
+                self.counters["expirations"] += 1
+                entry = None
+
+            if not entry:
+                self.counters["misses"] += 1
+                return None
+
+            self.entries[key] = entry  # moves it to the most recent end
+            self.counters["hits"] += 1
+            return entry[2]
+
+    def set(self, key, value, tags, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            if key in self.entries:
+                self.forget(key, self.entries.pop(key))
+            while len(self.entries) >= self.size:
+                self.forget(*self.entries.popitem(last=False))
+                self.counters["evictions"] += 1
+
+            self.entries[key] = (time.time() + self.ttl, tags, value)
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+
+    def forget(self, key, entry):
+        for tag in entry[1]:
+            keys = self.tagged.get(tag, set())
+            keys.discard(key)
+            if not keys:
+                self.tagged.pop(tag, None)
+
+    def invalidate(self, tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self.tagged.pop(tag, ()):
+                    entry = self.entries.pop(key, None)
+                    if entry:
+                        self.forget(key, entry)
+                        self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), size=self.size,
+                         ttl=self.ttl)
+            return stats
+
+
+BACKENDS = {
+    "local": LocalCache,
+    "null": NullCache,
+}
+
+_backend = []
+
+
+def backend():
+    ''' backend
+    Returns the cache backend configured in settings, creating it on first
+    use.
+    '''
+    if not _backend:
+        name = settings.CACHE_BACKEND or "null"
+        if name in BACKENDS:
+            cls = BACKENDS[name]
+        else:
+            module, _, cls = name.rpartition(".")
+            cls = getattr(import_module(module), cls)
+        _backend.append(cls(settings.CACHE_SIZE, settings.CACHE_TTL))
+    return _backend[0]
+
+
+def invalidate(tags):
+    ''' invalidate
+    Drops the cached responses built from any of the tagged data.
+    '''
+    if tags:
+        backend().invalidate(tags)
+
+
+def observe(revisions):
+    ''' observe
+    Records the revisions of kinds of data read from the database.
+    '''
+    now = time.time()
+    for (kind, value) in revisions.items():
+        seen[kind] = (value, now)
+
+
+def stale(revisions):
+    ''' stale
+    Tells whether any of the revisions an entry was built from has advanced
+    since, reading the ones last read over settings.CACHE_CHECK seconds ago
+    again.
+    '''
+    from . import db, changes
+
+    now = time.time()
+    old = [kind for kind in revisions
+           if now - seen.get(kind, (0, 0))[1] >= settings.CACHE_CHECK]
+    if old:
+        observe(dict(zip(old, [value for (value, _) in
+                               changes.current(db.session, old)])))
+    return any(seen[kind][0] > value for (kind, value) in revisions.items())
+
+
+def cached(tags):
+    ''' cached decorator:
+    Caches successful responses of a GET route, keyed by the endpoint, the
+    view and query arguments and the negotiated mimetype.  `tags` is a
+    function that is given the view and query arguments and returns the tags
+    of the data the response is built from (see `changes`), entries are also
+    tagged "<kind>:*" for each kind of item among them, so every entry built
+    from a kind of item can be dropped at once.  Goes above the
+    `paginate` and `datatype` decorators so the whole response is stored,
+    conditional requests are answered from the stored ETag.  Streamed
+    responses (listings, see `decorators.stream`) are passed through, as
+    storing them would hold the whole body in memory.  The `datatype`
+    should have `depends`, the kinds whose revisions are checked on lookup
+    (see `stale`).
+
+    ex:
+        @app.get('/host/<host_name>/')
+        @cached(lambda args: ['host:' + args['host_name']])
+        @datatype(depends=['host'])
+        def host_info(host_name=None):
+    '''
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            store = backend()
+            key = (request.endpoint, tuple(sorted(kwargs.items())),
+                   tuple(sorted(request.args.iteritems(multi=True))),
+                   request.accept_mimetypes.best_match(
+                       ["application/json", "text/html"]))
+
+            entry = store.get(key)
+            if entry is None or stale(entry[3]):
+                generation = store.generation
+                response = func(*args, **kwargs)
+                if response.status_code != httplib.OK or \
+                        response.is_streamed:
+                    return response
+
+                revisions = getattr(request, 'revisions', {})
+                observe(revisions)
+                entry = (response.get_data(), response.status_code,
+                         response.headers.to_list(), revisions)
+                arguments = dict(request.args.items(), **kwargs)
+                tagged = tags(arguments)
+                tagged = tagged + sorted(set(tag.split(':')[0] + ':*'
+                                             for tag in tagged if ':' in tag))
+                store.set(key, entry, tagged, generation)
+
+            data, status, headers, _ = entry
+            response = Response(data, status, headers)
+            if request.if_none_match and \
+                    request.if_none_match.contains(response.get_etag()[0]):
+                response = Response("", httplib.NOT_MODIFIED,
+                                    [("ETag", response.headers["ETag"])])
+            return response
+
+        return decorated_function
+    return decorator
@@ -0,0 +1,329 @@
+''' changes
+Tracks what is changed by each write, both the kinds of data (hosts and
+vlans) and the individual hosts, vlans and IPs, and keeps a persisted revision
+counter for each kind, so readers can tell whether anything they depend on
+has changed without reading it.
+
+A flush listener records the tags of everything touched by each flush in the
+session info, a tag is either a kind ("host") or a kind and the key the data
+is looked up by ("host:www1").  `write_operation` calls `bump` before
+committing, advancing the revision of the changed kinds in the same
+transaction as the changes themselves.
+
+The listener also records an event for each host, IP and vlan created,
+updated or deleted, which `bump` appends to the `change` log, numbered by an
+increasing sequence number.  Appending bumps the "change" revision first,
+whose row lock makes writers append (and commit) in sequence order, so
+readers of the log never see a number before the ones below it.
+
+Every settings.CHANGES_COMPACT events (or once at the end of bulk writes)
+the log is compacted in the same transaction (see `compact`), dropping the
+events superseded by a later one for the same item and, further back, the
+tombstones of deleted items, so it holds little more than an event per
+existing item.  Each compaction only looks at the events appended since the
+one before it.
+'''
+from . import db, settings
+from .utils import int2ip
+from sqlalchemy import event, select, exists, and_
+from sqlalchemy.orm import Session
+from collections import OrderedDict
+import datetime
+import json
+
+revisions = db.Table(
+    'revision',
+    db.Column('name', db.String(20), primary_key=True),
+    db.Column('value', db.Integer, nullable=False, default=0),
+    db.Column('modified', db.DateTime),
+)
+
+log = db.Table(
+    'change',
+    db.Column('seq', db.Integer, primary_key=True),
+    db.Column('kind', db.String(10), nullable=False),
+    db.Column('action', db.String(10), nullable=False),
+    db.Column('key', db.String(50), nullable=False),
+    db.Column('data', db.Text, nullable=False),
+    db.Column('time', db.DateTime, nullable=False),
+    db.Index('ix_change_kind_key', 'kind', 'key', 'seq'),
+    sqlite_autoincrement=True,  # sequence numbers are never reused
+)
+
+
+ORDER = ("vlan", "host", "ip")  # IPs are created after and deleted before
+
+
+def host_tags(host):
+    ''' host_tags
+    Returns the tags of a host.
+    '''
+    return ['host', 'host:{}'.format(host.name)] if host else []
+
+
+def vlan_tags(vlan):
+    ''' vlan_tags
+    Returns the tags of a vlan, which is looked up by number or name.
+    '''
+    return ['vlan', 'vlan:{}'.format(vlan.number),
+            'vlan:{}'.format(vlan.name)] if vlan else []
+
+
+def tags(obj):
+    ''' tags
+    Returns the tags of the data affected by a change to a model, IPs link
+    hosts to vlans so they show up in both, as does removing a vlan (which
+    removes its IPs).
+    '''
+    from .models import Host, Ip, Vlan, Block
+
+    if isinstance(obj, Host):
+        return host_tags(obj)
+    elif isinstance(obj, Ip):
+        return host_tags(obj.host) + vlan_tags(obj.vlan) + \
+            ['host', 'vlan', 'ip:{}'.format(int2ip(obj.number or 0))]
+    elif isinstance(obj, Vlan):
+        return vlan_tags(obj) + ['host']
+    elif isinstance(obj, Block):
+        return vlan_tags(obj.vlan)
+    return []
+
+
+def entry(kind, action, key, **data):
+    ''' entry
+    Returns a change log event, `data` describing the changed item.
+    '''
+    return {"kind": kind, "action": action, "key": unicode(key),
+            "data": data}
+
+
+def vlan_entry(action, vlan):
+    ''' vlan_entry
+    Returns the change log event of a vlan.
+    '''
+    data = {"number": vlan.number, "name": vlan.name,
+            "range": vlan.network()}
+    if vlan.cidr6 is not None:
+        data["range6"] = vlan.network(6)
+    return entry("vlan", action, vlan.number, **data)
+
+
+def events(obj, action):
+    ''' events
+    Returns the change log events of a change to a model.
+    '''
+    from .models import Host, Ip, Vlan
+
+    if isinstance(obj, Host):
+        return [entry("host", action, obj.name, name=obj.name)]
+    elif isinstance(obj, Ip) and obj.number is not None:
+        ip = int2ip(obj.number)
+        return [entry("ip", action, ip, ip=ip,
+                      host=obj.host.name if obj.host else None,
+                      vlan=obj.vlan.number if obj.vlan else None)]
+    elif isinstance(obj, Vlan):
+        return [vlan_entry(action, obj)]
+    return []
+
+
+def kinds(changed):
+    ''' kinds
+    Returns the kinds of data among a set of tags.
+    '''
+    return set(tag for tag in changed if ':' not in tag)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_changes(session, flush_context):
+    ''' track_changes
+    Flush listener that records the tags of the data changed by the flush,
+    and the events of the change log.
+    '''
+    changed = session.info.setdefault('changed', set())
+    logged = session.info.setdefault('events', [])
+    for (objects, action) in [(session.new, "create"),
+                              (session.dirty, "update"),
+                              (session.deleted, "delete")]:
+        flushed = []
+        for obj in objects:
+            if action != "update":
+                changed.update(tags(obj))
+                flushed.extend(events(obj, action))
+            elif session.is_modified(obj):
+                changed.update(tags(obj))
+                if session.is_modified(obj, include_collections=False):
+                    flushed.extend(events(obj, action))  # not just its IPs
+        flushed.sort(key=lambda event: ORDER.index(event["kind"]),
+                     reverse=action == "delete")
+        logged.extend(flushed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    ''' discard_changes
+    Forgets the changes recorded by flushes that were rolled back.
+    '''
+    session.info.pop('changed', None)
+    session.info.pop('events', None)
+
+
+def bump(session):
+    ''' bump
+    Advances the revision of every kind of data changed since the last call
+    and appends their events to the change log, should be called before
+    committing.  Returns the tags of the changes.
+    '''
+    changed = session.info.pop('changed', set())
+    logged = session.info.pop('events', [])
+    if logged:
+        changed.add('change')
+    advance(session, kinds(changed))
+
+    if logged:
+        record(session, logged)
+        latest = last(session)
+        if (latest - len(logged)) // settings.CHANGES_COMPACT < \
+                latest // settings.CHANGES_COMPACT:
+            compact(session)
+    return changed
+
+
+def advance(session, names):
+    ''' advance
+    Advances the revisions of the kinds of data in `names`.
+    '''
+    now = datetime.datetime.utcnow()
+    for kind in names:
+        updated = session.execute(revisions.update().where(
+            revisions.c.name == kind).values(
+            value=revisions.c.value + 1, modified=now))
+        if not updated.rowcount:
+            session.execute(revisions.insert().values(
+                name=kind, value=1, modified=now))
+
+
+def store(session, name, value):
+    ''' store
+    Sets the value of a revision row, for the ones that are not counters.
+    '''
+    updated = session.execute(revisions.update().where(
+        revisions.c.name == name).values(value=value))
+    if not updated.rowcount:
+        session.execute(revisions.insert().values(name=name, value=value))
+
+
+def record(session, logged):
+    ''' record
+    Inserts events into the change log, once the "change" revision has been
+    advanced in the transaction.
+    '''
+    now = datetime.datetime.utcnow()
+    session.execute(log.insert(), [
+        dict(event, data=json.dumps(event["data"], sort_keys=True), time=now)
+        for event in logged])
+
+
+def append(session, logged):
+    ''' append
+    Appends events to the change log right away rather than at `bump`, for
+    writes with too many to hold until then (such as snapshot imports),
+    which call `compact` once they are done rather than every
+    settings.CHANGES_COMPACT events.
+    '''
+    session.info.setdefault('changed', set()).add('change')
+    advance(session, ['change'])
+    record(session, logged)
+
+
+def compact(session):
+    ''' compact
+    Removes the events of the change log superseded by a later event for the
+    same item, other than the latest settings.CHANGES_RETAIN events, and the
+    tombstones (delete events) older than the latest
+    settings.CHANGES_TOMBSTONES events, recording the seq they were removed
+    up to (see `horizon`).  Only the items with events after the seq the
+    last compaction reached can have events to remove, the superseded ones
+    are removed with a single statement looking them up by key.  Returns the
+    number of events removed.
+    '''
+    latest, removed = last(session), 0
+    (reached, _), (start, _) = current(session, ['compaction', 'compacted'])
+    end = latest - settings.CHANGES_RETAIN
+    if end > reached:
+        later, window = log.alias('later'), log.alias('window')
+        keys = select([window.c.key]).where(and_(
+            window.c.seq > reached, window.c.seq <= end))
+        superseded = exists().where(and_(
+            later.c.kind == log.c.kind, later.c.key == log.c.key,
+            later.c.seq > log.c.seq, later.c.seq > reached,
+            later.c.seq <= end))
+        removed += session.execute(log.delete().where(and_(
+            log.c.seq < end, log.c.key.in_(keys), superseded))).rowcount
+        store(session, 'compaction', end)
+
+    cutoff = latest - settings.CHANGES_TOMBSTONES
+    if cutoff > start:
+        removed += session.execute(log.delete().where(and_(
+            log.c.seq > start, log.c.seq <= cutoff,
+            log.c.action == "delete"))).rowcount
+        store(session, 'compacted', cutoff)
+    return removed
+
+
+def horizon(session):
+    ''' horizon
+    Returns the seq the tombstones of the change log were removed up to,
+    changes after an earlier seq can no longer be told apart.
+    '''
+    return current(session, ['compacted'])[0][0]
+
+
+def since(session, seq, limit):
+    ''' since
+    Returns up to `limit` events of the change log after the sequence number
+    `seq`, in order.
+    '''
+    return session.execute(select([log]).where(log.c.seq > seq).order_by(
+        log.c.seq).limit(limit)).fetchall()
+
+
+def delta(session, seq, limit):
+    ''' delta
+    Returns the latest event of each item changed after the seq `seq`,
+    reading up to `limit` events, as the seq of the last event read, whether
+    there may be more and the changes in the order they were last made.
+    Deleted items are tombstones, which have no data.
+    '''
+    rows = since(session, seq, limit)
+    latest = OrderedDict()
+    for row in rows:
+        latest.pop((row.kind, row.key), None)
+        latest[(row.kind, row.key)] = row
+
+    items = []
+    for row in latest.values():
+        item = {"kind": row.kind, "key": row.key, "seq": row.seq,
+                "deleted": row.action == "delete"}
+        if not item["deleted"]:
+            item["data"] = json.loads(row.data)
+        items.append(item)
+    return rows[-1].seq if rows else seq, len(rows) == limit, items
+
+
+def last(session):
+    ''' last
+    Returns the sequence number of the latest event of the change log, 0 if
+    it is empty.
+    '''
+    return session.execute(select([db.func.max(log.c.seq)])).scalar() or 0
+
+
+def current(session, names):
+    ''' current
+    Returns the (value, modified) revision of each of the kinds of data in
+    `names`, kinds that have never changed are at (0, None).
+    '''
+    rows = dict((row.name, (row.value, row.modified)) for row in
+                session.execute(select([revisions]).where(
+                    revisions.c.name.in_(names))))
+    return [rows.get(name, (0, None)) for name in names]
@@ -0,0 +1,457 @@
+''' client
+Command line client of the REST API, run with `bin/banchi-cli`.  Commands
+are given as arguments, typed into an interactive shell when there are none,
+or read one per line from stdin with `--batch`:
+
+    host list | host show <name> | host add <name> [<vlan>...]
+    host delete <name>
+    vlan list | vlan show <vlan> | vlan add <number> <name> <cidr> [<cidr6>]
+    vlan delete <vlan> | vlan stats [<vlan>]
+    block list <vlan> | block add <vlan> <size> [<align> [<name>]]
+    block delete <vlan> <id>
+    find ip <ip> | find host <hostname> | find range <cidr or start-end>
+
+Every request goes over one persistent HTTP/1.1 connection, reopened when
+the server closes it.  The URLs of the endpoints are discovered from `GET /`
+once per server and kept in settings.CLIENT_CACHE, `--refresh` discovers
+them again.
+
+In batch mode, runs of consecutive `host add` commands are sent as bulk
+creates (a failing one is retried a host at a time, so every command gets
+its own result) and runs of `host show` and `find ip` commands as batch
+queries, up to settings.CLIENT_BATCH commands per request.  Each command
+prints a line of JSON with its status and data, or its error.
+'''
+from . import settings
+from urllib import quote, urlencode
+from urlparse import urlsplit
+import argparse
+import cmd
+import httplib
+import inspect
+import json
+import os
+import re
+import shlex
+import socket
+import sys
+
+NEXT = re.compile(r'<([^>]*)>;\s*rel="next"')
+BULK = {  # commands sent together in batch mode -> Client method
+    "host_add": "bulk_create",
+    "host_show": "bulk_query",
+    "find_ip": "bulk_query",
+}
+
+
+class RequestFailed(Exception):
+    ''' RequestFailed
+    Raised for responses with an error status.
+    '''
+    def __init__(self, status, message=None):
+        self.status = status
+        self.message = message or "{} {}".format(
+            status, httplib.responses.get(status, "Error"))
+
+    def __str__(self):
+        return self.message
+
+
+class UsageError(Exception):
+    pass
+
+
+class Connection(object):
+    ''' Connection
+    A persistent HTTP/1.1 connection to the server.  A request that fails on
+    a connection kept from a previous one (which the server may have closed
+    in the meantime) is retried once on a new connection, if it failed
+    before it was sent or it is a GET.  Other requests may have been carried
+    out, so running them again (such as a bulk create) is left to the caller.
+    '''
+    def __init__(self, url, timeout=None):
+        parts = urlsplit(url)
+        kind = httplib.HTTPSConnection if parts.scheme == "https" else \
+            httplib.HTTPConnection
+        self.connection = kind(parts.hostname, parts.port,
+                               timeout=timeout or settings.CLIENT_TIMEOUT)
+        self.opened = 0
+        self.requests = 0
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {}, Accept="application/json")
+        for attempt in range(2):
+            reused, sent = self.connection.sock is not None, False
+            self.opened += not reused
+            try:
+                self.connection.request(method, path, body, headers)
+                sent = True
+                response = self.connection.getresponse()
+                self.requests += 1
+                return response, response.read()
+            except (httplib.BadStatusLine, socket.error):
+                self.connection.close()
+                if attempt or not reused or (sent and method != "GET"):
+                    raise
+
+    def close(self):
+        self.connection.close()
+
+
+class Client(object):
+    ''' Client
+    Runs commands against a server, each command is a method named after its
+    two words ("host show" is `host_show`).
+    '''
+    def __init__(self, url=None, cache=None, refresh=False):
+        self.url = (url or settings.CLIENT_URL).rstrip("/")
+        self.cache = cache or settings.CLIENT_CACHE
+        self.connection = Connection(self.url)
+        self.endpoints = None if refresh else self.cached()
+        self.discovered = False
+        self.status = None
+        self.link = None
+
+    def cached(self):
+        try:
+            with open(self.cache) as cache:
+                return json.load(cache).get(self.url)
+        except (IOError, ValueError, AttributeError):
+            return None
+
+    def discover(self):
+        ''' Client::discover
+        Fetches the URLs of the endpoints from the server and caches them.
+        '''
+        self.endpoints = dict((name, endpoint['url']) for (name, endpoint)
+                              in self.call("GET", "/").items())
+        self.discovered = True
+
+        try:
+            with open(self.cache) as cache:
+                servers = json.load(cache)
+        except (IOError, ValueError):
+            servers = {}
+        servers[self.url] = self.endpoints
+        try:
+            if not os.path.isdir(os.path.dirname(self.cache)):
+                os.makedirs(os.path.dirname(self.cache))
+            with open(self.cache + ".tmp", "w") as cache:
+                json.dump(servers, cache)
+            os.rename(self.cache + ".tmp", self.cache)
+        except (IOError, OSError):
+            pass  # discovered again next time
+
+    def endpoint(self, name, *parts):
+        ''' Client::endpoint
+        Returns the URL of an endpoint, followed by the quoted `parts`.
+        '''
+        if not self.discovered and name not in (self.endpoints or {}):
+            self.discover()
+        if name not in self.endpoints:
+            raise RequestFailed(httplib.NOT_FOUND,
+                                "the server has no {} endpoint".format(name))
+        return self.endpoints[name] + "".join(
+            quote(str(part), safe="") + "/" for part in parts)
+
+    def call(self, method, path, query=None, form=None, data=None):
+        ''' Client::call
+        Makes a request, returning the decoded response or raising
+        RequestFailed for an error status.
+        '''
+        headers, body = {}, None
+        if form is not None:
+            body = urlencode(form, doseq=True)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif data is not None:
+            body = json.dumps(data)
+            headers["Content-Type"] = "application/json"
+        if query:
+            path += "?" + urlencode(query, doseq=True)
+
+        response, text = self.connection.request(method, path, body, headers)
+        if response.status >= 400:
+            raise RequestFailed(response.status)
+        self.status = response.status
+        self.link = response.getheader("link")
+        if not text:
+            return None
+        if "json" in (response.getheader("content-type") or ""):
+            return json.loads(text)
+        return text
+
+    def listing(self, path):
+        ''' Client::listing
+        Returns every item of a paginated listing, following the links to
+        the next pages.
+        '''
+        items, query = [], {"per_page": settings.CLIENT_BATCH}
+        while path:
+            items.extend(self.call("GET", path, query))
+            match = NEXT.search(self.link or "")
+            path, query = (match.group(1) if match else None), None
+        self.status = httplib.OK
+        return items
+
+    def run(self, words):
+        ''' Client::run
+        Runs the command in a list of words, returning its data.
+        '''
+        method = getattr(self, "_".join(words[:2]), None) \
+            if len(words) >= 2 and words[0] in COMMANDS else None
+        if method is None:
+            raise UsageError("unknown command: {}".format(" ".join(words)))
+
+        spec = inspect.getargspec(method)
+        required = len(spec.args) - 1 - len(spec.defaults or ())
+        if len(words) - 2 < required or \
+                not spec.varargs and len(words) - 2 > len(spec.args) - 1:
+            raise UsageError("usage: {}".format(usage(words[:2])))
+        return method(*words[2:])
+
+    def batch(self, lines):
+        ''' Client::batch
+        Generates the result of each command line, as a dict with the
+        command and either its status and data or its error, sending runs
+        of the commands in `BULK` together.
+        '''
+        pending, kind = [], None
+        for line in lines:
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError as e:
+                words, error = None, e
+            if words == []:
+                continue
+
+            name = "_".join(words[:2]) if words else None
+            if pending and (BULK.get(name) != kind or
+                            len(pending) >= settings.CLIENT_BATCH):
+                for result in getattr(self, kind)(pending):
+                    yield result
+                pending, kind = [], None
+
+            if words is None:
+                yield {"command": line.strip(), "error": str(error)}
+            elif name in BULK:
+                pending.append((line.strip(), words))
+                kind = BULK[name]
+            else:
+                yield self.result(line.strip(), words)
+
+        if pending:
+            for result in getattr(self, kind)(pending):
+                yield result
+
+    def result(self, command, words):
+        try:
+            data = self.run(words)
+        except RequestFailed as e:
+            return {"command": command, "status": e.status,
+                    "error": e.message}
+        except UsageError as e:
+            return {"command": command, "error": str(e)}
+        return {"command": command, "status": self.status, "data": data}
+
+    def bulk_create(self, commands):
+        ''' Client::bulk_create
+        Creates the hosts of `host add` commands in one request.
+        '''
+        hosts = [{"name": words[2], "vlan": words[3:]}
+                 for (_, words) in commands if len(words) > 2]
+        if len(commands) > 1 and len(hosts) == len(commands):
+            try:
+                created = self.call("POST", self.endpoint("create_hosts"),
+                                    data=hosts)
+            except RequestFailed:
+                pass  # retried one at a time for the error of each
+            else:
+                created = dict((host["name"], host) for host in created)
+                return [{"command": command, "status": httplib.CREATED,
+                         "data": created[words[2]]}
+                        for (command, words) in commands]
+        return [self.result(command, words) for (command, words) in commands]
+
+    def bulk_query(self, commands):
+        ''' Client::bulk_query
+        Looks up the hosts and IPs of `host show` and `find ip` commands in
+        one batch query.
+        '''
+        if any(len(words) != 3 for (_, words) in commands):
+            return [self.result(command, words)
+                    for (command, words) in commands]
+
+        keys = [("hostname" if words[0] == "host" else "ip", words[2])
+                for (_, words) in commands]
+        found = self.call("POST", self.endpoint("find"), data={
+            "ip": [value for (kind, value) in keys if kind == "ip"],
+            "hostname": [value for (kind, value) in keys
+                         if kind == "hostname"]})
+
+        results = []
+        for ((command, _), (kind, value)) in zip(commands, keys):
+            data = found[kind][value]
+            if isinstance(data, int):
+                results.append({"command": command, "status": data,
+                                "error": RequestFailed(data).message})
+            else:
+                results.append({"command": command, "status": httplib.OK,
+                                "data": data})
+        return results
+
+    def host_list(self):
+        return self.listing(self.endpoint("hosts"))
+
+    def host_show(self, name):
+        return self.call("GET", self.endpoint("hosts", name))
+
+    def host_add(self, name, *vlans):
+        return self.call("POST", self.endpoint("hosts"),
+                         form={"name": name, "vlan": vlans})
+
+    def host_delete(self, name):
+        return self.call("DELETE", self.endpoint("hosts", name))
+
+    def vlan_list(self):
+        return self.listing(self.endpoint("vlans"))
+
+    def vlan_show(self, vlan):
+        return self.call("GET", self.endpoint("vlans", vlan))
+
+    def vlan_add(self, number, name, mask, mask6=None):
+        form = {"number": number, "name": name, "mask": mask}
+        if mask6:
+            form["mask6"] = mask6
+        return self.call("POST", self.endpoint("vlans"), form=form)
+
+    def vlan_delete(self, vlan):
+        return self.call("DELETE", self.endpoint("vlans", vlan))
+
+    def vlan_stats(self, vlan=None):
+        if vlan is None:
+            return self.call("GET", self.endpoint("vlan_stats"))
+        return self.call("GET", self.endpoint("vlans", vlan, "stats"))
+
+    def block_list(self, vlan):
+        return self.call("GET", self.endpoint("vlans", vlan, "block"))
+
+    def block_add(self, vlan, size, align=1, name=None):
+        form = {"size": size, "align": align}
+        if name is not None:
+            form["name"] = name
+        return self.call("POST", self.endpoint("vlans", vlan, "block"),
+                         form=form)
+
+    def block_delete(self, vlan, block_id):
+        return self.call("DELETE",
+                         self.endpoint("vlans", vlan, "block", block_id))
+
+    def find_ip(self, ip):
+        return self.call("GET", self.endpoint("find"), {"ip": ip})
+
+    def find_host(self, hostname):
+        return self.call("GET", self.endpoint("find"), {"hostname": hostname})
+
+    def find_range(self, cidr):
+        return self.call("GET", self.endpoint("find_range"), {"range": cidr})
+
+
+COMMANDS = ("host", "vlan", "block", "find")
+
+
+def usage(words=None):
+    ''' usage
+    Returns the usage of the commands (starting with `words`).
+    '''
+    lines = []
+    for (name, method) in sorted(inspect.getmembers(Client)):
+        if name.split("_")[0] not in COMMANDS or \
+                words and name != "_".join(words):
+            continue
+        spec = inspect.getargspec(method)
+        required = len(spec.args) - len(spec.defaults or ())
+        arguments = ["<{}>".format(arg) for arg in spec.args[1:required]] + \
+            ["[<{}>]".format(arg) for arg in spec.args[required:]] + \
+            (["[<{}>...]".format(spec.varargs[:-1])] if spec.varargs else [])
+        lines.append(" ".join(name.split("_", 1) + arguments))
+    return "\n".join(lines)
+
+
+def show(data, out=None):
+    ''' show
+    Prints the data of a command, text as is and anything else as JSON.
+    '''
+    out = out or sys.stdout
+    if isinstance(data, basestring):
+        out.write(data + "\n")
+    elif data is not None:
+        out.write(json.dumps(data, indent=2, sort_keys=True) + "\n")
+
+
+class Shell(cmd.Cmd):
+    ''' Shell
+    Interactive shell running a command per line.
+    '''
+    prompt = "banchi> "
+
+    def __init__(self, client):
+        cmd.Cmd.__init__(self)
+        self.client = client
+
+    def default(self, line):
+        try:
+            show(self.client.run(shlex.split(line)))
+        except (RequestFailed, UsageError, ValueError) as e:
+            sys.stderr.write("{}\n".format(e))
+
+    def emptyline(self):
+        pass
+
+    def do_help(self, line):
+        sys.stdout.write(usage(shlex.split(line)) + "\n")
+
+    def do_quit(self, line):
+        return True
+
+    do_EOF = do_quit
+
+
+def main(argv=None, stdin=None, stdout=None):
+    ''' main
+    Runs `bin/banchi-cli`, returning its exit status.
+    '''
+    parser = argparse.ArgumentParser(
+        description="Manage hosts and vlans on a banchi server.",
+        epilog="commands:\n" + usage(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="server URL (default {})".format(
+        settings.CLIENT_URL))
+    parser.add_argument("--refresh", action="store_true",
+                        help="discover the endpoints of the server again")
+    parser.add_argument("--batch", action="store_true",
+                        help="run the commands on stdin, one per line")
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    options = parser.parse_args(argv)
+    stdin, stdout = stdin or sys.stdin, stdout or sys.stdout
+
+    client = Client(options.url, refresh=options.refresh)
+    try:
+        if options.batch:
+            failed = False
+            for result in client.batch(stdin):
+                failed = failed or "error" in result
+                stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            return 1 if failed else 0
+        elif options.command:
+            show(client.run(options.command), stdout)
+        else:
+            Shell(client).cmdloop()
+    except (RequestFailed, UsageError) as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+    except (socket.error, httplib.HTTPException) as e:
+        sys.stderr.write("cannot reach {}: {}\n".format(client.url, e))
+        return 2
+    finally:
+        client.connection.close()
+    return 0
@@ -0,0 +1,174 @@
+''' database
+Engine configuration for the database named by settings.DATABASE_URI.  Any
+database SQLAlchemy supports can be used, with SQLite and PostgreSQL being
+the ones that are tested.
+
+Connections are kept in a `MeteredPool` sized by the DATABASE_POOL_* settings
+(set from the environment, see `settings`), which also counts the requests
+waiting on a connection.  SQLite connections get the pragmas in
+settings.SQLITE_PRAGMAS when they are opened, by default write ahead logging
+so readers do not block the writer and a busy timeout so writers wait for
+each other instead of failing with "database is locked".
+
+IP addresses are stored in `Address` columns, as IPv6 addresses do not fit
+the 64 bit integers databases have.  Databases created before that store
+them as integers, `outdated` finds those (and any other column the existing
+tables lack), which have to be exported and imported into a new database.
+'''
+from . import settings
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc, inspect, types
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from threading import Lock
+import sqlite3
+
+
+class MeteredPool(QueuePool):
+    ''' MeteredPool
+    A QueuePool that counts the checkouts waiting for a connection and the
+    ones that timed out waiting.
+    '''
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.counter_lock = Lock()
+        self.waiting = 0
+        self.timeouts = 0
+
+    def _do_get(self):
+        with self.counter_lock:
+            self.waiting += 1
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            with self.counter_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            with self.counter_lock:
+                self.waiting -= 1
+
+    def stats(self):
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": self.overflow(),
+            "waiting": self.waiting,
+            "timeouts": self.timeouts,
+        }
+
+
+class Database(SQLAlchemy):
+    ''' Database
+    Flask-SQLAlchemy extension that creates its engines with a MeteredPool,
+    except for in memory SQLite databases, which have to stay on a single
+    connection.
+    '''
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite') and \
+                info.database in (None, '', ':memory:'):
+            for option in ['pool_size', 'pool_timeout', 'max_overflow']:
+                options.pop(option, None)
+            return SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+        options.setdefault('pool_size', settings.DATABASE_POOL_SIZE)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        options['poolclass'] = MeteredPool
+        if info.drivername.startswith('sqlite'):  # connections move threads
+            options['connect_args'] = {'check_same_thread': False}
+
+
+class Address(types.TypeDecorator):
+    ''' Address
+    Column type for IPv4 and IPv6 addresses (and offsets within their
+    networks), stored as fixed width hexadecimal strings so that they keep
+    their numeric order in comparisons, ranges and indexes on any database.
+    '''
+    impl = types.String(32)
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return "{:032x}".format(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return int(value, 16)
+
+
+def configure(app):
+    ''' configure
+    Copies the database settings into the app config.
+    '''
+    app.config['SQLALCHEMY_DATABASE_URI'] = settings.DATABASE_URI
+    app.config['SQLALCHEMY_POOL_SIZE'] = settings.DATABASE_POOL_SIZE
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = settings.DATABASE_MAX_OVERFLOW
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = settings.DATABASE_POOL_TIMEOUT
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = settings.DATABASE_POOL_RECYCLE
+
+
+@event.listens_for(Engine, 'connect')
+def set_pragmas(connection, record):
+    ''' set_pragmas
+    Connection listener that applies settings.SQLITE_PRAGMAS to new SQLite
+    connections.
+    '''
+    if not isinstance(connection, sqlite3.Connection):
+        return
+    cursor = connection.cursor()
+    for (name, value) in sorted(settings.SQLITE_PRAGMAS.items()):
+        cursor.execute("PRAGMA {} = {}".format(name, value))
+    cursor.close()
+
+
+def stats(engine):
+    ''' stats
+    Returns the state of the connection pool of an engine.
+    '''
+    pool = engine.pool
+    result = {"dialect": engine.dialect.name,
+              "pool": pool.__class__.__name__}
+    if isinstance(pool, MeteredPool):
+        result.update(pool.stats())
+    return result
+
+
+def outdated(engine, metadata):
+    ''' outdated
+    Returns the "table.column" names of the columns of the tables in
+    `metadata` that their existing tables lack or store addresses in as
+    integers, which `create_all` does not migrate.
+    '''
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    columns = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = dict((column['name'], column['type']) for column in
+                        inspector.get_columns(table.name))
+        for column in table.columns:
+            kind = existing.get(column.name)
+            if kind is None or (isinstance(column.type, Address) and
+                                isinstance(kind, types.Integer)):
+                columns.append("{}.{}".format(table.name, column.name))
+    return columns
+
+
+def create_indexes(engine, metadata):
+    ''' create_indexes
+    Creates the indexes of the tables in `metadata` that their existing tables
+    lack, as `create_all` only creates indexes along with new tables.
+    '''
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in
+                       inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
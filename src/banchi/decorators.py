@@ -1,10 +1,15 @@
 import json
+import base64
 import datetime
 import time
+import types
+import random
+import hashlib
 from functools import wraps
 from flask import request, make_response, session, render_template, Flask, \
-    url_for
+    url_for, stream_with_context, Response
 from werkzeug import BaseResponse
+from . import settings, metrics
 import httplib
 
 
@@ -93,17 +98,147 @@ JSON_KWARGS = {
     "separators": (',', ':')
 }
 
+STREAM_CHUNK = 16 * 1024
 
-def datatype(template=None):
+
+def encode_stream(items, prefix="", suffix=""):
+    ''' encode_stream
+    Generates the JSON array of the items produced by an iterable, encoding
+    one item at a time and yielding the output in chunks of roughly
+    STREAM_CHUNK bytes.  The output is identical to `json.dumps` of the list.
+    '''
+    encoder = JSONEncoder(separators=JSON_KWARGS["separators"])
+    chunk, length = [prefix, "["], 0
+    measure, spent = metrics.enabled, 0.0
+    for i, item in enumerate(items):
+        if measure:
+            start = metrics.timer()
+            encoded = encoder.encode(item)
+            spent += metrics.timer() - start
+        else:
+            encoded = encoder.encode(item)
+        chunk.append("," + encoded if i else encoded)
+        length += len(encoded) + 1
+        if length >= STREAM_CHUNK:
+            yield "".join(chunk)
+            chunk, length = [], 0
+
+    chunk.extend(["]", suffix])
+    if measure:
+        metrics.serialized(spent)
+    yield "".join(chunk)
+
+
+def package(data, status_code, mimetypes, default):
+    ''' package
+    Produces a response for a data packet (dict or list), formatted based on
+    the HTTP Accept header or as JSONP if there is a callback parameter.
+    '''
+    callback = request.args.get('callback', False)
+    if callback:  # if has a callback parameter, treat like JSONP
+        data = str(callback) + "(" + \
+            metrics.serialize(mimetypes['application/json'], data) + ");"
+        response = make_response(data, status_code)
+        response.mimetype = 'application/javascript'
+    else:  # Non-JSONP treatment
+        best = request.accept_mimetypes. \
+            best_match(mimetypes.keys())
+        data = metrics.serialize(mimetypes[best or default], data)
+        response = make_response(data, status_code)
+        response.mimetype = best if best else default
+
+    return response
+
+
+def stream(items, status_code, mimetypes):
+    ''' stream
+    Produces a response for a lazily generated list, which is sent as a
+    chunked JSON array (or JSONP) as it is generated so the whole list is
+    never held in memory.  Other negotiated formats need the whole list, so
+    it is collected and rendered normally for those.
+    '''
+    callback = request.args.get('callback', False)
+    best = request.accept_mimetypes.best_match(mimetypes.keys())
+    if not callback and best not in (None, 'application/json'):
+        return package(list(items), status_code, mimetypes, best)
+
+    if callback:  # if has a callback parameter, treat like JSONP
+        body = encode_stream(items, str(callback) + "(", ");")
+        mimetype = 'application/javascript'
+    else:
+        body = encode_stream(items)
+        mimetype = 'application/json'
+
+    return Response(stream_with_context(body), status_code,
+                    mimetype=mimetype)
+
+
+def revision(depends, mimetypes):
+    ''' revision
+    Works out the ETag and Last-Modified values of a response from the
+    current revisions of the kinds of data in `depends` and the format the
+    response will be negotiated into.  The revisions are kept on the
+    request for `cache.cached`.
+    '''
+    from . import db, changes
+
+    current = changes.current(db.session, depends)
+    request.revisions = dict(zip(depends, [value for (value, _) in current]))
+    variant = "{}:{}".format(
+        request.accept_mimetypes.best_match(mimetypes.keys()),
+        request.args.get('callback', ''))
+    etag = "-".join([str(value) for (value, _) in current] +
+                    [hashlib.md5(variant).hexdigest()[:8]])
+    dates = [modified for (_, modified) in current if modified]
+
+    return etag, max(dates) if dates else None
+
+
+def conditional(func, depends, mimetypes):
+    ''' conditional
+    Wraps a datatype handler so that its responses carry an ETag and a
+    Last-Modified header, and conditional requests for data that has not
+    changed get a NOT_MODIFIED without running the handler at all.
+    '''
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        etag, modified = revision(depends, mimetypes)
+        if request.if_none_match:
+            unchanged = request.if_none_match.contains(etag)
+        else:
+            since = request.if_modified_since
+            unchanged = bool(modified and since and
+                             modified.replace(microsecond=0) <= since)
+
+        if unchanged:
+            response = make_response("", httplib.NOT_MODIFIED)
+        else:
+            response = func(*args, **kwargs)
+            if response.status_code != httplib.OK:
+                return response
+
+        response.set_etag(etag)
+        response.vary.add('Accept')
+        if modified:
+            response.last_modified = modified
+        return response
+
+    return decorated_function
+
+
+def datatype(template=None, depends=None):
     ''' datatype decorator:
     This decorator function is used to handle formatting and packaging a
     response coming out of a handler.  It will handle different scenarios and
     produce the proper format of output.  If the output of the route is a
     dictionary, it is assumed to be a data packet and will be formatted based
-    on the HTTP Accept header, if it is a number, it is treated like a HTTP
-    status code.
+    on the HTTP Accept header, if it is a generator, it is streamed as a list
+    (see `stream`), if it is a number, it is treated like a HTTP status code.
 
     argument(optional) template file to render html requests with
+    argument(optional) depends, a list of the kinds of data (see `changes`)
+        the response is built from, if given the response is conditional on
+        their revisions (see `conditional`)
 
     ex:
         @datatype('some_function.html')
@@ -129,30 +264,21 @@ def datatype(template=None):
                 status_code = data[1]
                 data = data[0]
 
-            if type(data) is int:  # if int, treat it like a status code
+            if isinstance(data, types.GeneratorType):  # if lazy, stream it
+                response = stream(data, status_code, mimetypes)
+            elif type(data) is int:  # if int, treat it like a status code
                 response = make_response("", data)
             elif type(data) is dict or type(data) is list:
                 # if it is a dict or list, treat like data packet
-                callback = request.args.get('callback', False)
-                if callback:  # if has a callback parameter, treat like JSONP
-                    data = str(callback) + "(" + \
-                        mimetypes['application/json'](data) + ");"
-                    response = make_response(data, status_code)
-                    response.mimetype = 'application/javascript'
-                else:  # Non-JSONP treatment
-                    best = request.accept_mimetypes. \
-                        best_match(mimetypes.keys())
-                    data = mimetypes[best](data) if best \
-                        else mimetypes[default](data)
-                    response = make_response(data, status_code)
-                    response.mimetype = best if best else default
+                response = package(data, status_code, mimetypes, default)
             elif isinstance(data, BaseResponse):  # if it is a Response, use it
                 response = data
             else:  # otherwise, treat it like raw data
                 response = make_response(data, status_code)
 
             return response
-        return decorated_function
+        return conditional(decorated_function, depends, mimetypes) \
+            if depends else decorated_function
 
     if hasattr(template, '__call__'):  # if no template was given
         return decorator(template)
@@ -160,57 +286,179 @@ def datatype(template=None):
         return decorator
 
 
+def encode_cursor(key):
+    ''' encode_cursor
+    Packs the sort key of the last item of a page into an opaque string.
+    '''
+    return base64.urlsafe_b64encode(json.dumps([key], **JSON_KWARGS))
+
+
+def decode_cursor(cursor):
+    ''' decode_cursor
+    Unpacks a cursor generated by `encode_cursor`, raising a ValueError if it
+    is malformed or its key is not a string or an integer.
+    '''
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor)))[0]
+    except (TypeError, IndexError, KeyError):
+        raise ValueError("malformed cursor")
+    if not isinstance(key, (basestring, int, long)) or isinstance(key, bool):
+        raise ValueError("malformed cursor")
+    return key
+
+
+def windowed(query, column, limit=None):
+    ''' windowed
+    Generates the results of a query ordered by the (unique and indexed)
+    `column`, fetching them settings.WINDOW_SIZE at a time by filtering on
+    the last key of the previous window.  Only a window of models is held at
+    once, and unlike `yield_per` it works with eager loaded relationships.
+    '''
+    last = None
+    while limit is None or limit > 0:
+        size = settings.WINDOW_SIZE if limit is None else \
+            min(limit, settings.WINDOW_SIZE)
+        window = query if last is None else query.filter(column > last)
+        rows = window.order_by(column).limit(size).all()
+        for row in rows:
+            yield row
+
+        if len(rows) < size:
+            return
+        last = getattr(rows[-1], column.key)
+        limit = None if limit is None else limit - size
+
+
+def keyset(query, column, cursor, per_page):
+    ''' keyset
+    Generates the page of `per_page` results of a query following `cursor`
+    when ordered by the (unique and indexed) `column`, so every page costs
+    the same no matter how deep into the listing it is.  The key of the last
+    item is stored for `paginate` if there is another page after it.
+    '''
+    if cursor is not None:
+        query = query.filter(column > cursor)
+
+    boundary = query.with_entities(column).order_by(column).offset(
+        per_page - 1).limit(2)
+    keys = [key for (key,) in boundary]
+    request.next_cursor = keys[0] if len(keys) == 2 else None
+
+    return windowed(query, column, per_page)
+
+
 def paginate(func):
     ''' paginate decorator:
     This decorator function is used to handle the pagination of long lists of
-    models.  It pulls the page count and page size from either the request
+    models.  It pulls the cursor and page size from either the request
     arguments or the session and passes them into the view function.  It then
     adds the 'Link' header to the response.
 
-    Assumes the wrapped function takes kwargs of 'page' and 'per_page' to
-    handle the limiting and offsetting of the query.
+    Assumes the wrapped function takes kwargs of 'cursor' and 'per_page' and
+    limits its query with `keyset`, which finds the cursor of the next page.
     '''
     @wraps(func)
     def decorated_function(*args, **kwargs):
-        page = int(request.args.get('page', 0))
         per_page = request.args.get('per_page', session.get('page_size', 25))
-
-        kwargs['page'] = page
-        kwargs['per_page'] = int(per_page)
+        try:
+            kwargs['per_page'] = max(int(per_page), 1)
+            kwargs['cursor'] = decode_cursor(request.args['cursor']) \
+                if 'cursor' in request.args else None
+        except ValueError:
+            return make_response("", httplib.BAD_REQUEST)
+
+        request.next_cursor = None
+        response = func(*args, **kwargs)
 
         links = []
         vargs = request.view_args.copy()
         if 'per_page' in request.args:
-            vargs['per_page'] = per_page
+            vargs['per_page'] = kwargs['per_page']
 
-        if page > 0:
-            vargs['page'] = page - 1
+        if kwargs['cursor'] is not None:
             links.append(
-                "<" + url_for(request.endpoint, **vargs) + ">; rel=\"prev\"")
+                "<" + url_for(request.endpoint, **vargs) + ">; rel=\"first\"")
 
-        vargs['page'] = page + 1
-        links.append(
-            "<" + url_for(request.endpoint, **vargs) + ">; rel=\"next\"")
+        if request.next_cursor is not None:
+            vargs['cursor'] = encode_cursor(request.next_cursor)
+            links.append(
+                "<" + url_for(request.endpoint, **vargs) + ">; rel=\"next\"")
 
-        response = func(*args, **kwargs)
-        response.headers.add('Link', ", ".join(links))
+        if links:
+            response.headers.add('Link', ", ".join(links))
 
         return response
 
     return decorated_function
 
 
-def write_operation(func):
+TRANSIENT_ERRORS = ["locked", "deadlock", "could not serialize", "busy"]
+
+
+def retryable(error):
+    ''' retryable
+    Tells whether a failed write could succeed if run again: lock timeouts,
+    deadlocks and serialization failures.  Constraint violations are not, as
+    running the write again violates them again.
+    '''
+    from sqlalchemy.exc import OperationalError
+
+    return isinstance(error, OperationalError) and any(
+        message in str(error.orig).lower() for message in TRANSIENT_ERRORS)
+
+
+def write_operation(func=None, retries=None):
     ''' write operation decorator:
     Designates a route that is considered a write operation, handles committing
-    the operations performed during the requests.
+    the operations performed during the requests, advancing the revisions of
+    the data they changed and dropping the cached responses built from it.
+
+    Writes that fail because of a concurrent write (see `retryable`) are
+    rolled back and the whole route is run again, up to `retries` (by default
+    settings.WRITE_RETRIES) times with a random backoff, then a CONFLICT is
+    returned.  Writes violating a constraint (such as a name taken by a
+    concurrent write) are a CONFLICT right away.  Routes that cannot be run
+    twice (such as ones consuming the request stream) should not be retried.
+
+    ex:
+        @app.post('/snapshot/')
+        @datatype
+        @write_operation(retries=0)
+        def restore():
     '''
-    from . import db
+    from . import db, changes, cache, feed
+    from sqlalchemy.exc import DBAPIError, IntegrityError
+
+    if func is None:
+        return lambda func: write_operation(func, retries)
+    if retries is None:
+        retries = settings.WRITE_RETRIES
 
     @wraps(func)
     def decorated_function(*args, **kwargs):
-        response = func(*args, **kwargs)
-        db.session.commit()
-        return response
+        for attempt in range(retries + 1):
+            try:
+                response = func(*args, **kwargs)
+                db.session.flush()
+                changed = changes.bump(db.session)
+                db.session.commit()
+            except DBAPIError as e:
+                db.session.rollback()
+                if isinstance(e, IntegrityError):
+                    break
+                if not retryable(e):
+                    raise
+                if attempt == retries:
+                    break
+                time.sleep(random.uniform(0, settings.WRITE_BACKOFF) *
+                           2 ** attempt)
+                continue
+
+            cache.invalidate(changed)
+            if 'change' in changed:
+                feed.feed.wake()
+            return response
+
+        return httplib.CONFLICT
 
     return decorated_function
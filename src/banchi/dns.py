@@ -0,0 +1,501 @@
+''' dns
+A DNS responder for the allocation data, answering A and AAAA queries for
+hosts and PTR queries for their IPs.  The IP returned for a host is the one
+(of the type asked for) on the vlan
+the query came from, so each vlan resolves a host to its own address on that
+vlan, falling back to all of the host's IPs when the requester is on a vlan
+the host is not on.
+
+Answers come from an in-memory `Index` that is loaded once and then kept up
+to date from the change log (see `changes`): once the revisions of the host or
+vlan data advance, only the events logged since the last seq it saw are
+applied, falling back to loading everything again when there are more than
+settings.DNS_CHANGES of them or they were compacted away.  Encoded answers are
+reused for repeated questions, so serving a query never touches the database.
+The `Server` runs a single threaded event loop over UDP and TCP sockets with
+`select`.
+'''
+from . import db, settings, changes
+from .models import Host, Ip, Vlan
+from .utils import ip2int, isip, version
+import errno
+import json
+import select
+import socket
+import struct
+import time
+
+TYPE_A, TYPE_PTR, TYPE_AAAA, TYPE_ANY = 1, 12, 28, 255
+CLASS_IN = 1
+NOERROR, FORMERR, NXDOMAIN, NOTIMP = 0, 1, 3, 4
+
+FLAG_RESPONSE, FLAG_AUTHORITATIVE, FLAG_RECURSION = 0x8000, 0x0400, 0x0100
+FLAG_TRUNCATED = 0x0200
+OPCODE = 0x7800
+UDP_SIZE = 512  # the largest message over UDP (without EDNS)
+
+REVERSE_ZONE = ['in-addr', 'arpa']
+REVERSE_ZONE6 = ['ip6', 'arpa']
+
+
+def parse(packet):
+    ''' parse
+    Breaks a query into its id, flags, the lowercased labels of the name
+    asked for, the type and class asked for and the raw question section.
+    Raises a ValueError if the query is malformed.
+    '''
+    try:
+        ident, flags, count = struct.unpack('!HHH', packet[:6])
+        labels, offset = [], 12
+        while ord(packet[offset]):
+            length = ord(packet[offset])
+            if length & 0xC0:  # compression is never used in questions
+                raise ValueError("compressed question")
+            labels.append(packet[offset + 1:offset + 1 + length].lower())
+            offset += length + 1
+        qtype, qclass = struct.unpack('!HH', packet[offset + 1:offset + 5])
+    except (IndexError, struct.error):
+        raise ValueError("truncated query")
+
+    if flags & FLAG_RESPONSE or count != 1:
+        raise ValueError("not a single question query")
+    return ident, flags, labels, qtype, qclass, packet[12:offset + 5]
+
+
+def encode_name(labels):
+    ''' encode_name
+    Encodes a domain name from its labels.
+    '''
+    return "".join(chr(len(label)) + label for label in labels) + "\0"
+
+
+def build(ident, flags, question, rcode, answers=()):
+    ''' build
+    Assembles a response to a query from its id, flags and question section
+    and the already encoded answer records.
+    '''
+    flags = FLAG_RESPONSE | FLAG_AUTHORITATIVE | \
+        (flags & (OPCODE | FLAG_RECURSION)) | rcode
+    return struct.pack('!HHHHHH', ident, flags, 1 if question else 0,
+                       len(answers), 0, 0) + question + "".join(answers)
+
+
+def truncate(response, size=UDP_SIZE):
+    ''' truncate
+    Cuts a response down to the whole answer records that fit in `size`
+    bytes, setting the TC bit if any were left out so the client asks again
+    over TCP.
+    '''
+    if len(response) <= size:
+        return response
+    ident, flags, questions = struct.unpack('!HHH', response[:6])
+    offset, count = 12, 0
+    if questions:
+        while ord(response[offset]):
+            offset += ord(response[offset]) + 1
+        offset += 5
+    while offset + 12 <= len(response):
+        length = struct.unpack('!H', response[offset + 10:offset + 12])[0]
+        if offset + 12 + length > size:
+            break
+        offset, count = offset + 12 + length, count + 1
+    return struct.pack('!HHHHHH', ident, flags | FLAG_TRUNCATED, questions,
+                       count, 0, 0) + response[12:offset]
+
+
+def record(rtype, rdata):
+    ''' record
+    Encodes an answer record for the name in the question (by pointing at the
+    question, which is always at offset 12).
+    '''
+    return struct.pack('!HHHIH', 0xC00C, rtype, CLASS_IN, settings.DNS_TTL,
+                       len(rdata)) + rdata
+
+
+def netmask(length, width=32):
+    return ((1 << width) - 1) ^ ((1 << (width - length)) - 1)
+
+
+def address_record(number):
+    ''' address_record
+    Encodes the A or AAAA record of an IP.
+    '''
+    if version(number) == 4:
+        return record(TYPE_A, struct.pack('!I', number))
+    return record(TYPE_AAAA, struct.pack(
+        '!QQ', number >> 64, number & ((1 << 64) - 1)))
+
+
+def nibbles(labels):
+    ''' nibbles
+    Converts the labels of an ip6.arpa name into the IPv6 number they spell,
+    or None if they are not 32 hexadecimal digits.
+    '''
+    digits = "".join(reversed(labels))
+    if len(labels) != 32 or len(digits) != 32:
+        return None
+    try:
+        return int(digits, 16)
+    except ValueError:
+        return None
+
+
+class Index(object):
+    ''' Index
+    In-memory copy of the host, IP and vlan data needed to answer queries,
+    along with the encoded answers already given.
+    '''
+    def __init__(self):
+        self.hosts = {}  # host name -> [(vlan number, ip)]
+        self.names = {}  # ip -> host name
+        self.vlans = {}  # vlan number -> [(width, prefix length, network)]
+        self.networks = []  # [((width, prefix length), {network: vlan})]
+        self.answers = {}  # (question, flags, vlan number) -> response
+        self.revision = None
+        self.seq = None  # of the last change log event applied
+        self.checked = 0
+        self.zone = filter(None, settings.DNS_ZONE.lower().split('.'))
+
+    def refresh(self, session, force=False):
+        ''' Index::refresh
+        Updates the data if its revisions advanced since the last refresh,
+        checking at most every settings.DNS_REFRESH seconds.
+        '''
+        now = time.time()
+        if not force and now - self.checked < settings.DNS_REFRESH:
+            return False
+        self.checked = now
+
+        revision = changes.current(session, ['host', 'vlan'])
+        refresh = force or revision != self.revision
+        if refresh:
+            if force or not self.update(session):
+                self.load(session)
+            self.revision = revision
+
+        session.rollback()  # so the next check sees newer data
+        return refresh
+
+    def load(self, session):
+        ''' Index::load
+        Reads the hosts, IPs and vlans with one query each, without building
+        models for them.  Names are kept as encoded labels are.
+        '''
+        self.seq = changes.last(session)  # later events are applied again
+        hosts, names, vlans = {}, {}, {}
+        for (name, number, vlan) in session.query(
+                Host.name, Ip.number, Vlan.number).join(
+                Ip, Ip.host_id == Host.id).join(
+                Vlan, Ip.vlan_id == Vlan.id):
+            name = name.encode('utf-8')
+            hosts.setdefault(name.lower(), []).append((vlan, number))
+            names[number] = name
+        for (name,) in session.query(Host.name):
+            hosts.setdefault(name.encode('utf-8').lower(), [])
+        for (vlan, cidr, length, cidr6, length6) in session.query(
+                Vlan.number, Vlan.cidr, Vlan.length, Vlan.cidr6,
+                Vlan.length6):
+            vlans[vlan] = [(32, length, cidr & netmask(length))]
+            if cidr6 is not None:
+                vlans[vlan].append(
+                    (128, length6, cidr6 & netmask(length6, 128)))
+
+        self.hosts, self.names, self.vlans = hosts, names, vlans
+        self.index_networks()
+
+    def update(self, session):
+        ''' Index::update
+        Applies the events of the change log since the last one seen, returns
+        False (applying none) if there are more than settings.DNS_CHANGES or
+        some may have been compacted away.
+        '''
+        if self.seq is None or self.seq < changes.horizon(session):
+            return False
+        rows = changes.since(session, self.seq, settings.DNS_CHANGES + 1)
+        if len(rows) > settings.DNS_CHANGES:
+            return False
+
+        vlans = False
+        for row in rows:
+            data = json.loads(row.data)
+            if row.kind == 'host':
+                self.apply_host(row.action, row.key.encode('utf-8'))
+            elif row.kind == 'ip':
+                self.apply_ip(row.action, ip2int(row.key), data)
+            elif row.kind == 'vlan':
+                self.apply_vlan(row.action, int(row.key), data)
+                vlans = True
+        if vlans:
+            self.index_networks()
+        if rows:
+            self.seq = rows[-1].seq
+        self.answers = {}
+        return True
+
+    def apply_host(self, action, name):
+        ''' Index::apply_host
+        Applies a host event, its IPs have events of their own.
+        '''
+        if action == "delete":
+            self.hosts.pop(name.lower(), None)
+        else:
+            self.hosts.setdefault(name.lower(), [])
+
+    def apply_ip(self, action, number, data):
+        ''' Index::apply_ip
+        Applies an IP event, moving the IP off of the host it was on.
+        '''
+        name = self.names.pop(number, None)
+        if name is not None and name.lower() in self.hosts:
+            self.hosts[name.lower()] = [
+                ip for ip in self.hosts[name.lower()] if ip[1] != number]
+        if action != "delete" and data.get("host"):
+            name = data["host"].encode('utf-8')
+            self.hosts.setdefault(name.lower(), []).append(
+                (data["vlan"], number))
+            self.names[number] = name
+
+    def apply_vlan(self, action, vlan, data):
+        ''' Index::apply_vlan
+        Applies a vlan event to its networks, `index_networks` has to be
+        called after.
+        '''
+        self.vlans.pop(vlan, None)
+        if action == "delete":
+            return
+        self.vlans[vlan] = []
+        for network in filter(None, [data.get("range"), data.get("range6")]):
+            address, length = network.split('/')
+            width = 32 if version(ip2int(address)) == 4 else 128
+            self.vlans[vlan].append((width, int(length), ip2int(address) &
+                                     netmask(int(length), width)))
+
+    def index_networks(self):
+        ''' Index::index_networks
+        Groups the networks of the vlans by prefix length, most specific
+        first, for `vlan_of`.
+        '''
+        networks = {}
+        for (vlan, ranges) in self.vlans.items():
+            for (width, length, network) in ranges:
+                networks.setdefault((width, length), {})[network] = vlan
+        self.networks = sorted(networks.items(), reverse=True)
+
+    def vlan_of(self, source):
+        ''' Index::vlan_of
+        Finds the most specific vlan containing the source address.
+        '''
+        if not isip(source):
+            return None
+        address = ip2int(source)
+        family = 32 if version(address) == 4 else 128
+        for ((width, length), networks) in self.networks:
+            if width != family:
+                continue
+            vlan = networks.get(address & netmask(length, width))
+            if vlan is not None:
+                return vlan
+        return None
+
+    def resolve(self, labels, qtype, vlan):
+        ''' Index::resolve
+        Returns the response code and encoded answers for a question.
+        '''
+        if labels[-2:] == REVERSE_ZONE:
+            return self.resolve_ptr(ip2int(".".join(reversed(labels[:-2])))
+                                    if len(labels) == 6 else None, qtype)
+        if labels[-2:] == REVERSE_ZONE6:
+            return self.resolve_ptr(nibbles(labels[:-2]), qtype)
+
+        if self.zone and labels[-len(self.zone):] == self.zone:
+            labels = labels[:-len(self.zone)]
+        ips = self.hosts.get(".".join(labels))
+        if ips is None:
+            return NXDOMAIN, []
+
+        answers = []
+        for (rtype, family) in [(TYPE_A, 4), (TYPE_AAAA, 6)]:
+            if qtype not in (rtype, TYPE_ANY):
+                continue
+            ips_of = [(on, number) for (on, number) in ips
+                      if version(number) == family]
+            local = [number for (on, number) in ips_of if on == vlan]
+            answers.extend(address_record(number) for number
+                           in local or [number for (_, number) in ips_of])
+        return NOERROR, answers
+
+    def resolve_ptr(self, number, qtype):
+        ''' Index::resolve_ptr
+        Returns the response code and encoded answer for a reverse lookup of
+        an IP number (None if the name asked for is not a valid IP).
+        '''
+        name = self.names.get(number) if number is not None else None
+        if name is None:
+            return NXDOMAIN, []
+        if qtype not in (TYPE_PTR, TYPE_ANY):
+            return NOERROR, []
+
+        return NOERROR, [record(TYPE_PTR,
+                                encode_name(name.split('.') + self.zone))]
+
+    def answer(self, packet, source):
+        ''' Index::answer
+        Produces the response to a query packet from the source address, or
+        None if the packet cannot be answered at all.
+        '''
+        try:
+            ident, flags, labels, qtype, qclass, question = parse(packet)
+        except ValueError:  # answer bad queries, but never bad responses
+            if len(packet) < 12 or ord(packet[2]) & 0x80:
+                return None
+            return build(struct.unpack('!H', packet[:2])[0],
+                         struct.unpack('!H', packet[2:4])[0], "", FORMERR)
+
+        vlan = self.vlan_of(source)
+        key = (question, flags & (OPCODE | FLAG_RECURSION), vlan)
+        response = self.answers.get(key)
+        if response is None:
+            if flags & OPCODE or qclass != CLASS_IN:
+                rcode, answers = NOTIMP, []
+            else:
+                rcode, answers = self.resolve(labels, qtype, vlan)
+            response = build(0, flags, question, rcode, answers)
+
+            if len(self.answers) >= settings.DNS_ANSWER_CACHE:
+                self.answers.clear()
+            self.answers[key] = response
+
+        return struct.pack('!H', ident) + response[2:]
+
+
+class Connection(object):
+    ''' Connection
+    Buffers of a TCP client, whose messages are prefixed with their length.
+    '''
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbox = ""
+        self.outbox = ""
+
+    def messages(self):
+        while len(self.inbox) >= 2:
+            length = struct.unpack('!H', self.inbox[:2])[0]
+            if len(self.inbox) < length + 2:
+                break
+            message, self.inbox = self.inbox[2:length + 2], \
+                self.inbox[length + 2:]
+            yield message
+
+
+class Server(object):
+    ''' Server
+    Answers queries over UDP and TCP from one thread, waiting on all of the
+    sockets with `select` and refreshing the index between batches.  UDP
+    answers too long for a datagram are truncated (see `truncate`).
+    '''
+    BATCH = 256  # UDP packets handled per wake up
+
+    def __init__(self, index, host, port):
+        self.index = index
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp.bind((host, port))
+        self.tcp.bind(self.udp.getsockname())  # same port if it was picked
+        for sock in (self.udp, self.tcp):
+            sock.setblocking(False)
+        self.tcp.listen(64)
+        self.connections = {}
+
+    def serve_forever(self, session):
+        ''' Server::serve_forever
+        Runs the event loop, refreshing the index from the session.
+        '''
+        while True:
+            self.index.refresh(session)
+            self.poll(settings.DNS_REFRESH)
+
+    def poll(self, timeout):
+        ''' Server::poll
+        Waits for and handles a round of socket events.
+        '''
+        writers = [conn.sock for conn in self.connections.values()
+                   if conn.outbox]
+        readable, writable, _ = select.select(
+            [self.udp, self.tcp] + self.connections.keys(), writers, [],
+            timeout)
+
+        for sock in readable:
+            if sock is self.udp:
+                self.receive()
+            elif sock is self.tcp:
+                self.accept()
+            else:
+                self.read(self.connections[sock])
+        for sock in writable:
+            if sock in self.connections:
+                self.write(self.connections[sock])
+
+    def receive(self):
+        for _ in xrange(self.BATCH):
+            try:
+                packet, address = self.udp.recvfrom(UDP_SIZE)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            response = self.index.answer(packet, address[0])
+            if response:
+                try:
+                    self.udp.sendto(truncate(response), address)
+                except socket.error:
+                    pass
+
+    def accept(self):
+        try:
+            sock, address = self.tcp.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self.connections[sock] = Connection(sock, address)
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(4096)
+        except socket.error:
+            data = ""
+        if not data:
+            return self.close(conn)
+
+        conn.inbox += data
+        for message in conn.messages():
+            response = self.index.answer(message, conn.address[0])
+            if response:
+                conn.outbox += struct.pack('!H', len(response)) + response
+        self.write(conn)
+
+    def write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbox)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.close(conn)
+        conn.outbox = conn.outbox[sent:]
+
+    def close(self, conn):
+        self.connections.pop(conn.sock, None)
+        conn.sock.close()
+
+
+def serve(app, host=None, port=None):
+    ''' serve
+    Loads the index and answers queries until interrupted.
+    '''
+    with app.app_context():
+        index = Index()
+        index.refresh(db.session, force=True)
+        server = Server(index, host or settings.DNS_HOST,
+                        port or settings.DNS_PORT)
+        server.serve_forever(db.session)
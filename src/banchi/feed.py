@@ -0,0 +1,256 @@
+''' feed
+Pushes the change log (see `changes`) to subscribers as server-sent events,
+so consumers learn about created, updated and deleted hosts, IPs and vlans
+without polling the listings.  Each event carries its sequence number as
+its id, and a subscriber that reconnects with the last id it saw (in the
+`Last-Event-ID` header, or `since`) gets every event after it:
+
+    id: 42
+    event: create
+    data: {"seq":42,"kind":"ip","action":"create","key":"10.0.0.5",...}
+
+Every process keeps one `Feed` with the latest events, which all of its
+subscribers read from.  Subscribers wait on a condition rather than each
+polling the database, and while any are waiting one of them at a time checks
+the "change" revision (a single row read) every settings.CHANGES_POLL
+seconds, or right away when a write of the process commits, and reads the new
+events for all of them.  Subscribers that fell further behind than the
+buffered events catch up from the database first.  Streams do not count
+against the request threads of the production server (see `Worker.detach`).
+
+Mirrors that sync now and then rather than follow the stream ask for the
+delta since the last seq they saw (GET /changes/?since=<seq>), which holds
+the latest state of each item changed after it, and a tombstone for each one
+deleted.  Deltas before the compaction horizon (see `changes.compact`) are
+GONE, and such mirrors sync again from the listings.
+'''
+from . import app, db, settings, changes
+from .decorators import datatype, JSON_KWARGS
+from .cache import cached
+from flask import request, Response, stream_with_context
+from collections import deque
+from threading import Condition
+import httplib
+import json
+import time
+
+BASE_PATH = '/changes/'
+
+
+def encode(row):
+    ''' encode
+    Formats a change log row as a server-sent event.
+    '''
+    event = {"seq": row.seq, "kind": row.kind, "action": row.action,
+             "key": row.key, "data": json.loads(row.data),
+             "time": row.time.isoformat()}
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        row.seq, row.action, json.dumps(event, **JSON_KWARGS))
+
+
+class Feed(object):
+    ''' Feed
+    Buffer of the latest settings.CHANGES_BUFFER encoded events of the change
+    log, kept current by the subscribers waiting on it.
+    '''
+    def __init__(self):
+        self.condition = Condition()
+        self.events = deque()  # (seq, encoded event)
+        self.last = None  # seq of the latest event read, once started
+        self.floor = None  # seq of the latest event no longer buffered
+        self.revision = None
+        self.checked = 0
+        self.polling = False
+        self.woken = False
+        self.subscribers = 0
+
+    def subscribe(self):
+        ''' Feed::subscribe
+        Counts a new subscriber, returning False if there are already
+        settings.CHANGES_SUBSCRIBERS of them.
+        '''
+        with self.condition:
+            if self.subscribers >= settings.CHANGES_SUBSCRIBERS:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def wake(self):
+        ''' Feed::wake
+        Has the change log checked now rather than at the next poll, called
+        when a write commits.
+        '''
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def start(self, session):
+        ''' Feed::start
+        Returns the seq of the latest event, starting the feed from it the
+        first time.
+        '''
+        with self.condition:
+            while self.last is None:
+                if self.polling:
+                    self.condition.wait()
+                else:
+                    self.turn(session)
+            return self.last
+
+    def turn(self, session):
+        ''' Feed::turn
+        Polls the change log on behalf of every subscriber, called with the
+        condition held, which is released while polling.
+        '''
+        self.polling, self.woken = True, False
+        self.condition.release()
+        try:
+            self.poll(session)
+        finally:
+            self.condition.acquire()
+            self.polling, self.checked = False, time.time()
+            self.condition.notify_all()
+
+    def poll(self, session):
+        ''' Feed::poll
+        Reads the events committed since the last poll if the "change"
+        revision advanced, releasing the connection afterwards.
+        '''
+        try:
+            revision = changes.current(session, ['change'])[0][0]
+            if self.last is None:
+                self.last = self.floor = changes.last(session)
+            fresh = []
+            while revision != self.revision:
+                rows = changes.since(session, self.last if not fresh else
+                                     fresh[-1][0], settings.WINDOW_SIZE)
+                fresh.extend((row.seq, encode(row)) for row in rows)
+                if len(rows) < settings.WINDOW_SIZE:
+                    self.revision = revision
+        finally:
+            session.close()
+
+        with self.condition:
+            self.events.extend(fresh)
+            while len(self.events) > settings.CHANGES_BUFFER:
+                self.floor = self.events.popleft()[0]
+            if fresh:
+                self.last = fresh[-1][0]
+
+    def wait(self, session, after, timeout):
+        ''' Feed::wait
+        Returns the buffered (seq, event) pairs after the seq `after`,
+        waiting up to `timeout` seconds for some.  Waiting subscribers take
+        turns polling the change log.
+        '''
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if self.last > after:
+                    return [(seq, event) for (seq, event) in self.events
+                            if seq > after]
+                now = time.time()
+                if now >= deadline:
+                    return []
+                if self.polling:
+                    self.condition.wait(deadline - now)
+                elif self.woken or now >= self.checked + settings.CHANGES_POLL:
+                    self.turn(session)
+                else:
+                    self.condition.wait(
+                        min(deadline, self.checked + settings.CHANGES_POLL) -
+                        now)
+
+feed = Feed()
+
+
+def events(session, after):
+    ''' events
+    Generates the server-sent events after the seq `after` as they are
+    committed, with a comment every settings.CHANGES_HEARTBEAT seconds
+    without any so that dead connections are noticed.
+    '''
+    yield "retry: {}\n\n".format(int(settings.CHANGES_RETRY * 1000))
+    while True:
+        if after < feed.floor:  # fell behind the buffer
+            rows = changes.since(session, after, settings.WINDOW_SIZE)
+            session.close()
+            after = rows[-1].seq if rows else feed.floor
+            if rows:
+                yield "".join(encode(row) for row in rows)
+            continue
+
+        fresh = feed.wait(session, after, settings.CHANGES_HEARTBEAT)
+        if fresh:
+            after = fresh[-1][0]
+            yield "".join(event for (_, event) in fresh)
+        else:
+            yield ": keep-alive\n\n"
+
+
+@app.endpoint(BASE_PATH)
+@cached(lambda args: ['change'])
+@datatype(depends=['change'])
+def delta():
+    ''' delta - GET /changes
+        GET: since=<seq> (optional)
+    Returns the hosts, IPs and vlans changed after the event with the seq
+    `since`, each as the data of its latest event or as a tombstone
+    (`deleted`) if it was removed, in the order they were last changed.  At
+    most settings.CHANGES_DELTA events are read at once, `more` is set if
+    there may be more changes after `seq`, which is the seq to ask for the
+    changes since next.  Without `since` only the latest seq is returned.  A
+    malformed seq is a BAD_REQUEST, and one before the compaction horizon is
+    GONE.
+    '''
+    since = request.args.get('since')
+    if since is None:
+        return {"seq": changes.last(db.session), "more": False,
+                "changes": []}
+    try:
+        since = int(since)
+    except ValueError:
+        return httplib.BAD_REQUEST
+    if since < changes.horizon(db.session):
+        return httplib.GONE
+
+    seq, more, items = changes.delta(db.session, since,
+                                     settings.CHANGES_DELTA)
+    return {"since": since, "seq": seq, "more": more, "changes": items}
+
+
+@app.endpoint(BASE_PATH + "stream/")
+@datatype
+def stream():
+    ''' stream - GET /changes/stream
+        GET: since=<seq> (optional)
+    Streams the creations, updates and deletions of hosts, IPs and vlans as
+    server-sent events as they are committed, starting after the event with
+    the seq in the `Last-Event-ID` header or `since` (from the latest event
+    if neither is given).  A malformed seq is a BAD_REQUEST, one before the
+    compaction horizon is GONE, and once settings.CHANGES_SUBSCRIBERS are
+    subscribed a SERVICE_UNAVAILABLE is returned.
+    '''
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        after = int(since) if since else None
+    except ValueError:
+        return httplib.BAD_REQUEST
+    if after is not None and after < changes.horizon(db.session):
+        return httplib.GONE
+    latest = feed.start(db.session)
+    if not feed.subscribe():
+        return httplib.SERVICE_UNAVAILABLE
+
+    request.environ.get('banchi.detach', lambda: None)()
+    response = Response(stream_with_context(events(
+        db.session, latest if after is None else after)),
+        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # proxies pass events on
+    response.call_on_close(feed.unsubscribe)  # even if never iterated
+    return response
@@ -0,0 +1,131 @@
+''' hiera
+Lookup endpoints for a Hiera backend.  Puppet asks for keys of the form
+`<host>_<vlan>_ip` (and `<host>_<vlan>_ip6` for the IPv6 addresses of
+dual-stack vlans, see `Ip.__tuple__`), which are answered along with whole
+hosts (every key of the host) in one query, so a catalog compile can fetch
+everything it needs in a single round trip.
+
+Both host and vlan names may contain underscores, so a key is split at every
+underscore into the possible (host, vlan) pairs and the query matches all of
+them through the unique name indexes, keeping only the rows that produce one
+of the requested keys.
+'''
+from . import models
+from . import app, db
+from .utils import int2ip, version
+from .decorators import datatype
+from .cache import cached
+from flask import request
+from sqlalchemy import and_, or_
+import httplib
+
+BASE_PATH = '/hiera/'
+SUFFIXES = {4: '_ip', 6: '_ip6'}
+
+
+def candidates(key):
+    ''' candidates
+    Returns the (host, vlan) name pairs that could produce a key.
+    '''
+    suffix = SUFFIXES[6 if key.endswith(SUFFIXES[6]) else 4]
+    if not key.endswith(suffix):
+        return []
+    parts = key[:-len(suffix)].split('_')
+    return [('_'.join(parts[:i]), '_'.join(parts[i:]))
+            for i in range(1, len(parts))]
+
+
+def resolve(keys=(), hosts=()):
+    ''' resolve
+    Returns a dict of the values of the requested keys and of every key of
+    the requested hosts, keys with no value are left out.
+    '''
+    keys, hosts = set(keys), set(hosts)
+    pairs = [pair for key in keys for pair in candidates(key)]
+    clauses = []
+    if hosts:
+        clauses.append(models.Host.name.in_(hosts))
+    if pairs:
+        clauses.append(and_(models.Host.name.in_(set(h for h, _ in pairs)),
+                            models.Vlan.name.in_(set(v for _, v in pairs))))
+    if not clauses:
+        return {}
+
+    rows = db.session.query(
+        models.Host.name, models.Vlan.name, models.Ip.number).select_from(
+        models.Ip).join(models.Host, models.Ip.host_id == models.Host.id).join(
+        models.Vlan, models.Ip.vlan_id == models.Vlan.id).filter(
+        or_(*clauses))
+
+    values = {}
+    for host, vlan, number in rows:
+        key = "{}_{}{}".format(host, vlan, SUFFIXES[version(number)])
+        if host in hosts or key in keys:
+            values[key] = int2ip(number)
+    return values
+
+
+def lookup_tags(args):
+    ''' lookup_tags
+    Returns the cache tags of a lookup, the hosts (and vlans) that any of the
+    keys could belong to.
+    '''
+    keys = request.args.getlist('key') or [args.get('key', '')]
+    pairs = [pair for key in keys for pair in candidates(key)]
+    return ['host:' + host for host in request.args.getlist('host')] + \
+        ['host:' + host for host, _ in pairs] + \
+        ['vlan:' + vlan for _, vlan in pairs]
+
+
+@app.endpoint(BASE_PATH)
+@cached(lookup_tags)
+@datatype(depends=['host', 'vlan'])
+def lookup():
+    ''' lookup - GET /hiera
+        GET: key=[<host>_<vlan>_ip or <host>_<vlan>_ip6]
+             host=[<hostname>]
+    Returns an object with the value of every requested key and every key of
+    the requested hosts, keys without a value are left out.
+    '''
+    keys = request.args.getlist('key')
+    hosts = request.args.getlist('host')
+    if not keys and not hosts:
+        return httplib.BAD_REQUEST
+
+    return resolve(keys, hosts)
+
+
+@app.post(BASE_PATH)
+@datatype
+def lookup_batch():
+    ''' lookup_batch - POST /hiera
+        POST: key=[<host>_<vlan>_ip]
+              host=[<hostname>]
+        POST: {"keys": [<host>_<vlan>_ip], "hosts": [<hostname>]}
+    Same as the GET lookup, for batches too large to fit in a query string.
+    '''
+    data = request.get_json(silent=True)
+    if data is None:
+        keys, hosts = request.form.getlist('key'), request.form.getlist('host')
+    elif isinstance(data, dict):
+        keys, hosts = data.get('keys', []), data.get('hosts', [])
+    else:
+        return httplib.BAD_REQUEST
+
+    if not isinstance(keys, list) or not isinstance(hosts, list) or \
+            not (keys or hosts) or \
+            not all(isinstance(name, basestring) for name in keys + hosts):
+        return httplib.BAD_REQUEST
+
+    return resolve(keys, hosts)
+
+
+@app.get(BASE_PATH + "<key>/")
+@cached(lookup_tags)
+@datatype(depends=['host', 'vlan'])
+def lookup_key(key):
+    ''' lookup_key - GET /hiera/<key>
+    Returns the value of a single `<host>_<vlan>_ip` key.
+    '''
+    values = resolve(keys=[key])
+    return values[key] if key in values else httplib.NOT_FOUND
@@ -1,36 +1,95 @@
 from . import models
 from . import app, db
-from . import errors
-from .decorators import datatype, write_operation
+from . import errors, serializers
+from .decorators import datatype, write_operation, paginate, keyset
+from .cache import cached
 from flask import request
+from collections import Counter
 import httplib
 
 BASE_PATH = '/host/'
 
 
 @app.endpoint(BASE_PATH)
-@datatype
-def hosts():
+@cached(lambda args: ['host'])
+@paginate
+@datatype(depends=['host'])
+def hosts(cursor=None, per_page=None):
     ''' hosts - GET /host
-    Returns an array of all the hosts
+        GET: cursor=<cursor> (optional)
+             per_page=<page size> (optional)
+    Returns a page of the hosts ordered by name, the next page is linked in
+    the `Link` header.
     '''
-    return [host.__simple__() for host in models.Host.query.all()]
+    return serializers.host_listing(keyset(
+        serializers.host_query(), models.Host.name, cursor, per_page))
 
 
 @app.get(BASE_PATH + "<host_name>/")
-@datatype
+@cached(lambda args: ['host:' + args['host_name']])
+@datatype(depends=['host'])
 def host_info(host_name=None):
     ''' host_info - GET /host/<host_name>
     Returns a more detailed set of information for the host specified by the
-    `host_name` parameter, or BAD_REQUEST if no host exists with that name.
+    `host_name` parameter, or NOT_FOUND if no host exists with that name.
     '''
     if host_name:
-        return models.Host.query.filter(
-            models.Host.name == host_name).first().__full__()
+        return serializers.host_details(host_name) or httplib.NOT_FOUND
     else:
         return httplib.BAD_REQUEST
 
 
+def provision(requested):
+    ''' provision
+    Creates the hosts in `requested`, a list of (name, [vlan_id]) pairs, and
+    allocates an IP for each of their vlans, both an IPv4 and an IPv6 one on
+    dual-stack vlans.  The existing hosts and the vlans are looked up with
+    one query each and every address needed on a vlan is taken in one pass
+    over its free space.  Nothing is created unless all of
+    the hosts can be, otherwise the status code is returned: CONFLICT if a
+    name is in use, BAD_REQUEST if a vlan does not exist and
+    PRECONDITION_FAILED if a vlan cannot fit all of its hosts.
+    '''
+    names = [name for (name, _) in requested]
+    if not all(names):
+        return httplib.BAD_REQUEST
+    if len(set(names)) != len(names) or models.Host.query.filter(
+            models.Host.name.in_(names)).count():
+        return httplib.CONFLICT
+
+    try:
+        requested = [(name, map(int, vlans)) for (name, vlans) in requested]
+    except (TypeError, ValueError):
+        return httplib.BAD_REQUEST
+
+    demand = Counter(number for (_, vlans) in requested for number in vlans)
+    vlans = {vlan.number: vlan for vlan in models.Vlan.query.filter(
+        models.Vlan.number.in_(demand.keys())).all()} if demand else {}
+    if len(vlans) != len(demand):
+        return httplib.BAD_REQUEST
+
+    try:  # vlans are locked in order of their number to avoid deadlocks
+        free = {(number, version): iter(vlans[number].get_free(count, version))
+                for (number, count) in sorted(demand.items())
+                for version in vlans[number].versions()}
+    except errors.FullVlanException:
+        return httplib.PRECONDITION_FAILED
+
+    hosts = []
+    for (name, numbers) in requested:
+        host = models.Host(name=name)
+        db.session.add(host)
+        db.session.add_all([
+            models.Ip(number=next(free[number, version]), vlan=vlans[number],
+                      host=host)
+            for number in numbers for version in vlans[number].versions()])
+        hosts.append(host)
+
+    db.session.flush()
+    return models.Host.query.options(db.subqueryload('vlans')).filter(
+        models.Host.id.in_(map(lambda h: h.id, hosts))).all()
+
+
 @app.post(BASE_PATH)
 @datatype
 @write_operation
@@ -39,32 +98,60 @@ def create_host():
         POST: name=<host_name>
               vlan=[<vlan_id>]
     Creates a host with the specified name and allocates IP addresses on each
-    of the specified vlans and returns the simple listing for the host.  If
+    of the specified vlans (an IPv4 and an IPv6 one on dual-stack vlans) and
+    returns the simple listing for the host.  If
     an IP cannot be allocated due to limits, a PRECONDITION_FAILED will be
     returned, if a vlan does not exist, a BAD_REQUEST will be returned.
     '''
-    name = request.form['name']
-    vlans = request.form.getlist('vlan')
+    hosts = provision(
+        [(request.form['name'], request.form.getlist('vlan'))])
+    if type(hosts) is int:
+        return hosts
 
-    if models.Host.query.filter(models.Host.name == name).count():
-        return httplib.CONFLICT
+    return hosts[0].__simple__(), httplib.CREATED
+
+
+def bulk_request():
+    ''' bulk_request
+    Reads the hosts of a bulk request, either a JSON list of objects (or an
+    object with the list under `hosts`) each with a `name` and a `vlan` list,
+    or a form where every `name` is created on every `vlan`.
+    '''
+    data = request.get_json(silent=True)
+    if data is None:
+        vlans = request.form.getlist('vlan')
+        return [(name, vlans) for name in request.form.getlist('name')]
+
+    if isinstance(data, dict):
+        data = data.get('hosts', [])
+    if not isinstance(data, list) or \
+            not all(isinstance(host, dict) for host in data):
+        return None
+
+    return [(host.get('name'), host.get('vlan', [])) for host in data]
+
+
+@app.endpoint(BASE_PATH + "bulk/", methods=["POST"])
+@datatype
+@write_operation
+def create_hosts():
+    ''' create_hosts - POST /host/bulk
+        POST: name=[<host_name>]
+              vlan=[<vlan_id>]
+        POST: [{"name": <host_name>, "vlan": [<vlan_id>]}]
+    Creates all of the hosts with IPs allocated on their vlans in a single
+    transaction and returns the simple listing of every host.  Either all of
+    the hosts are created or none are, with the same errors as create_host.
+    '''
+    requested = bulk_request()
+    if not requested:
+        return httplib.BAD_REQUEST
+
+    hosts = provision(requested)
+    if type(hosts) is int:
+        return hosts
 
-    host = models.Host(name=name)
-    db.session.add(host)
-
-    for vlan_id in vlans:
-        try:
-            vlan = models.Vlan.query.filter(
-                models.Vlan.number == int(vlan_id)).first()
-            if not vlan:
-                return httplib.BAD_REQUEST
-            ip = models.Ip(number=vlan.get_next(), vlan=vlan, host=host)
-            db.session.add(ip)
-        except errors.FullVlanException:
-            db.session.rollback()
-            return httplib.PRECONDITION_FAILED
-
-    return host.__simple__(), httplib.CREATED
+    return [host.__simple__() for host in hosts], httplib.CREATED
 
 
 @app.route(BASE_PATH + "<host_name>/", methods=["DELETE"])
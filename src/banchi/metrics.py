@@ -0,0 +1,309 @@
+''' metrics
+Request instrumentation served at /metrics in the Prometheus text format:
+latency, response size and SQL statements of each endpoint, the time spent
+encoding responses and the time allocations take.
+
+Nothing is recorded until `install` is called (by `setup` when
+settings.METRICS is on), which adds the SQL listeners, so a disabled service
+only pays for checking the `enabled` flag in the request hooks, the
+serializers and the allocator.
+
+Each process keeps its own `Registry`.  Under the pre-forking server every
+worker also writes its values to a file in settings.METRICS_DIR (at most
+every settings.METRICS_FLUSH seconds, and when it exits), and /metrics adds
+up the files of every worker, past ones included, so counters never go back.
+'''
+from . import settings
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+import json
+import os
+import timeit
+
+LATENCY = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0,
+           10.0)
+SIZES = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNTS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+METRICS = {  # name -> (type, help, buckets)
+    "banchi_requests_total": (
+        "counter", "Requests handled.", None),
+    "banchi_request_duration_seconds": (
+        "histogram", "Time spent on requests, streaming included.", LATENCY),
+    "banchi_response_size_bytes": (
+        "histogram", "Size of the response bodies.", SIZES),
+    "banchi_request_sql_queries": (
+        "histogram", "SQL statements run per request.", COUNTS),
+    "banchi_serialization_duration_seconds": (
+        "histogram", "Time spent encoding response data.", LATENCY),
+    "banchi_sql_queries_total": (
+        "counter", "SQL statements run.", None),
+    "banchi_sql_duration_seconds": (
+        "histogram", "Time spent running each SQL statement.", LATENCY),
+    "banchi_allocation_duration_seconds": (
+        "histogram", "Time spent finding free addresses.", LATENCY),
+}
+
+timer = timeit.default_timer
+enabled = False
+dumped = [0.0]
+
+
+class Registry(object):
+    ''' Registry
+    Thread safe store of counter values and histograms, keyed by the metric
+    name and a tuple of (label, value) pairs.  A histogram is the count of
+    observations in each bucket (and above the last), their sum and count.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [[0] * (len(buckets) + 1),
+                                                0.0, 0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        ''' Registry::snapshot
+        Returns a JSON serializable copy of the values.
+        '''
+        with self.lock:
+            return [[name, labels, [list(value[0]), value[1], value[2]]
+                     if isinstance(value, list) else value]
+                    for ((name, labels), value) in self.values.items()]
+
+    def merge(self, snapshot):
+        ''' Registry::merge
+        Adds the values of a snapshot to these.
+        '''
+        for (name, labels, value) in snapshot:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if isinstance(value, list):
+                current = self.values.setdefault(
+                    key, [[0] * len(value[0]), 0.0, 0])
+                current[0] = [a + b for (a, b) in zip(current[0], value[0])]
+                current[1] += value[1]
+                current[2] += value[2]
+            else:
+                self.values[key] = self.values.get(key, 0) + value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+registry = Registry()
+
+
+def escape(value):
+    return unicode(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def series(name, labels, extra=()):
+    pairs = ",".join('{}="{}"'.format(label, escape(value))
+                     for (label, value) in tuple(labels) + tuple(extra))
+    return "{}{{{}}}".format(name, pairs) if pairs else name
+
+
+def render(values):
+    ''' render
+    Formats the values of a registry in the Prometheus text format.
+    '''
+    lines = []
+    for name in sorted(METRICS):
+        kind, text, buckets = METRICS[name]
+        keys = sorted(labels for (metric, labels) in values if metric == name)
+        if not keys:
+            continue
+        lines.extend(["# HELP {} {}".format(name, text),
+                      "# TYPE {} {}".format(name, kind)])
+        for labels in keys:
+            value = values[(name, labels)]
+            if kind == "counter":
+                lines.append("{} {}".format(series(name, labels), value))
+                continue
+            total = 0
+            for (bound, count) in zip(list(buckets) + ["+Inf"], value[0]):
+                total += count
+                lines.append("{} {}".format(series(
+                    name + "_bucket", labels, [("le", bound)]), total))
+            lines.append("{} {!r}".format(series(name + "_sum", labels),
+                                          value[1]))
+            lines.append("{} {}".format(series(name + "_count", labels),
+                                        value[2]))
+    return "\n".join(lines) + "\n"
+
+
+def dump(force=False):
+    ''' dump
+    Writes the values of this process to settings.METRICS_DIR, if set, at
+    most every settings.METRICS_FLUSH seconds unless forced.
+    '''
+    directory = settings.METRICS_DIR
+    now = timer()
+    if not directory or not force and \
+            now - dumped[0] < settings.METRICS_FLUSH:
+        return
+    dumped[0] = now
+
+    path = os.path.join(directory, "{}.json".format(os.getpid()))
+    with open(path + ".tmp", "w") as out:
+        json.dump(registry.snapshot(), out)
+    os.rename(path + ".tmp", path)
+
+
+def collect():
+    ''' collect
+    Returns the text of the values of this process and of every process
+    that wrote to settings.METRICS_DIR.
+    '''
+    total = Registry()
+    total.merge(registry.snapshot())
+    directory = settings.METRICS_DIR
+    if directory and os.path.isdir(directory):
+        own = "{}.json".format(os.getpid())
+        for name in os.listdir(directory):
+            if name.endswith(".json") and name != own:
+                try:
+                    with open(os.path.join(directory, name)) as values:
+                        total.merge(json.load(values))
+                except (IOError, ValueError):  # replaced while being read
+                    continue
+    return render(total.values)
+
+
+def endpoint():
+    return (request.url_rule and request.endpoint) or "none"
+
+
+def timed(name, **labels):
+    ''' timed decorator:
+    Records the duration of each call of the function in a histogram.
+    '''
+    labels = tuple(sorted(labels.items()))
+
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, labels, timer() - start)
+        return decorated_function
+    return decorator
+
+
+def allocation(operation):
+    ''' allocation decorator:
+    Records the duration of an allocator operation.
+    '''
+    return timed("banchi_allocation_duration_seconds", operation=operation)
+
+
+def serialize(encoder, data):
+    ''' serialize
+    Encodes data with an encoder function, recording the time it took.
+    '''
+    if not enabled:
+        return encoder(data)
+    start = timer()
+    try:
+        return encoder(data)
+    finally:
+        serialized(timer() - start)
+
+
+def serialized(seconds):
+    ''' serialized
+    Records time spent encoding the data of the current request.
+    '''
+    registry.observe("banchi_serialization_duration_seconds",
+                     (("endpoint", endpoint()),), seconds)
+
+
+def start_request():
+    if enabled:
+        g.metrics = {"start": timer(), "queries": 0, "size": 0}
+
+
+def finish_request(response):
+    ''' finish_request
+    Records the request once the response is sent, streamed responses are
+    counted as they are sent and recorded when they are closed.
+    '''
+    state = getattr(g, "metrics", None)
+    if not enabled or state is None:
+        return response
+    labels = (("endpoint", endpoint()), ("method", request.method))
+    status = str(response.status_code)
+
+    if response.is_streamed:
+        response.response = counted(response.response, state)
+        response.call_on_close(lambda: record(labels, status, state))
+    else:
+        state["size"] = response.content_length or 0
+        record(labels, status, state)
+    return response
+
+
+def counted(body, state):
+    for chunk in body:
+        state["size"] += len(chunk)
+        yield chunk
+
+
+def record(labels, status, state):
+    registry.inc("banchi_requests_total", labels + (("status", status),))
+    registry.observe("banchi_request_duration_seconds", labels,
+                     timer() - state["start"])
+    registry.observe("banchi_response_size_bytes", labels, state["size"])
+    registry.observe("banchi_request_sql_queries", labels, state["queries"])
+    dump()
+
+
+def before_execute(conn, cursor, statement, parameters, context, many):
+    conn.info.setdefault("metrics_start", []).append(timer())
+
+
+def after_execute(conn, cursor, statement, parameters, context, many):
+    elapsed = timer() - conn.info["metrics_start"].pop()
+    if not enabled:
+        return
+    labels = (("endpoint", "none"),)
+    if has_request_context():
+        labels = (("endpoint", endpoint()),)
+        if hasattr(g, "metrics"):
+            g.metrics["queries"] += 1
+    registry.inc("banchi_sql_queries_total", labels)
+    registry.observe("banchi_sql_duration_seconds", labels, elapsed)
+
+
+def install():
+    ''' install
+    Starts recording requests and every SQL statement.
+    '''
+    global enabled
+    if not event.contains(Engine, "before_cursor_execute", before_execute):
+        event.listen(Engine, "before_cursor_execute", before_execute)
+        event.listen(Engine, "after_cursor_execute", after_execute)
+    enabled = True
@@ -1,21 +1,28 @@
-from .utils import int2ip
+from .utils import int2ip, version
+from .database import Address
 from . import errors
 from . import db
+from . import allocator
+from . import metrics
 from flask import url_for
 
 
 class Ip(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    number = db.Column(db.Integer)
-    vlan_id = db.Column(db.Integer, db.ForeignKey('vlan.id'))
-    host_id = db.Column(db.Integer, db.ForeignKey('host.id'))
+    number = db.Column(Address, index=True)
+    vlan_id = db.Column(db.Integer, db.ForeignKey('vlan.id'), index=True)
+    host_id = db.Column(db.Integer, db.ForeignKey('host.id'), index=True)
 
+    __table_args__ = (
+        db.UniqueConstraint('vlan_id', 'number', name='uq_ip_vlan_number'),
+    )
     __mapper_args__ = {
         "confirm_deleted_rows": False
     }
 
     def __tuple__(self):
-        name = "{}_{}_ip".format(self.host.name, self.vlan.name)
+        name = "{}_{}_ip{}".format(self.host.name, self.vlan.name,
+                                   "" if version(self.number) == 4 else "6")
         return (name, str(self))
 
     def __str__(self):
@@ -25,40 +32,130 @@ class Ip(db.Model):
 class Vlan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
-    cidr = db.Column(db.Integer)
+    cidr = db.Column(db.BigInteger)
     number = db.Column(db.Integer, unique=True)
     length = db.Column(db.Integer)
+    cidr6 = db.Column(Address)  # the IPv6 prefix of dual-stack vlans
+    length6 = db.Column(db.Integer)
     ips = db.relationship("Ip", backref='vlan', cascade="delete")
+    blocks = db.relationship("Block", backref='vlan', cascade="delete")
+
+    RESERVED = ("stats",)  # names of the routes under /vlan/
+
+    @metrics.allocation("get_next")
+    def get_next(self, version=4):
+        ''' Vlan::get_next
+        Returns the lowest free address of a version on the vlan, using the
+        free space index maintained by the allocator instead of the allocated
+        IPs.  The vlan stays locked for the rest of the transaction.
+        '''
+        allocator.lock(db.session, self, version)
+        free = allocator.peek(db.session, self, version=version)
+        if free:
+            return allocator.address(self, free[0], version)
 
-    def get_next(self):
-        mask = ~ self.cidr
-        allocated = set(map(lambda ip: ip.number & mask, self.ips))
-        for i in range(0, 1 << (32 - self.length)):
-            if i not in allocated:
-                return i | self.cidr
+        raise errors.FullVlanException(
+            "{} addresses allocated on {}".format(
+                allocator.allocated(db.session, self, version),
+                self.network(version)))
+
+    @metrics.allocation("get_free")
+    def get_free(self, count, version=4):
+        ''' Vlan::get_free
+        Returns the lowest `count` free addresses of a version on the vlan in
+        one pass over the free space index, or raises if the vlan does not
+        have that many.  The vlan stays locked for the rest of the
+        transaction.
+        '''
+        allocator.lock(db.session, self, version)
+        free = allocator.peek(db.session, self, count, version)
+        if len(free) == count:
+            return [allocator.address(self, offset, version)
+                    for offset in free]
 
         raise errors.FullVlanException(
-            "{} addresses allocated on {}/{}".format(len(self.ips),
-                                                     int2ip(self.cidr),
-                                                     self.length))
+            "{} of {} addresses available on {}".format(
+                len(free), count, self.network(version)))
+
+    @metrics.allocation("reserve")
+    def reserve(self, count, align=1, name=None, version=4):
+        ''' Vlan::reserve
+        Reserves a contiguous block of `count` addresses starting on a multiple
+        of `align`, taken from the smallest free block of the vlan it fits in.
+        Raises if the vlan has no room for the block.  The vlan stays locked
+        for the rest of the transaction.
+        '''
+        allocator.lock(db.session, self, version)
+        start = allocator.fit(db.session, self, count, align, version)
+        if start is None:
+            raise errors.FullVlanException(
+                "no room for {} addresses on {}".format(
+                    count, self.network(version)))
+
+        return Block(vlan=self, size=count, name=name,
+                     start=allocator.address(self, start, version))
+
+    def versions(self):
+        ''' Vlan::versions
+        Returns the IP versions the vlan has addresses of.
+        '''
+        return [4] if self.cidr6 is None else [4, 6]
+
+    def network(self, version=4):
+        ''' Vlan::network
+        Returns the prefix of the addresses of a version on the vlan in CIDR
+        notation.
+        '''
+        cidr, length, _ = allocator.prefix(self, version)
+        return "{}/{}".format(int2ip(cidr), length)
 
     def __str__(self):
         return str(self.number)
 
     def __simple__(self):
-        return {
+        simple = {
             "name": self.name,
             "number": self.number,
-            "range": "{}/{}".format(int2ip(self.cidr), self.length),
+            "range": self.network(),
             "url": url_for("vlan_info", vlan_name=self.name),
         }
+        if self.cidr6 is not None:
+            simple["range6"] = self.network(6)
+        return simple
 
     def __full__(self):
-        return {
+        full = {
             "name": self.name,
             "number": self.number,
-            "range": "{}/{}".format(int2ip(self.cidr), self.length),
+            "range": self.network(),
             "hosts": [host.name for host in self.hosts],
+            "blocks": [block.__simple__() for block in self.blocks],
+        }
+        if self.cidr6 is not None:
+            full["range6"] = self.network(6)
+        return full
+
+
+class Block(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50))
+    start = db.Column(Address, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    vlan_id = db.Column(db.Integer, db.ForeignKey('vlan.id'), nullable=False)
+
+    def __str__(self):
+        return "{}-{}".format(int2ip(self.start),
+                              int2ip(self.start + self.size - 1))
+
+    def __simple__(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "start": int2ip(self.start),
+            "end": int2ip(self.start + self.size - 1),
+            "size": self.size,
+            "url": url_for("release_block", vlan_name=self.vlan.name,
+                           block_id=self.id),
         }
 
 
@@ -76,7 +173,13 @@ class Host(db.Model):
         }
 
     def __full__(self):
-        return {
+        full = {
             "name": self.name,
-            "ips": dict(map(lambda ip: (str(ip.vlan), str(ip)), self.ips)),
+            "ips": dict((str(ip.vlan), str(ip)) for ip in self.ips
+                        if version(ip.number) == 4),
         }
+        ips6 = dict((str(ip.vlan), str(ip)) for ip in self.ips
+                    if version(ip.number) == 6)
+        if ips6:
+            full["ips6"] = ips6
+        return full
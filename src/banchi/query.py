@@ -1,46 +1,165 @@
 from . import models
-from . import app
-from .utils import ip2int, isip
+from . import app, db, settings, search, serializers
+from .utils import ip2int, int2ip, isip, parse_range, version
 from .decorators import datatype
+from .cache import cached
 from flask import request
+from sqlalchemy import select
 import httplib
 
 
+def find_tags(args):
+    ''' find_tags
+    Returns the cache tags of a query, an IP lookup only changes with that IP
+    while a hostname search can change with any host.
+    '''
+    if args.get('ip'):
+        return ['ip:' + int2ip(ip2int(args['ip']))] if isip(args['ip']) \
+            else []
+    return ['host']
+
+
 @app.endpoint("/query/")
-@datatype
+@cached(find_tags)
+@datatype(depends=['host', 'vlan'])
 def find():
     ''' find - GET /query
         GET: ip=<ip_string>
-             host=<hostname>
+             hostname=<hostname or glob pattern>
+             limit=<maximum number of hosts> (optional)
     Tries to retrieve the value associated with the string provided, including
     IP addresses and their names or ip names and their addresses. If there is
     nothing for the result a NOT_FOUND is returned, if the value is malformed
-    (such as a non IP for the IP string) a BAD_REQUEST is returned.
+    (such as a non IP for the IP string) a BAD_REQUEST is returned.  Hostnames
+    are searched for as substrings (or prefixes if shorter than 3 characters)
+    unless they contain glob wildcards (`*` and `?`), see `search`.
     '''
     ip = request.args.get('ip')
     if ip:
         return find_ip(ip)
     host = request.args.get('hostname')
     if host:
-        return find_host(host)
+        try:
+            limit = int(request.args.get('limit', settings.SEARCH_LIMIT))
+        except ValueError:
+            return httplib.BAD_REQUEST
+        return find_host(host, max(limit, 1))
 
 
 def find_ip(ip):
     if not isip(ip):
         return httplib.BAD_REQUEST
-    ip = models.Ip.query.filter(
+    ip = models.Ip.query.options(
+        db.joinedload('host'), db.joinedload('vlan')).filter(
         models.Ip.number == ip2int(ip)).first()
     return ip.__tuple__()[0] if ip else httplib.NOT_FOUND
 
 
-def find_host(hostname):
+def find_host(hostname, limit=None):
     if not len(hostname):
         return httplib.BAD_REQUEST
-    hosts = models.Host.query.filter(
-        models.Host.name.like('%' + hostname + '%'))
-    if hosts.count() == 0:
+    hosts = search.search(serializers.host_query(), hostname, limit).all()
+    if len(hosts) == 0:
         return httplib.NOT_FOUND
-    elif hosts.count() == 1:
-        return hosts.first().__full__()
+    elif len(hosts) == 1:
+        return serializers.host_details(host_id=hosts[0].id)
+
+    return list(serializers.host_listing(hosts))
+
+
+@app.endpoint("/query/range/")
+@datatype(depends=['host', 'vlan'])
+def find_range():
+    ''' find_range - GET /query/range
+        GET: range=<IPv4 or IPv6 cidr or start_ip-end_ip>
+    Streams the IPs allocated in a CIDR or an inclusive range of addresses in
+    address order, each with its host and vlan number.  A malformed range is
+    a BAD_REQUEST.  The allocations are read with a single scan of the index
+    on the IP numbers.
+    '''
+    bounds = parse_range(request.args.get('range', ''))
+    if bounds is None:
+        return httplib.BAD_REQUEST
+    return allocations(*bounds)
+
+
+def allocations(first, last):
+    Host, Ip, Vlan = (model.__table__ for model in
+                      (models.Host, models.Ip, models.Vlan))
+    rows = db.session.execute(
+        select([Ip.c.number, Host.c.name, Vlan.c.number.label('vlan')])
+        .where(Ip.c.host_id == Host.c.id).where(Ip.c.vlan_id == Vlan.c.id)
+        .where(Ip.c.number.between(first, last))
+        .order_by(Ip.c.number, Ip.c.id)
+        .execution_options(stream_results=True))
+    for row in rows:
+        yield {"ip": int2ip(row.number), "host": row.name, "vlan": row.vlan}
+
+
+def batch_request():
+    ''' batch_request
+    Reads the IPs and hostnames of a batch query, either a JSON object with
+    `ip` and `hostname` lists or a form with any number of each.
+    '''
+    data = request.get_json(silent=True)
+    if data is None:
+        return request.form.getlist('ip'), request.form.getlist('hostname')
+
+    if not isinstance(data, dict):
+        return None
+    ips, hosts = data.get('ip', []), data.get('hostname', [])
+    if not isinstance(ips, list) or not isinstance(hosts, list) or \
+            not all(isinstance(item, basestring) for item in ips + hosts):
+        return None
+    return ips, hosts
+
+
+def ip_names(numbers):
+    ''' ip_names
+    Returns the names (as in `find_ip`) of the IPs with the given numbers,
+    keyed by number, looking up a window of numbers at a time.
+    '''
+    Host, Ip, Vlan = (model.__table__ for model in
+                      (models.Host, models.Ip, models.Vlan))
+    names = {}
+    for batch in serializers.batches(set(numbers)):
+        for (number, host, vlan) in db.session.execute(
+                select([Ip.c.number, Host.c.name, Vlan.c.name])
+                .where(Ip.c.host_id == Host.c.id)
+                .where(Ip.c.vlan_id == Vlan.c.id)
+                .where(Ip.c.number.in_(batch)).order_by(Ip.c.id)):
+            names.setdefault(number, "{}_{}_ip{}".format(
+                host, vlan, "" if version(number) == 4 else "6"))
+    return names
+
+
+@app.post("/query/")
+@datatype
+def find_batch():
+    ''' find_batch - POST /query
+        POST: ip=[<ip_string>]
+              hostname=[<hostname>]
+        POST: {"ip": [<ip_string>], "hostname": [<hostname>]}
+    Looks up many IP addresses and hostnames at once, returning an object
+    with an `ip` and a `hostname` object that map each of the requested
+    values to what GET /query would return for it, or to NOT_FOUND or
+    BAD_REQUEST when it would return that status.  Hostnames are matched
+    exactly rather than searched for.  The lookups take a fixed number of
+    queries for every settings.WINDOW_SIZE values.
+    '''
+    requested = batch_request()
+    if not requested or not any(requested):
+        return httplib.BAD_REQUEST
+    ips, hostnames = requested
+
+    valid = dict((ip, ip2int(ip)) for ip in ips if isip(ip))
+    names = ip_names(valid.values())
+    hosts = serializers.hosts_details(name for name in hostnames if name)
 
-    return [host.__simple__() for host in hosts.all()]
+    return {
+        "ip": dict((ip, names.get(valid[ip], httplib.NOT_FOUND)
+                    if ip in valid else httplib.BAD_REQUEST) for ip in ips),
+        "hostname": dict((name, hosts.get(name, httplib.NOT_FOUND)
+                          if name else httplib.BAD_REQUEST)
+                         for name in hostnames),
+    }
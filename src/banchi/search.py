@@ -0,0 +1,161 @@
+''' search
+Hostname search backed by an index of the trigrams (every run of three
+characters) of each host name, kept in the `host_trigram` table.  Names are
+padded with two spaces in front and one behind before being split, so the
+leading and trailing trigrams also anchor prefixes and suffixes.
+
+A search term is turned into a glob pattern (`*term*`, or `term*` for terms
+too short to contain a trigram) unless it already is one, and the hosts with
+every trigram of the literal parts of the pattern are narrowed down to those
+matching the pattern itself, ranked with exact matches first and then
+prefix matches, shorter names first, all in one query.
+
+The index is kept current by a flush listener, so hosts created, renamed or
+deleted through the session are indexed without having to know about it,
+hosts inserted without the session are indexed with `index`.
+'''
+from . import db, settings
+from sqlalchemy import event, select, func, case, and_, bindparam, \
+    union_all, literal
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+import re
+
+PAD = " "
+WILDCARDS = re.compile(r"[*?]")
+
+trigrams = db.Table(
+    'host_trigram',
+    db.Column('trigram', db.String(3), primary_key=True),
+    db.Column('host_id', db.Integer, db.ForeignKey('host.id'),
+              primary_key=True),
+)
+
+
+def grams(text):
+    ''' grams
+    Returns the set of trigrams of a string.
+    '''
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def escape(text):
+    ''' escape
+    Escapes the characters that are special to LIKE.
+    '''
+    return re.sub(r"([%_\\])", r"\\\1", text)
+
+
+def name_grams(name):
+    ''' name_grams
+    Returns the trigrams a host name is indexed under.
+    '''
+    return grams(PAD * 2 + name.lower() + PAD)
+
+
+def pattern(term):
+    ''' pattern
+    Converts a search term into the trigrams every match has, the LIKE
+    pattern matches have to fit and the literal prefix they are ranked by.
+    '''
+    term = term.lower()
+    prefix = escape(WILDCARDS.split(term)[0])
+    if not WILDCARDS.search(term):
+        term = "*" + term + "*" if len(term) >= 3 else term + "*"
+
+    required = set()
+    for segment in WILDCARDS.split(PAD * 2 + term + PAD):
+        required |= grams(segment)
+
+    like = escape(term).replace("*", "%").replace("?", "_")
+    return required, like, prefix
+
+
+def index(session, hosts):
+    ''' index
+    Adds the trigrams of the (id, name) pairs of hosts to the index.
+    '''
+    rows = [{"trigram": gram, "host_id": host_id}
+            for (host_id, name) in hosts for gram in name_grams(name)]
+    if rows:
+        session.execute(trigrams.insert(), rows)
+
+
+def unindex(session, hosts):
+    ''' unindex
+    Removes the trigrams of the (id, name) pairs of hosts from the index,
+    by their whole key so only the primary key index is needed.
+    '''
+    c = trigrams.c
+    rows = [{"gram": gram, "id": host_id}
+            for (host_id, name) in hosts for gram in name_grams(name)]
+    if rows:
+        session.execute(trigrams.delete().where(and_(
+            c.trigram == bindparam("gram"), c.host_id == bindparam("id"))),
+            rows)
+
+
+def rebuild(session):
+    ''' rebuild
+    Regenerates the whole index from the host table, for databases created
+    before it existed.
+    '''
+    from .models import Host
+
+    session.execute(trigrams.delete())
+    index(session, session.execute(select([Host.id, Host.name])))
+
+
+def search(query, term, limit=None):
+    ''' search
+    Filters a query of hosts to the best `limit` (settings.SEARCH_LIMIT by
+    default) matches of the search term, in ranked order.
+    '''
+    from .models import Host
+
+    required, like, prefix = pattern(term)
+    name = func.lower(Host.name)
+    if required:
+        c = trigrams.c
+        counts = union_all(*[select([
+            literal(gram).label('trigram'),
+            select([func.count()]).where(c.trigram == gram).as_scalar()
+            .label('hosts')]) for gram in sorted(required)]).alias()
+        rarest = select([counts.c.trigram]).order_by(counts.c.hosts) \
+            .limit(1).as_scalar()
+        query = query.join(trigrams, and_(c.host_id == Host.id,
+                                          c.trigram == rarest))
+
+    rank = case([(name == term.lower(), 0),
+                 (name.like(prefix + "%", escape="\\"), 1)], else_=2)
+    return query.filter(name.like(like, escape="\\")).order_by(
+        rank, func.length(Host.name), Host.name).limit(
+        limit or settings.SEARCH_LIMIT)
+
+
+@event.listens_for(Session, 'before_flush')
+def drop_names(session, flush_context, instances):
+    ''' drop_names
+    Flush listener that drops the hosts deleted in the flush from the index,
+    before the hosts themselves so their foreign keys hold.
+    '''
+    from .models import Host
+
+    unindex(session, [(host.id, host.name) for host in session.deleted
+                      if isinstance(host, Host)])
+
+
+@event.listens_for(Session, 'after_flush')
+def track_names(session, flush_context):
+    ''' track_names
+    Flush listener that indexes the hosts created or renamed in the flush.
+    '''
+    from .models import Host
+
+    renamed = [(host, get_history(host, 'name')) for host in session.dirty
+               if isinstance(host, Host)]
+    renamed = [(host, history.deleted[0]) for (host, history) in renamed
+               if history.deleted]
+    unindex(session, [(host.id, name) for (host, name) in renamed])
+    index(session, [(host.id, host.name) for host in list(session.new) +
+                    [host for (host, _) in renamed] if isinstance(host, Host)])
@@ -0,0 +1,276 @@
+''' serializers
+Builds the listings and details of hosts, vlans and blocks straight from the
+rows of Core queries selecting only the columns they show, for the read
+endpoints that would otherwise load whole models and their relationships
+just to turn them into small dicts.  The output is identical to the
+`__simple__` and `__full__` of the models, which are still used for
+the models at hand (such as the ones just created).
+
+URLs are built by substituting into a template made with `url_for` once per
+request (see `url_builder`), rather than matching the URL map for each row.
+'''
+from . import models
+from . import db, settings, allocator
+from .utils import int2ip, version
+from flask import g, url_for
+from werkzeug.urls import url_quote
+from sqlalchemy import select, and_, case, func
+import re
+
+PLACEHOLDERS = ("__placeholder__", 987654321)  # for int converters too
+SAFE = re.compile(r"^[A-Za-z0-9_.\-]*$")  # never changed by url_quote
+
+
+def url_builder(endpoint, argument, **values):
+    ''' url_builder
+    Returns a function building the URL of an endpoint from the value of one
+    of its arguments (the others are fixed to `values`), the same URL as
+    `url_for` would.  Builders are kept for the rest of the request.
+    '''
+    key = (endpoint, argument, tuple(sorted(values.items())))
+    if not hasattr(g, 'url_builders'):
+        g.url_builders = {}
+    builders = g.url_builders
+    if key not in builders:
+        for placeholder in PLACEHOLDERS:
+            values[argument] = placeholder
+            try:
+                url = url_for(endpoint, **values)
+                break
+            except ValueError:  # not accepted by the converter
+                continue
+        prefix, suffix = url.rsplit(str(placeholder), 1)
+
+        def build(value):
+            if not isinstance(value, basestring):
+                value = unicode(value)
+            elif not SAFE.match(value):
+                value = url_quote(value)
+            return prefix + value + suffix
+        builders[key] = build
+    return builders[key]
+
+
+def batches(rows, size=None):
+    ''' batches
+    Groups the rows of an iterable into lists of up to `size` rows
+    (settings.WINDOW_SIZE by default).
+    '''
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= (size or settings.WINDOW_SIZE):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def host_vlans(host_ids):
+    ''' host_vlans
+    Returns the numbers of the vlans of each of the hosts, in the order their
+    IPs were allocated, each vlan once like the `vlans` relationship.
+    '''
+    Ip, Vlan = models.Ip.__table__, models.Vlan.__table__
+    vlans = {}
+    if host_ids:
+        for (host_id, number) in db.session.execute(
+                select([Ip.c.host_id, Vlan.c.number])
+                .where(Ip.c.vlan_id == Vlan.c.id)
+                .where(Ip.c.host_id.in_(host_ids)).order_by(Ip.c.id)):
+            numbers = vlans.setdefault(host_id, [])
+            if number not in numbers:
+                numbers.append(number)
+    return vlans
+
+
+def host_query():
+    ''' host_query
+    Returns a query of the (id, name) of the hosts, to be filtered and paged
+    like a query of the models.
+    '''
+    return db.session.query(models.Host.id, models.Host.name)
+
+
+def host_listing(rows):
+    ''' host_listing
+    Generates the simple listing of the hosts of (id, name) rows, looking up
+    the vlans of a window of hosts at a time.
+    '''
+    url = url_builder("host_info", "host_name")
+    for batch in batches(rows):
+        vlans = host_vlans([row.id for row in batch])
+        for (host_id, name) in batch:
+            yield {
+                "name": name,
+                "vlans": vlans.get(host_id, []),
+                "url": url(name),
+            }
+
+
+def host_rows(condition):
+    ''' host_rows
+    Returns the full listings of the hosts matching a condition on the host
+    table, keyed by host name.
+    '''
+    Host, Ip, Vlan = (model.__table__ for model in
+                      (models.Host, models.Ip, models.Vlan))
+    hosts = {}
+    for row in db.session.execute(
+            select([Host.c.name, Vlan.c.number, Ip.c.number.label('ip')])
+            .select_from(Host.outerjoin(Ip, Ip.c.host_id == Host.c.id)
+                         .outerjoin(Vlan, Ip.c.vlan_id == Vlan.c.id))
+            .where(condition).order_by(Ip.c.id)):
+        host = hosts.setdefault(row.name, {"name": row.name, "ips": {}})
+        if row.ip is not None:
+            ips = "ips" if version(row.ip) == 4 else "ips6"
+            host.setdefault(ips, {})[str(row.number)] = int2ip(row.ip)
+    return hosts
+
+
+def host_details(name=None, host_id=None):
+    ''' host_details
+    Returns the full listing of a host, found by name or id, or None if
+    there is no such host.
+    '''
+    Host = models.Host.__table__
+    hosts = host_rows(Host.c.name == name if host_id is None else
+                      Host.c.id == host_id)
+    return hosts.values()[0] if hosts else None
+
+
+def hosts_details(names):
+    ''' hosts_details
+    Returns the full listings of the hosts with the given names, keyed by
+    name, looking up a window of names at a time.
+    '''
+    Host = models.Host.__table__
+    hosts = {}
+    for batch in batches(set(names)):
+        hosts.update(host_rows(Host.c.name.in_(batch)))
+    return hosts
+
+
+def vlan_query():
+    ''' vlan_query
+    Returns a query of the columns a vlan is listed with.
+    '''
+    Vlan = models.Vlan
+    return db.session.query(Vlan.id, Vlan.name, Vlan.number, Vlan.cidr,
+                            Vlan.length, Vlan.cidr6, Vlan.length6)
+
+
+def ranges(listing, row):
+    ''' ranges
+    Adds the IPv4 range of a vlan row to its listing, and its IPv6 range if
+    it is dual-stack, like `Vlan.network` formats them.
+    '''
+    listing["range"] = "{}/{}".format(int2ip(row.cidr), row.length)
+    if row.cidr6 is not None:
+        listing["range6"] = "{}/{}".format(int2ip(row.cidr6), row.length6)
+    return listing
+
+
+def vlan_listing(rows):
+    ''' vlan_listing
+    Generates the simple listing of the vlans of `vlan_query` rows.
+    '''
+    url = url_builder("vlan_info", "vlan_name")
+    for row in rows:
+        yield ranges({
+            "name": row.name,
+            "number": row.number,
+            "url": url(row.name),
+        }, row)
+
+
+def block_listing(vlan_id, vlan_name):
+    ''' block_listing
+    Returns the simple listing of the blocks reserved on a vlan.
+    '''
+    Block = models.Block.__table__
+    url = url_builder("release_block", "block_id", vlan_name=vlan_name)
+    return [{
+        "id": row.id,
+        "name": row.name,
+        "start": int2ip(row.start),
+        "end": int2ip(row.start + row.size - 1),
+        "size": row.size,
+        "url": url(row.id),
+    } for row in db.session.execute(select([Block]).where(
+        Block.c.vlan_id == vlan_id).order_by(Block.c.id))]
+
+
+def vlan_details(number=None, name=None):
+    ''' vlan_details
+    Returns the full listing of a vlan, found by number or name, or None if
+    there is no such vlan.
+    '''
+    Host, Ip, Vlan = (model.__table__ for model in
+                      (models.Host, models.Ip, models.Vlan))
+    vlan = db.session.execute(select([Vlan]).where(
+        Vlan.c.number == number if number is not None else
+        Vlan.c.name == name)).first()
+    if vlan is None:
+        return None
+
+    hosts = db.session.execute(
+        select([Host.c.name]).where(and_(Ip.c.host_id == Host.c.id,
+                                         Ip.c.vlan_id == vlan.id))
+        .order_by(Ip.c.id))
+    names, seen = [], set()
+    for (host,) in hosts:
+        if host not in seen:  # hosts with more than one IP on the vlan
+            seen.add(host)
+            names.append(host)
+    return ranges({
+        "name": vlan.name,
+        "number": vlan.number,
+        "hosts": names,
+        "blocks": block_listing(vlan.id, vlan.name),
+    }, vlan)
+
+
+def vlan_stats(condition=None):
+    ''' vlan_stats
+    Generates the utilization of the IPv4 ranges of the vlans (all of them,
+    or the ones matching a condition on the vlan table) in the order they
+    were created, read from the allocated counts and free blocks kept by
+    `allocator` in one query.  Vlans whose index has not been built yet (see
+    `allocator.build`) count their IPs and reserved blocks instead, and the
+    largest run of free addresses is unknown (None).
+    '''
+    Vlan, Ip, Block, pools, blocks = (
+        models.Vlan.__table__, models.Ip.__table__, models.Block.__table__,
+        allocator.pools, allocator.free_blocks)
+    session = db.session()
+    ips = select([func.count(Ip.c.id)]).where(and_(
+        Ip.c.vlan_id == Vlan.c.id, allocator.family(Ip.c.number, 4)))
+    reserved = select([func.coalesce(func.sum(Block.c.size), 0)]).where(and_(
+        Block.c.vlan_id == Vlan.c.id, allocator.family(Block.c.start, 4)))
+    allocated = case([(pools.c.vlan_id.is_(None),
+                       ips.as_scalar() + reserved.as_scalar())],
+                     else_=pools.c.allocated)
+    largest = select([func.max(blocks.c.size)]).where(
+        allocator.indexed(blocks, Vlan.c.id, 4)).as_scalar()
+    columns = [Vlan.c.name, Vlan.c.number, Vlan.c.cidr, Vlan.c.length,
+               pools.c.vlan_id.isnot(None).label('indexed'),
+               allocated.label('allocated'), largest.label('largest')]
+    query = select(columns).select_from(Vlan.outerjoin(
+        pools, allocator.indexed(pools, Vlan.c.id, 4))).order_by(Vlan.c.id)
+    if condition is not None:
+        query = query.where(condition)
+
+    for row in session.execute(query):
+        first, last = allocator.bounds(row)
+        size = last - first + 1
+        yield {
+            "name": row.name,
+            "number": row.number,
+            "range": "{}/{}".format(int2ip(row.cidr), row.length),
+            "size": size,
+            "allocated": row.allocated,
+            "free": size - row.allocated,
+            "used": round(100.0 * row.allocated / size, 2),
+            "largest_free": (row.largest or 0) if row.indexed else None,
+        }
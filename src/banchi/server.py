@@ -0,0 +1,343 @@
+''' server
+Pre-forking HTTP server for production, run with `bin/banchi serve`.  The
+master process binds the listening socket and forks settings.SERVER_WORKERS
+workers that accept from it, each handling up to settings.SERVER_THREADS
+requests at once in threads of a Werkzeug server.  Connections are kept
+alive between requests (streamed responses are sent chunked so they do not
+close them), idle ones for settings.SERVER_KEEPALIVE seconds.
+
+Workers warm up before accepting, opening their own database connections
+(none are shared with the master) and building the URL map, so the first
+requests are not slowed down.  Workers that die are replaced.  The master
+handles these signals:
+
+    SIGTERM, SIGINT: stop accepting, finish the requests in progress and exit
+    SIGHUP: fork a new set of workers and gracefully stop the old ones
+
+Workers are given settings.SERVER_GRACEFUL_TIMEOUT seconds to finish before
+they are killed.
+'''
+from . import db, settings, metrics
+from SocketServer import BaseServer, ThreadingMixIn
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from threading import Condition, local
+import errno
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+NO_BODY = ('204', '304')  # statuses that never have a body
+
+
+def chunked(app):
+    ''' chunked
+    WSGI middleware that sends the responses without a length with chunked
+    transfer encoding to HTTP/1.1 clients, so the connection can be kept.
+    '''
+    def wrapper(environ, start_response):
+        state = {}
+
+        def start(status, headers, exc_info=None):
+            keys = set(key.lower() for (key, _) in headers)
+            state['chunked'] = \
+                environ.get('SERVER_PROTOCOL') == 'HTTP/1.1' and \
+                environ['REQUEST_METHOD'] != 'HEAD' and \
+                'content-length' not in keys and \
+                'transfer-encoding' not in keys and \
+                not status.startswith('1') and status[:3] not in NO_BODY
+            if state['chunked']:
+                headers = headers + [('Transfer-Encoding', 'chunked')]
+            return start_response(status, headers, exc_info)
+
+        body = app(environ, start)
+        if not state.get('chunked'):
+            return body
+        return encode_chunks(body)
+    return wrapper
+
+
+def encode_chunks(body):
+    try:
+        for data in body:
+            if data:
+                yield "{:x}\r\n{}\r\n".format(len(data), data)
+        yield "0\r\n\r\n"
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+class Handler(WSGIRequestHandler):
+    ''' Handler
+    Request handler speaking HTTP/1.1, keeping connections open after
+    responses with a length or chunked encoding.
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.timeout = settings.SERVER_KEEPALIVE
+        WSGIRequestHandler.setup(self)
+
+    def handle_one_request(self):
+        self.chunked = False
+        WSGIRequestHandler.handle_one_request(self)
+        if self.server.stopping:
+            self.close_connection = 1
+
+    def make_environ(self):
+        environ = WSGIRequestHandler.make_environ(self)
+        environ['banchi.detach'] = self.server.detach
+        return environ
+
+    def send_header(self, key, value):
+        if key.lower() == 'transfer-encoding':
+            self.chunked = True
+        elif key.lower() == 'connection' and self.chunked:
+            self.close_connection = 0  # set by Werkzeug for the lack of length
+            return
+        WSGIRequestHandler.send_header(self, key, value)
+
+
+class Worker(ThreadingMixIn, BaseWSGIServer):
+    ''' Worker
+    Threaded WSGI server accepting from a listening socket it was given
+    rather than one of its own, with a limit on the requests in progress.
+    '''
+    multithread = True
+    multiprocess = True
+    daemon_threads = True
+
+    def __init__(self, sock, app, threads=None):
+        BaseServer.__init__(self, sock.getsockname()[:2], Handler)
+        self.socket = sock
+        self.app = chunked(app)
+        self.passthrough_errors = False
+        self.shutdown_signal = False
+        self.ssl_context = None
+        self.stopping = False
+        self.parent = None  # pid of the master, stops if it goes away
+        self.threads = threads or settings.SERVER_THREADS
+        self.active = 0
+        self.idle = Condition()
+        self.local = local()
+
+    def process_request(self, request, client_address):
+        with self.idle:
+            while self.active >= self.threads:
+                self.idle.wait()
+            self.active += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request,
+                                                  client_address)
+        finally:
+            if not getattr(self.local, 'detached', False):
+                self.detach()
+            self.local.detached = False
+
+    def detach(self):
+        ''' Worker::detach
+        Stops counting the request thread it is called from against the
+        limit, for long lived responses (such as the change feed) that mostly
+        wait rather than work.
+        '''
+        if getattr(self.local, 'detached', False):
+            return
+        self.local.detached = True
+        with self.idle:
+            self.active -= 1
+            self.idle.notify_all()
+
+    def handle_error(self, request, client_address):
+        if sys.exc_info()[0] in (socket.error, socket.timeout):
+            return  # clients going away are not errors
+        BaseWSGIServer.handle_error(self, request, client_address)
+
+    def run(self, timeout=None):
+        ''' Worker::run
+        Accepts connections until `stop` is called and then waits up to
+        `timeout` seconds (settings.SERVER_GRACEFUL_TIMEOUT by default) for
+        the requests in progress.
+        '''
+        while not self.stopping:
+            if self.ready(1.0):
+                self._handle_request_noblock()
+            if self.parent and os.getppid() != self.parent:
+                self.stop()
+        self.drain(settings.SERVER_GRACEFUL_TIMEOUT
+                   if timeout is None else timeout)
+
+    def ready(self, timeout):
+        try:
+            return bool(select.select([self.socket], [], [], timeout)[0])
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def drain(self, timeout):
+        deadline = time.time() + timeout
+        with self.idle:
+            while self.active and time.time() < deadline:
+                self.idle.wait(min(1.0, deadline - time.time()))
+        return not self.active
+
+
+def listen(host, port, backlog=None):
+    ''' listen
+    Binds the listening socket shared by the workers.  It does not block, as
+    every worker waits on it and only one of them gets each connection.
+    '''
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog or settings.SERVER_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+def warm_up(app):
+    ''' warm_up
+    Prepares a freshly forked worker, replacing any database connections
+    inherited from the master with one of its own and compiling the URL map.
+    '''
+    if 'sqlalchemy' in app.extensions:
+        with app.app_context():
+            engine = db.get_engine(app)
+            engine.dispose()
+            engine.connect().close()
+
+    adapter = app.url_map.bind("localhost")
+    try:
+        adapter.match("/")
+    except Exception:
+        pass
+
+
+class Master(object):
+    ''' Master
+    Keeps `workers` worker processes serving `app` on a listening socket,
+    replacing the ones that exit and restarting or stopping all of them on
+    signals.
+    '''
+    def __init__(self, app, sock, workers=None):
+        self.app = app
+        self.socket = sock
+        self.count = workers or settings.SERVER_WORKERS
+        self.workers = {}  # pid -> generation
+        self.retiring = {}  # pid -> time by which it has to have exited
+        self.generation = 0
+        self.stopping = False
+
+    def run(self):
+        ''' Master::run
+        Runs the workers until told to stop, returning once they all exited.
+        '''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.restart)
+        shared = metrics.enabled and not settings.METRICS_DIR
+        if shared:  # where the workers leave their metrics for each other
+            settings.METRICS_DIR = tempfile.mkdtemp(prefix="banchi-metrics-")
+
+        while not self.stopping:
+            self.reap()
+            current = [pid for (pid, generation) in self.workers.items()
+                       if generation == self.generation]
+            for _ in range(self.count - len(current)):
+                self.spawn()
+            if len(current) >= self.count:
+                self.retire([pid for (pid, generation) in self.workers.items()
+                             if generation != self.generation])
+            self.kill_late()
+            time.sleep(0.1)
+
+        self.retire(self.workers.keys())
+        while self.workers:
+            self.reap()
+            self.kill_late()
+            time.sleep(0.1)
+        self.socket.close()
+        if shared:
+            shutil.rmtree(settings.METRICS_DIR, ignore_errors=True)
+            settings.METRICS_DIR = None
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def restart(self, *args):
+        self.generation += 1
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return pid
+
+        status = 1
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_IGN)
+            worker = Worker(self.socket, self.app)
+            worker.parent = os.getppid()
+            warm_up(self.app)
+            signal.signal(signal.SIGTERM, worker.stop)
+            worker.run()
+            metrics.dump(force=True)
+            status = 0
+        finally:
+            os._exit(status)
+
+    def retire(self, pids):
+        deadline = time.time() + settings.SERVER_GRACEFUL_TIMEOUT
+        for pid in pids:
+            if pid not in self.retiring:
+                self.retiring[pid] = deadline
+                self.signal(pid, signal.SIGTERM)
+
+    def kill_late(self):
+        now = time.time()
+        for (pid, deadline) in self.retiring.items():
+            if deadline < now:
+                self.signal(pid, signal.SIGKILL)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+            self.retiring.pop(pid, None)
+
+
+def serve(app, host=None, port=None):
+    ''' serve
+    Serves the app with pre-forked workers until stopped.
+    '''
+    sock = listen(host or settings.HOST, port or settings.PORT)
+    Master(app, sock).run()
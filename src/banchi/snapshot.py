@@ -0,0 +1,389 @@
+''' snapshot
+Exports and imports the whole allocation database as lines of JSON, one
+record per line, so it can be backed up, migrated or seeded without going
+through the API one host at a time:
+
+    ["snapshot", 1]
+    ["vlan", <number>, <name>, "<cidr>/<length>"(, "<IPv6 prefix>/<length>")]
+    ["block", <vlan number>, <name>, "<start ip>", <size>]
+    ["host", <name>]
+    ["ip", <host name>, <vlan number>, "<ip>"]
+
+Records refer to vlans and hosts defined on earlier lines (or already in the
+database), the IPv6 prefix is only there for dual-stack vlans.  Both
+directions work a window of rows at a time, exports page
+through the tables in id order and imports buffer settings.SNAPSHOT_BATCH
+records before writing them with bulk inserts, so neither holds the whole
+database in memory: imports look up the hosts of each batch with one query
+and only keep the vlans, and the cache tags of what they changed until there
+are more than the cache holds.  Imported IPs keep their addresses rather
+than being allocated, and the free space index of the vlans they land on is
+dropped to be rebuilt when next used.
+'''
+from . import models
+from . import app, db, settings, allocator, changes, search
+from .utils import ip2int, int2ip, cidr2mask, isip, version, ipv6_prefix
+from .decorators import datatype, write_operation, STREAM_CHUNK
+from flask import request, Response, stream_with_context
+from sqlalchemy import select, and_
+import httplib
+import json
+import sys
+
+VERSION = 1
+BASE_PATH = '/snapshot/'
+
+
+def rows(session, statement, column):
+    ''' rows
+    Generates the rows of a Core select ordered by the (unique and indexed)
+    `column`, fetching them settings.WINDOW_SIZE at a time.
+    '''
+    last = None
+    while True:
+        window = statement if last is None else statement.where(column > last)
+        batch = session.execute(window.order_by(column).limit(
+            settings.WINDOW_SIZE)).fetchall()
+        for row in batch:
+            yield row
+
+        if len(batch) < settings.WINDOW_SIZE:
+            return
+        last = batch[-1][column]
+
+
+def dump(session):
+    ''' dump
+    Generates the records of a snapshot of the database.
+    '''
+    Vlan, Block, Host, Ip = (model.__table__ for model in
+                             (models.Vlan, models.Block, models.Host,
+                              models.Ip))
+    yield ["snapshot", VERSION]
+
+    for row in rows(session, select([Vlan]), Vlan.c.id):
+        record = ["vlan", row.number, row.name,
+                  "{}/{}".format(int2ip(row.cidr), row.length)]
+        if row.cidr6 is not None:
+            record.append("{}/{}".format(int2ip(row.cidr6), row.length6))
+        yield record
+    for row in rows(session, select(
+            [Block.c.id, Vlan.c.number, Block.c.name, Block.c.start,
+             Block.c.size]).where(Block.c.vlan_id == Vlan.c.id), Block.c.id):
+        yield ["block", row.number, row.name, int2ip(row.start), row.size]
+    for row in rows(session, select([Host]), Host.c.id):
+        yield ["host", row.name]
+    for row in rows(session, select(
+            [Ip.c.id, Host.c.name, Vlan.c.number, Ip.c.number.label('ip')])
+            .where(Ip.c.host_id == Host.c.id)
+            .where(Ip.c.vlan_id == Vlan.c.id), Ip.c.id):
+        yield ["ip", row.name, row.number, int2ip(row.ip)]
+
+
+def encode(records):
+    ''' encode
+    Generates the lines of the records in chunks of about STREAM_CHUNK bytes.
+    '''
+    chunk, length = [], 0
+    for record in records:
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        chunk.append(line)
+        length += len(line)
+        if length >= STREAM_CHUNK:
+            yield "".join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+class Loader(object):
+    ''' Loader
+    Imports snapshot records into the session, buffering them by kind and
+    writing each batch with one bulk insert per table.  Malformed records and
+    records that conflict with the data raise a ValueError naming their line.
+    '''
+    def __init__(self, session):
+        self.session = session
+        self.vlans = {}  # number -> (id, name, cidr, length, cidr6, length6)
+        for row in session.execute(select([models.Vlan.__table__])):
+            self.vlans[row.number] = (row.id, row.name, row.cidr, row.length,
+                                      row.cidr6, row.length6)
+        self.buffered = 0
+        self.pending = dict((kind, []) for kind in self.KINDS)
+        self.counts = dict.fromkeys(self.KINDS, 0)
+        self.changed = set(['host', 'vlan'])  # None once there are too many
+        self.events = []  # change log events of the batch
+        self.touched = set()  # ids of the vlans that got IPs or blocks
+
+    KINDS = ["vlan", "block", "host", "ip"]
+    FIELDS = {
+        "snapshot": [int],
+        "vlan": [int, basestring, basestring, (basestring, type(None))],
+        "block": [int, (basestring, type(None)), basestring, int],
+        "host": [basestring],
+        "ip": [basestring, int, basestring],
+    }
+    OPTIONAL = {"vlan": 1}  # trailing fields that can be left out
+    EVERYTHING = ['host', 'vlan', 'host:*', 'vlan:*', 'ip:*']  # see `cached`
+
+    def load(self, lines):
+        ''' Loader::load
+        Imports every line and returns the number of records of each kind.
+        '''
+        for (line, text) in enumerate(lines, 1):
+            if text.strip():
+                self.add(line, text)
+        self.flush()
+        changes.compact(self.session)  # once, rather than for every batch
+        if self.touched:
+            allocator.drop(self.session, list(self.touched))
+        self.session.info.setdefault('changed', set()).update(
+            self.changed or self.EVERYTHING)
+        return self.counts
+
+    def add(self, line, text):
+        try:
+            record = json.loads(text)
+        except ValueError:
+            raise ValueError("line {}: not JSON".format(line))
+        fields = self.FIELDS.get(record[0]) if \
+            isinstance(record, list) and record and \
+            isinstance(record[0], basestring) else None
+        if fields is not None and len(fields) - self.OPTIONAL.get(
+                record[0], 0) < len(record) <= len(fields):
+            record = record + [None] * (len(fields) + 1 - len(record))
+        if fields is None or len(record) != len(fields) + 1 or not all(
+                isinstance(value, kind) for (value, kind) in
+                zip(record[1:], fields)):
+            raise ValueError("line {}: malformed record".format(line))
+
+        if record[0] == "snapshot":
+            if record[1] != VERSION:
+                raise ValueError("line {}: unsupported version".format(line))
+            return
+        self.pending[record[0]].append((line, record[1:]))
+        self.buffered += 1
+        if self.buffered >= settings.SNAPSHOT_BATCH:
+            self.flush()
+
+    def flush(self):
+        ''' Loader::flush
+        Writes the buffered records, kinds that others refer to first, and
+        appends their events to the change log.
+        '''
+        for kind in self.KINDS:
+            records, self.pending[kind] = self.pending[kind], []
+            if records:
+                getattr(self, "insert_" + kind)(records)
+                self.counts[kind] += len(records)
+        if self.events:
+            changes.append(self.session, self.events)
+            self.events = []
+        self.buffered = 0
+
+    def tag(self, *tags):
+        ''' Loader::tag
+        Records the cache tags of imported records, falling back to every
+        kind of data (EVERYTHING) once there are more tags than the cache
+        holds entries.
+        '''
+        if self.changed is not None:
+            self.changed.update(tags)
+            if len(self.changed) > settings.CACHE_SIZE:
+                self.changed = None
+
+    def host_ids(self, names):
+        ''' Loader::host_ids
+        Returns the ids of the existing hosts among `names`, keyed by name.
+        '''
+        table = models.Host.__table__
+        return dict((row.name, row.id) for row in self.session.execute(
+            select([table.c.id, table.c.name]).where(
+                table.c.name.in_(names))))
+
+    def vlan(self, line, number):
+        if number not in self.vlans:
+            raise ValueError("line {}: unknown vlan {}".format(line, number))
+        return self.vlans[number]
+
+    def address(self, line, vlan, ip):
+        ''' Loader::address
+        Converts an IP on a vlan to its number, checking it is on the vlan.
+        '''
+        number = ip2int(ip)
+        if number is not None and version(number) == 6:
+            cidr, length, width = vlan[4], vlan[5], 128
+        else:
+            cidr, length, width = vlan[2], vlan[3], 32
+        if number is None or cidr is None or \
+                number & (~0 << (width - length)) != cidr:
+            raise ValueError("line {}: {} is not on the vlan".format(line, ip))
+        return number
+
+    def insert_vlan(self, records):
+        table, rows = models.Vlan.__table__, []
+        for line, (number, name, mask, mask6) in records:
+            if '/' not in mask or not isip(mask.split('/')[0]):
+                raise ValueError("line {}: malformed range".format(line))
+            cidr, length = cidr2mask(mask), int(mask.split('/')[1])
+            prefix6 = (None, None) if mask6 is None else ipv6_prefix(mask6)
+            if prefix6 is None:
+                raise ValueError("line {}: malformed range".format(line))
+            if number in self.vlans:
+                if self.vlans[number][1:] != (name, cidr, length) + prefix6:
+                    raise ValueError("line {}: vlan {} conflicts".format(
+                        line, number))
+                continue
+            if name in models.Vlan.RESERVED or \
+                    name in set(vlan[1] for vlan in self.vlans.values()):
+                raise ValueError("line {}: vlan {} conflicts".format(
+                    line, name))
+            self.vlans[number] = (None, name, cidr, length) + prefix6
+            rows.append({"number": number, "name": name, "cidr": cidr,
+                         "length": length, "cidr6": prefix6[0],
+                         "length6": prefix6[1]})
+            self.tag('vlan:{}'.format(number), 'vlan:' + name)
+            data = {"number": number, "name": name,
+                    "range": "{}/{}".format(int2ip(cidr), length)}
+            if prefix6[0] is not None:
+                data["range6"] = "{}/{}".format(int2ip(prefix6[0]),
+                                                prefix6[1])
+            self.events.append(changes.entry("vlan", "create", number,
+                                             **data))
+
+        if rows:
+            self.session.execute(table.insert(), rows)
+            for row in self.session.execute(select([table]).where(
+                    table.c.number.in_([r["number"] for r in rows]))):
+                self.vlans[row.number] = (row.id, row.name, row.cidr,
+                                          row.length, row.cidr6, row.length6)
+
+    def insert_block(self, records):
+        rows = []
+        for line, (number, name, start, count) in records:
+            vlan = self.vlan(line, number)
+            rows.append({"vlan_id": vlan[0], "name": name, "size": count,
+                         "start": self.address(line, vlan, start)})
+            self.touched.add(vlan[0])
+            self.tag('vlan:{}'.format(number), 'vlan:' + vlan[1])
+        self.session.execute(models.Block.__table__.insert(), rows)
+
+    def insert_host(self, records):
+        table = models.Host.__table__
+        existing = self.host_ids(set(name for _, (name,) in records))
+        names = []  # in the order of the records
+        for _, (name,) in records:
+            if name not in existing:
+                existing[name] = None
+                names.append(name)
+        if names:
+            self.session.execute(table.insert(), [
+                {"name": name} for name in names])
+            ids = self.host_ids(names)  # by name, others may insert too
+            created = [(ids[name], name) for name in names]
+            search.index(self.session, created)
+            self.events.extend(changes.entry("host", "create", name,
+                                             name=name)
+                               for (_, name) in created)
+        self.tag(*('host:' + name for _, (name,) in records))
+
+    def taken(self, rows):
+        ''' Loader::taken
+        Returns the (vlan id, number) of the allocated IPs in the range of
+        addresses of `rows` on each of their vlans.
+        '''
+        Ip, ranges = models.Ip.__table__, {}
+        for row in rows:
+            low, high = ranges.get(row["vlan_id"], (row["number"],) * 2)
+            ranges[row["vlan_id"]] = (min(low, row["number"]),
+                                      max(high, row["number"]))
+
+        return set((vlan_id, number) for (vlan_id, (low, high)) in
+                   ranges.items() for (number,) in self.session.execute(
+                       select([Ip.c.number]).where(and_(
+                           Ip.c.vlan_id == vlan_id,
+                           Ip.c.number.between(low, high)))))
+
+    def insert_ip(self, records):
+        rows, claimed = [], set()
+        hosts = self.host_ids(set(host for _, (host, _, _) in records))
+        for line, (host, number, ip) in records:
+            vlan = self.vlan(line, number)
+            if host not in hosts:
+                raise ValueError("line {}: unknown host {}".format(line, host))
+            row = {"host_id": hosts[host], "vlan_id": vlan[0],
+                   "number": self.address(line, vlan, ip), "line": line}
+            if (row["vlan_id"], row["number"]) in claimed:
+                raise ValueError("line {}: {} is taken".format(line, ip))
+            claimed.add((row["vlan_id"], row["number"]))
+            rows.append(row)
+            self.touched.add(vlan[0])
+            ip = int2ip(row["number"])
+            self.tag('host:' + host, 'ip:' + ip, 'vlan:{}'.format(number),
+                     'vlan:' + vlan[1])
+            self.events.append(changes.entry("ip", "create", ip, ip=ip,
+                                             host=host, vlan=number))
+
+        taken = self.taken(rows)
+        for row in rows:
+            line = row.pop("line")
+            if (row["vlan_id"], row["number"]) in taken:
+                raise ValueError("line {}: {} is taken".format(
+                    line, int2ip(row["number"])))
+        self.session.execute(models.Ip.__table__.insert(), rows)
+
+
+@app.endpoint(BASE_PATH)
+def export():
+    ''' export - GET /snapshot
+    Streams a snapshot of the whole database, one JSON record per line.
+    '''
+    return Response(stream_with_context(encode(dump(db.session))),
+                    mimetype='application/x-ndjson')
+
+
+@app.post(BASE_PATH)
+@datatype
+@write_operation(retries=0)
+def restore():
+    ''' restore - POST /snapshot
+        POST: <snapshot lines>
+    Imports a snapshot into the database, adding to what is already there.
+    Nothing is imported if any of the records is malformed or conflicts with
+    the existing data (BAD_REQUEST), or with a concurrent write (CONFLICT).
+    Returns the number of records of each kind that were imported.
+    '''
+    try:
+        counts = Loader(db.session).load(request.stream)
+    except ValueError:
+        db.session.rollback()
+        return httplib.BAD_REQUEST
+
+    return counts, httplib.CREATED
+
+
+def command(name, path=None):
+    ''' command
+    Runs the `export` or `import` command of bin/banchi with a file (stdout
+    or stdin by default), must be run inside of an app context.
+    '''
+    if name == "export":
+        out = open(path, "w") if path else sys.stdout
+        for chunk in encode(dump(db.session)):
+            out.write(chunk)
+        out.close()
+        return 0
+
+    try:
+        counts = Loader(db.session).load(open(path) if path else sys.stdin)
+    except ValueError as e:
+        db.session.rollback()
+        sys.stderr.write("import failed, {}\n".format(e))
+        return 1
+
+    db.session.flush()
+    changes.bump(db.session)
+    db.session.commit()
+    sys.stderr.write("imported {}\n".format(", ".join(
+        "{} {}s".format(counts[kind], kind) for kind in Loader.KINDS)))
+    return 0
@@ -1,16 +1,38 @@
 import re
+import socket
+import struct
 
 ip_regex = re.compile(r"^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}$")
+IPV6_START = 1 << 32  # IPv6 addresses below it (::/96) are not supported
 
 
 def ip2int(ip):
+    if ':' in ip:
+        return ip6_int(ip)
     if not isip(ip):
         return None
     octs = map(int, ip.split('.'))
     return reduce(lambda i, o: (i << 8) + o, octs)
 
 
+def ip6_int(ip):
+    ''' ip6_int
+    Converts an IPv6 address into its 128 bit number, returning None if it is
+    malformed or in ::/96, whose numbers are the ones of IPv4 addresses.
+    '''
+    try:
+        high, low = struct.unpack('!QQ', socket.inet_pton(
+            socket.AF_INET6, ip.encode('ascii')))
+    except (socket.error, UnicodeError, ValueError):
+        return None
+    number = (high << 64) | low
+    return number if number >= IPV6_START else None
+
+
 def int2ip(i):
+    if i >= IPV6_START:
+        return socket.inet_ntop(socket.AF_INET6, struct.pack(
+            '!QQ', i >> 64, i & ((1 << 64) - 1)))
     return '.'.join(map(str, [
         i >> 24,
         (i >> 16) & 255,
@@ -20,13 +42,67 @@ def int2ip(i):
 
 
 def isip(i):
+    if ':' in i:
+        return ip6_int(i) is not None
     return bool(ip_regex.match(i))
 
 
+def version(number):
+    ''' version
+    Returns the IP version (4 or 6) of an address number.
+    '''
+    return 4 if number < IPV6_START else 6
+
+
+def width(ip):
+    ''' width
+    Returns the number of bits of the addresses of the version of an IP.
+    '''
+    return 128 if ':' in ip else 32
+
+
 def cidr2mask(cidr):
     ip, mask_length = cidr.split("/")
 
     i = ip2int(ip)
-    mask = (~ 0) << (32 - int(mask_length))
+    mask = (~ 0) << (width(ip) - int(mask_length))
 
     return i & mask
+
+
+def ipv6_prefix(mask):
+    ''' ipv6_prefix
+    Converts an IPv6 prefix ("2001:db8::/64") into its (cidr, length), or
+    returns None if it is malformed or overlaps the ::/96 IPv4 numbers.
+    '''
+    ip, _, length = mask.partition("/")
+    if ':' not in ip or not isip(ip) or not length.isdigit() or \
+            int(length) > 128:
+        return None
+    cidr = cidr2mask(mask)
+    return (cidr, int(length)) if cidr >= IPV6_START else None
+
+
+def parse_range(text):
+    ''' parse_range
+    Converts a CIDR ("10.0.0.0/20", "2001:db8::/64") or an inclusive range
+    of IPs ("10.0.0.10-10.0.0.20") into the numbers of its first and last
+    IPs, returning None if it is malformed.
+    '''
+    if "/" in text:
+        ip, length = text.split("/", 1)
+        if not length.isdigit() or int(length) > width(ip):
+            return None
+        first, last = ip, ip
+    else:
+        first, dash, last = text.partition("-")
+        last, length = last if dash else first, width(first)
+
+    if width(first) != width(last) or not all(
+            isip(ip) and (':' in ip or all(int(o) < 256 for o in
+                                           ip.split(".")))
+            for ip in (first, last)):
+        return None
+    size = 1 << (width(first) - int(length))
+    first, last = ip2int(first) & ~(size - 1), ip2int(last) | (size - 1)
+    return (first, last) if first <= last else None
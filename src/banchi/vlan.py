@@ -1,25 +1,83 @@
 from . import models
 from . import app, db
-from .utils import cidr2mask
-from .decorators import datatype, write_operation
+from . import errors, serializers
+from .utils import cidr2mask, ipv6_prefix
+from .decorators import datatype, write_operation, paginate, keyset
+from .cache import cached
 from flask import request
 import httplib
 
 BASE_PATH = '/vlan/'
 
 
+def find_vlan(vlan_id=None, vlan_name=None):
+    ''' find_vlan
+    Looks up a vlan by either its number or its name.
+    '''
+    if vlan_id:
+        return models.Vlan.query.filter(models.Vlan.number == vlan_id).first()
+    elif vlan_name:
+        return models.Vlan.query.filter(models.Vlan.name == vlan_name).first()
+    return None
+
+
+def vlan_tags(args):
+    ''' vlan_tags
+    Returns the cache tags of the vlan a request is for.
+    '''
+    return ['vlan:{}'.format(args.get('vlan_id') or args.get('vlan_name'))]
+
+
 @app.endpoint(BASE_PATH)
-@datatype
-def vlans():
+@cached(lambda args: ['vlan'])
+@paginate
+@datatype(depends=['vlan'])
+def vlans(cursor=None, per_page=None):
     ''' vlans - GET /vlan
-    Returns an array of all the vlans
+        GET: cursor=<cursor> (optional)
+             per_page=<page size> (optional)
+    Returns a page of the vlans in the order they were created, the next
+    page is linked in the `Link` header.
+    '''
+    return serializers.vlan_listing(keyset(
+        serializers.vlan_query(), models.Vlan.id, cursor, per_page))
+
+
+@app.endpoint(BASE_PATH + "stats/")
+@cached(lambda args: ['vlan'])
+@datatype(depends=['vlan'])
+def vlan_stats():
+    ''' vlan_stats - GET /vlan/stats
+    Returns the utilization of the IPv4 range of every vlan: the number of
+    addresses it can hand out (`size`), how many of them are allocated to
+    IPs or reserved blocks, how many are free, the percentage used and the
+    size of the largest run of free addresses.  The IPv6 prefixes of
+    dual-stack vlans are not counted, a /64 never fills up.
     '''
-    return [vlan.__simple__() for vlan in models.Vlan.query.all()]
+    return serializers.vlan_stats()
+
+
+@app.get(BASE_PATH + "<int:vlan_id>/stats/")
+@app.get(BASE_PATH + "<vlan_name>/stats/")
+@cached(vlan_tags)
+@datatype(depends=['vlan'])
+def vlan_usage(vlan_id=None, vlan_name=None):
+    ''' vlan_usage - GET /vlan/<vlan_id>/stats
+        vlan_usage - GET /vlan/<vlan_name>/stats
+    Returns the utilization of the IPv4 range of the vlan, as listed by
+    vlan_stats.
+    '''
+    Vlan = models.Vlan.__table__
+    condition = Vlan.c.number == vlan_id if vlan_id else \
+        Vlan.c.name == vlan_name
+    stats = list(serializers.vlan_stats(condition))
+    return stats[0] if stats else httplib.NOT_FOUND
 
 
 @app.get(BASE_PATH + "<int:vlan_id>/")
 @app.get(BASE_PATH + "<vlan_name>/")
-@datatype
+@cached(vlan_tags)
+@datatype(depends=['vlan'])
 def vlan_info(vlan_id=None, vlan_name=None):
     ''' vlan_info - GET /vlan/<vlan id>
         vlan_info - GET /vlan/<vlan_name>
@@ -27,22 +85,39 @@ def vlan_info(vlan_id=None, vlan_name=None):
     Returns a detailed listing of the specified vlan
     '''
     if vlan_id:
-        return models.Vlan.query.filter(
-            models.Vlan.number == vlan_id).first().__full__()
+        vlan = serializers.vlan_details(number=vlan_id)
     elif vlan_name:
-        return models.Vlan.query.filter(
-            models.Vlan.name == vlan_name).first().__full__()
+        vlan = serializers.vlan_details(name=vlan_name)
     else:
         return httplib.BAD_REQUEST
 
+    return vlan or httplib.NOT_FOUND
+
 
 @app.post(BASE_PATH)
 @datatype
 @write_operation
 def create_vlan():
+    ''' create_vlan - POST /vlan
+        POST: number=<vlan number>
+              name=<vlan name>
+              mask=<IPv4 cidr>
+              mask6=<IPv6 prefix> (optional)
+    Creates a vlan over the IPv4 range, dual-stacked if given an IPv6 prefix
+    as well (a malformed prefix is a BAD_REQUEST), and returns its simple
+    listing.  If the number or name is taken, a CONFLICT is returned, names
+    of the routes under /vlan/ (such as "stats") are a BAD_REQUEST.
+    '''
     number = int(request.form['number'], 10)
     name = request.form['name']
     mask = request.form['mask']
+    if name in models.Vlan.RESERVED:
+        return httplib.BAD_REQUEST
+    prefix6 = (None, None)
+    if request.form.get('mask6'):
+        prefix6 = ipv6_prefix(request.form['mask6'])
+        if prefix6 is None:
+            return httplib.BAD_REQUEST
 
     if models.Vlan.query.filter(models.Vlan.number == number).count() or \
             models.Vlan.query.filter(models.Vlan.name == name).count():
@@ -50,7 +125,7 @@ def create_vlan():
 
     vlan = models.Vlan(
         name=name, number=number, cidr=cidr2mask(mask),
-        length=mask.split("/")[1]
+        length=int(mask.split("/")[1]), cidr6=prefix6[0], length6=prefix6[1]
     )
 
     db.session.add(vlan)
@@ -66,14 +141,83 @@ def delete_vlan(vlan_id=None, vlan_name=None):
         delete_vlan - DELETE /vlan/<vlan_name>
     Removes the vlan and associated IPs
     '''
-    vlan = None
-    if vlan_id:
-        vlan = models.Vlan.query.filter(models.Vlan.number == vlan_id).first()
-    elif vlan_name:
-        vlan = models.Vlan.query.filter(models.Vlan.name == vlan_name).first()
-
+    vlan = find_vlan(vlan_id, vlan_name)
     if not vlan:
         return httplib.NOT_FOUND
 
     db.session.delete(vlan)
     return httplib.ACCEPTED
+
+
+@app.get(BASE_PATH + "<int:vlan_id>/block/")
+@app.get(BASE_PATH + "<vlan_name>/block/")
+@cached(vlan_tags)
+@datatype(depends=['vlan'])
+def blocks(vlan_id=None, vlan_name=None):
+    ''' blocks - GET /vlan/<vlan_id>/block
+        blocks - GET /vlan/<vlan_name>/block
+    Returns the contiguous blocks of addresses reserved on the vlan.
+    '''
+    vlan = find_vlan(vlan_id, vlan_name)
+    if not vlan:
+        return httplib.NOT_FOUND
+
+    return serializers.block_listing(vlan.id, vlan.name)
+
+
+@app.post(BASE_PATH + "<int:vlan_id>/block/")
+@app.post(BASE_PATH + "<vlan_name>/block/")
+@datatype
+@write_operation
+def reserve_block(vlan_id=None, vlan_name=None):
+    ''' reserve_block - POST /vlan/<vlan_id>/block
+        reserve_block - POST /vlan/<vlan_name>/block
+        POST: size=<address count>
+              align=<boundary> (optional)
+              name=<block name> (optional)
+    Reserves a contiguous block of addresses on the vlan, starting on a
+    multiple of `align` if given, and returns it.  If the vlan has no room
+    for the block a PRECONDITION_FAILED is returned.
+    '''
+    vlan = find_vlan(vlan_id, vlan_name)
+    if not vlan:
+        return httplib.NOT_FOUND
+
+    try:
+        size = int(request.form['size'])
+        align = int(request.form.get('align', 1))
+    except (KeyError, ValueError):
+        return httplib.BAD_REQUEST
+    if size < 1 or align < 1:
+        return httplib.BAD_REQUEST
+
+    try:
+        block = vlan.reserve(size, align, request.form.get('name'))
+    except errors.FullVlanException:
+        return httplib.PRECONDITION_FAILED
+
+    db.session.add(block)
+    db.session.flush()
+    return block.__simple__(), httplib.CREATED
+
+
+@app.route(BASE_PATH + "<int:vlan_id>/block/<int:block_id>/",
+           methods=["DELETE"])
+@app.route(BASE_PATH + "<vlan_name>/block/<int:block_id>/",
+           methods=["DELETE"])
+@datatype
+@write_operation
+def release_block(block_id, vlan_id=None, vlan_name=None):
+    ''' release_block - DELETE /vlan/<vlan_id>/block/<block_id>
+        release_block - DELETE /vlan/<vlan_name>/block/<block_id>
+    Releases a reserved block, returning its addresses to the vlan.
+    '''
+    vlan = find_vlan(vlan_id, vlan_name)
+    block = models.Block.query.filter(
+        models.Block.id == block_id,
+        models.Block.vlan_id == vlan.id).first() if vlan else None
+    if not block:
+        return httplib.NOT_FOUND
+
+    db.session.delete(block)
+    return httplib.ACCEPTED
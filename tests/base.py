@@ -1,5 +1,7 @@
 from flask.ext.testing import TestCase
-from banchi import app, db
+from banchi import app, db, cache
+from contextlib import contextmanager
+from sqlalchemy import event
 import httplib
 import json
 
@@ -20,6 +22,7 @@ class TestBase(TestCase):
 
     def setUp(self):
         db.create_all()
+        cache.backend().clear()
         self.session = db.session
 
         self.client = self.app.test_client()
@@ -54,7 +57,35 @@ class TestBase(TestCase):
                     response.status_code, status)
             self.assertEqual(response.status_code, status, msg)
 
-    def create_vlan(self, number=20, name="test", mask="100.110.120.0/24"):
+    @contextmanager
+    def assertMaxQueries(self, count, msg=None):
+        ''' TestBase::assertMaxQueries
+        context manager for tests to check that the code run inside of it
+        issues no more than `count` SQL statements
+        params:
+            count: <Int> for the maximum number of statements allowed
+            msg: <String> message to give to the assert call (default message
+                lists the statements that were run)
+        '''
+        statements = []
+        engine = db.get_engine(self.app)
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        if not msg:
+            msg = "{} statements run (expected at most {}):\n{}".format(
+                len(statements), count, "\n".join(statements))
+        self.assertLessEqual(len(statements), count, msg)
+
+    def create_vlan(self, number=20, name="test", mask="100.110.120.0/24",
+                    mask6=None):
         ''' ::create_vlan
         Helper method to request the creation of a new vlan.
         '''
@@ -63,6 +94,8 @@ class TestBase(TestCase):
             'name': name,
             'mask': mask,
         }
+        if mask6:
+            vlan['mask6'] = mask6
         response = self.client.post(self.url_vlans, data=vlan,
                                     headers=self.json_header)
         self.assertHasStatus(response, httplib.CREATED)
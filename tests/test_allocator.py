@@ -0,0 +1,135 @@
+from base import TestBase
+from banchi import models, allocator, settings, utils
+
+
+class AllocatorTest(TestBase):
+    ''' AllocatorTest
+    Tests the free space index used to allocate IPs on vlans.
+    '''
+    cidr = 1024
+
+    def vlan(self, length=24):
+        ''' ::vlan
+        Creates and flushes a simple Vlan model object.
+        '''
+        vlan = models.Vlan(name="alloc", cidr=self.cidr, number=1,
+                           length=length)
+        self.session.add(vlan)
+        self.session.flush()
+        return vlan
+
+    def blocks(self, vlan):
+        ''' ::blocks
+        Returns the free runs of offsets indexed for the vlan.
+        '''
+        c = allocator.free_blocks.c
+        return [list(row) for row in self.session.execute(
+            allocator.select([c.first, c.last]).where(
+                c.vlan_id == vlan.id).order_by(c.first))]
+
+    def test_ipv6(self):
+        ''' IPv6 prefixes are allocated from without enumerating them
+        A /64 and a /32 are each indexed as a single free block, separate
+        from the IPv4 range of the vlan, and handing out and releasing
+        addresses only splits and merges the blocks around them.
+        '''
+        vlan = self.vlan()
+        vlan.cidr6, vlan.length6 = utils.ip2int("2001:db8::"), 64
+        allocator.rebuild(self.session, vlan, 6)
+        c = allocator.free_blocks.c
+        blocks = self.session.execute(allocator.select(
+            [c.first, c.last, c.size]).where(c.version == 6)).fetchall()
+        self.assertEqual([list(row) for row in blocks],
+                         [[0, (1 << 64) - 1, 1 << 64]])
+
+        ips = [models.Ip(number=number, vlan=vlan)
+               for number in vlan.get_free(3, 6)]
+        self.assertEqual([str(ip) for ip in ips],
+                         ["2001:db8::", "2001:db8::1", "2001:db8::2"])
+        self.session.add_all(ips)
+        self.assertEqual(allocator.allocated(self.session, vlan, 6), 3)
+        self.assertEqual(vlan.get_next(), self.cidr)
+
+        self.session.delete(ips[1])
+        self.assertEqual(utils.int2ip(vlan.get_next(6)), "2001:db8::1")
+        self.assertEqual(allocator.allocated(self.session, vlan, 6), 2)
+
+        vlan.length6 = 32
+        allocator.rebuild(self.session, vlan, 6)
+        self.assertEqual(allocator.peek(self.session, vlan, 2, 6), [1, 3])
+        self.assertEqual(allocator.bounds(vlan, 6), (0, (1 << 96) - 1))
+
+    def test_run_arithmetic(self):
+        ''' runs can be subtracted from and merged into free blocks
+        '''
+        self.assertEqual(allocator.runs([5, 1, 2, 3, 7]),
+                         [[1, 3], [5, 5], [7, 7]])
+        self.assertEqual(allocator.subtract([[0, 9]], [[0, 0], [4, 5]]),
+                         [[1, 3], [6, 9]])
+        self.assertEqual(allocator.union([[1, 3], [6, 9]], [[4, 5]]),
+                         [[1, 9]])
+
+    def test_release(self):
+        ''' deleted IPs are handed out again
+        Allocates a run of IPs, deletes one from the middle and checks that it
+        is the next address returned and that the free space is merged back
+        together once it is released.
+        '''
+        vlan = self.vlan()
+        ips = [models.Ip(number=self.cidr + i, vlan=vlan) for i in range(5)]
+        self.session.add_all(ips)
+
+        self.assertEqual(self.cidr + 5, vlan.get_next())
+        self.session.delete(ips[2])
+        self.assertEqual(self.cidr + 2, vlan.get_next())
+        self.assertEqual(self.blocks(vlan), [[2, 2], [5, 255]])
+
+        self.session.delete(ips[4])
+        self.session.delete(ips[3])
+        self.session.flush()
+        self.assertEqual(self.blocks(vlan), [[2, 255]])
+        self.assertEqual(allocator.allocated(self.session, vlan), 2)
+
+    def test_rebuild(self):
+        ''' vlans without an index get one built from their IPs
+        Drops the index of a vlan with allocated IPs (like a vlan created
+        before the index existed) and checks that allocation still works.
+        '''
+        vlan = self.vlan()
+        for i in [0, 1, 3]:
+            self.session.add(models.Ip(number=self.cidr + i, vlan=vlan))
+        self.session.flush()
+
+        allocator.drop(self.session, [vlan.id])
+        self.assertEqual(self.blocks(vlan), [])
+
+        self.assertEqual(self.cidr + 2, vlan.get_next())
+        self.assertEqual(self.blocks(vlan), [[2, 2], [4, 255]])
+
+    def test_delete_vlan(self):
+        ''' deleting a vlan removes its index
+        '''
+        vlan = self.vlan()
+        vlan_id = vlan.id
+        self.session.delete(vlan)
+        self.session.flush()
+
+        c = allocator.pools.c
+        self.assertIsNone(self.session.execute(allocator.select(
+            [c.vlan_id]).where(c.vlan_id == vlan_id)).first())
+
+    def test_reserved_addresses(self):
+        ''' network and broadcast addresses can be kept out of allocation
+        '''
+        settings.RESERVE_NETWORK_BROADCAST = True
+        try:
+            vlan = self.vlan(length=30)
+            self.assertEqual(self.cidr + 1, vlan.get_next())
+            self.assertEqual(self.blocks(vlan), [[1, 2]])
+
+            point_to_point = models.Vlan(name="p2p", cidr=self.cidr, number=2,
+                                         length=31)
+            self.session.add(point_to_point)
+            self.assertEqual(self.cidr, point_to_point.get_next())
+        finally:
+            settings.RESERVE_NETWORK_BROADCAST = False
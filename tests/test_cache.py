@@ -0,0 +1,140 @@
+from base import TestBase
+from banchi import cache, changes, models, settings
+import unittest
+import json
+import httplib
+
+
+class LocalCacheTest(unittest.TestCase):
+    ''' LocalCacheTest
+    Tests the bounds and invalidation of the local cache backend.
+    '''
+
+    def test_lru_eviction(self):
+        ''' the least recently used entry is evicted when full
+        '''
+        store = cache.LocalCache(2, 60)
+        store.set("a", 1, [], 0)
+        store.set("b", 2, [], 0)
+        self.assertEqual(store.get("a"), 1)
+        store.set("c", 3, [], 0)
+
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.get("a"), 1)
+        self.assertEqual(store.get("c"), 3)
+        self.assertEqual(store.stats()["evictions"], 1)
+
+    def test_expiry(self):
+        ''' entries are dropped once their time to live has passed
+        '''
+        store = cache.LocalCache(2, -1)
+        store.set("a", 1, [], 0)
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.stats()["expirations"], 1)
+
+    def test_invalidation(self):
+        ''' invalidating a tag drops only the entries with that tag
+        Also checks that a value built before an invalidation is not stored
+        after it.
+        '''
+        store = cache.LocalCache(10, 60)
+        store.set("a", 1, ["host:a", "host"], 0)
+        store.set("b", 2, ["host:b", "host"], 0)
+        store.set("list", [1, 2], ["host"], 0)
+
+        store.invalidate(["host:a"])
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("b"), 2)
+
+        store.invalidate(["host"])
+        self.assertEqual(store.stats()["entries"], 0)
+
+        generation = store.generation
+        store.invalidate(["host:a"])
+        store.set("a", 1, ["host:a"], generation)
+        self.assertIsNone(store.get("a"))
+
+
+class CacheTest(TestBase):
+    ''' CacheTest
+    Tests caching of the read endpoints and their invalidation by writes.
+    '''
+
+    def get(self, url):
+        ''' ::get
+        Helper method to request a url and decode the response.
+        '''
+        response = self.client.get(url, headers=self.json_header)
+        self.assertHasStatus(response, httplib.OK)
+        return json.loads(response.data)
+
+    def test_cached_lookups(self):
+        ''' repeated lookups are answered without the database
+        Looks up a host twice and checks that the second request runs no SQL
+        and is counted as a hit.
+        '''
+        self.create_vlan()
+        host = self.create_host(vlans=[20])
+
+        self.get(host["url"])
+        with self.assertMaxQueries(0):
+            self.get(host["url"])
+
+        stats = self.get(self.url_cache_stats)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_precise_invalidation(self):
+        ''' writes drop only the responses they affect
+        Caches a host, the host listing and the vlan, removes another host and
+        checks that the listing and the vlan are rebuilt while the host that
+        was kept is still served from the cache.
+        '''
+        vlan = self.create_vlan()
+        kept = self.create_host(name="kept", vlans=[20])
+        dropped = self.create_host(name="dropped", vlans=[20])
+        vlan_url = self.url_vlans + vlan["name"] + "/"
+
+        self.get(kept["url"])
+        self.assertEqual(len(self.get_hosts()), 2)
+        self.assertEqual(len(self.get(vlan_url)["hosts"]), 2)
+
+        response = self.client.delete(dropped["url"])
+        self.assertHasStatus(response, httplib.ACCEPTED)
+
+        with self.assertMaxQueries(0):
+            self.get(kept["url"])
+        self.assertEqual(self.get(vlan_url)["hosts"], ["kept"])
+        self.assertEqual(len(self.get_hosts()), 1)
+
+    def test_streamed(self):
+        ''' streamed listings are not cached
+        '''
+        self.create_vlan()
+        self.create_host(vlans=[20])
+        self.assertEqual(len(self.get_hosts()), 1)
+        self.assertEqual(len(self.get(self.url_hosts + "?per_page=1000")), 1)
+        self.assertEqual(self.get(self.url_cache_stats)["entries"], 0)
+
+    def test_other_processes(self):
+        ''' writes of other processes are seen once the revisions are read
+        Removes the IPs of a cached host the way another process would, without
+        invalidating this cache, and checks that the host is rebuilt once its
+        revision is checked.
+        '''
+        check, settings.CACHE_CHECK = settings.CACHE_CHECK, 60
+        try:
+            self.create_vlan()
+            host = self.create_host(vlans=[20])
+            self.assertEqual(len(self.get(host["url"])["ips"]), 1)
+
+            models.Ip.query.delete()
+            self.session.info['changed'] = set(['host'])
+            changes.bump(self.session)
+            self.session.commit()
+
+            self.assertEqual(len(self.get(host["url"])["ips"]), 1)
+            settings.CACHE_CHECK = 0
+            self.assertEqual(self.get(host["url"])["ips"], {})
+        finally:
+            settings.CACHE_CHECK = check
@@ -0,0 +1,164 @@
+from banchi import app, db, client, server, settings
+from StringIO import StringIO
+from threading import Thread
+import base
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+
+class ClientTest(unittest.TestCase):
+    ''' ClientTest
+    Tests the command line client against a server running in a thread of
+    the test, on a database of its own.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.join(
+            self.directory, "banchi.db")
+        with app.app_context():
+            db.session.remove()
+            db.create_all()
+
+        self.sock = server.listen("127.0.0.1", 0)
+        self.worker = server.Worker(self.sock, app, threads=2)
+        self.thread = Thread(target=self.worker.run, args=(5,))
+        self.thread.start()
+        self.url = "http://{}:{}".format(*self.sock.getsockname())
+        self.cache = os.path.join(self.directory, "cache", "endpoints.json")
+        self.client = self.connect()
+
+    def tearDown(self):
+        self.client.connection.close()
+        self.worker.stop()
+        self.thread.join()
+        self.sock.close()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.uri
+        shutil.rmtree(self.directory)
+
+    def connect(self, refresh=False):
+        return client.Client(self.url, cache=self.cache, refresh=refresh)
+
+    def test_commands(self):
+        ''' commands over one connection
+        Every command of a session goes over the same connection, listings
+        are followed through all of their pages.
+        '''
+        run = self.client.run
+        run(["vlan", "add", "20", "test", "10.0.0.0/24"])
+        self.assertEqual(self.client.status, httplib.CREATED)
+        for i in range(5):
+            run(["host", "add", "www{}".format(i), "20"])
+
+        host = run(["host", "show", "www3"])
+        self.assertEqual(host["name"], "www3")
+        self.assertEqual(run(["find", "ip", host["ips"]["20"]]),
+                         "www3_test_ip")
+        settings.CLIENT_BATCH, size = 2, settings.CLIENT_BATCH
+        try:
+            self.assertEqual([item["name"] for item in run(["host", "list"])],
+                             ["www{}".format(i) for i in range(5)])
+        finally:
+            settings.CLIENT_BATCH = size
+        self.assertEqual(len(run(["find", "range", "10.0.0.0/24"])), 5)
+        self.assertEqual(run(["vlan", "stats", "test"])["allocated"], 5)
+        run(["host", "delete", "www3"])
+        with self.assertRaises(client.RequestFailed) as failure:
+            run(["host", "show", "www3"])
+        self.assertEqual(failure.exception.status, httplib.NOT_FOUND)
+        with self.assertRaises(client.UsageError):
+            run(["vlan", "add", "21"])
+        with self.assertRaises(client.UsageError):
+            run(["frobnicate"])
+
+        self.assertEqual(self.client.connection.opened, 1)
+
+    def test_reconnect(self):
+        ''' dropped connections are reopened for GETs only
+        A POST that was sent on a dropped connection may have been carried
+        out, so it is not sent again.
+        '''
+        connection = client.Connection(self.url)
+        connection.request("GET", "/")
+        connection.connection.sock.shutdown(socket.SHUT_RD)
+        response, _ = connection.request("GET", "/vlan/")
+        self.assertEqual((response.status, connection.opened),
+                         (httplib.OK, 2))
+
+        connection.connection.sock.shutdown(socket.SHUT_RD)
+        with self.assertRaises(httplib.BadStatusLine):
+            connection.request("POST", "/vlan/", "number=20&name=test&mask="
+                               "10.0.0.0/24", {"Content-Type": "application/"
+                                               "x-www-form-urlencoded"})
+        for _ in range(50):  # until the server has carried it out
+            vlans = json.loads(connection.request("GET", "/vlan/")[1])
+            if vlans:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(vlans), 1)
+        connection.close()
+
+    def test_discovery(self):
+        ''' endpoints are discovered once
+        Later clients use the cached endpoints unless told to refresh them.
+        '''
+        self.client.run(["vlan", "list"])
+        self.assertEqual(self.client.connection.requests, 2)
+
+        for (refresh, requests) in [(False, 1), (True, 2)]:
+            later = self.connect(refresh)
+            later.run(["vlan", "list"])
+            later.connection.close()
+            self.assertEqual(later.connection.requests, requests)
+
+    def test_batch(self):
+        ''' batch mode sends runs of commands together
+        Every command gets its own result, in order, and failures in a bulk
+        create are reported for the command that caused them.
+        '''
+        lines = ["vlan add 20 test 10.0.0.0/24", "# comment", ""] + \
+            ["host add h{} 20".format(i) for i in range(50)] + \
+            ["host show h{}".format(i) for i in range(50)] + \
+            ["find ip 10.0.0.1", "host show missing", "find ip bogus",
+             "host add h1 20", "host add fresh 20", "vlan show test",
+             "vlan stats", "unknown command", "host add 'unclosed"]
+        out = StringIO()
+        self.assertEqual(client.main(["--url", self.url, "--batch"],
+                                     StringIO("\n".join(lines)), out), 1)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+
+        self.assertEqual([result["command"] for result in results],
+                         [line for line in lines if line and line[0] != "#"])
+        self.assertEqual([result.get("status") for result in results[51:]],
+                         [httplib.OK] * 51 + [httplib.NOT_FOUND,
+                                              httplib.BAD_REQUEST,
+                                              httplib.CONFLICT,
+                                              httplib.CREATED, httplib.OK,
+                                              httplib.OK, None, None])
+        self.assertEqual(results[1]["data"]["name"], "h0")
+        self.assertEqual(results[51]["data"], {
+            "name": "h0", "ips": {"20": "10.0.0.0"}})
+        self.assertEqual(results[101]["data"], "h1_test_ip")
+        self.assertEqual(results[-3]["data"][0]["allocated"], 51)
+
+    def test_batch_requests(self):
+        ''' batches take a request per run of commands
+        '''
+        self.client.run(["vlan", "add", "20", "test", "10.0.0.0/24"])
+        requests = self.client.connection.requests
+        results = list(self.client.batch(
+            ["host add h{} 20".format(i) for i in range(200)] +
+            ["host show h{}".format(i) for i in range(200)] +
+            ["find ip 10.0.0.{}".format(i) for i in range(200)]))
+        self.assertEqual(len(results), 600)
+        self.assertEqual(self.client.connection.requests - requests, 2)
@@ -0,0 +1,76 @@
+from banchi import app, db, models, allocator
+from multiprocessing import Process
+from sqlalchemy import func, select
+import base
+import httplib
+import os
+import sys
+import tempfile
+import unittest
+
+WORKERS = 4
+HOSTS = 15
+
+
+def allocate(worker, vlans):
+    ''' allocate
+    Creates HOSTS hosts on the vlans through the API, exiting with an error
+    if any of them could not be created.
+    '''
+    db.session.remove()  # drop the connection inherited from the parent
+    client = app.test_client()
+    statuses = [client.post("/host/", data={
+        "name": "w{}-{}".format(worker, i), "vlan": vlans}).status_code
+        for i in range(HOSTS)]
+    sys.exit(0 if set(statuses) == set([httplib.CREATED]) else 1)
+
+
+class ConcurrencyTest(unittest.TestCase):
+    ''' ConcurrencyTest
+    Tests allocating addresses from several processes sharing a database.
+    '''
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + self.path
+        self.context = app.test_request_context()
+        self.context.push()
+        db.session.remove()
+        db.create_all()
+        db.session.add_all([
+            models.Vlan(name="shared", number=1, cidr=10 << 24, length=24),
+            models.Vlan(name="other", number=2, cidr=11 << 24, length=24)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.uri
+        os.unlink(self.path)
+
+    def test_no_duplicates(self):
+        ''' concurrent workers never hand out the same address
+        Every worker allocates on both vlans at once, and every host has to
+        be created with a distinct address on each.
+        '''
+        workers = [Process(target=allocate, args=(i, [1, 2]))
+                   for i in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([worker.exitcode for worker in workers],
+                         [0] * WORKERS)
+
+        ips = db.session.query(models.Ip.vlan_id, models.Ip.number).all()
+        self.assertEqual(len(ips), WORKERS * HOSTS * 2)
+        self.assertEqual(len(set(ips)), len(ips))
+        self.assertEqual(models.Host.query.count(), WORKERS * HOSTS)
+
+        allocated = dict(db.session.execute(select(
+            [allocator.pools.c.vlan_id, allocator.pools.c.allocated]))
+            .fetchall())
+        self.assertEqual(allocated, dict(db.session.query(
+            models.Ip.vlan_id, func.count()).group_by(models.Ip.vlan_id)))
@@ -0,0 +1,150 @@
+from base import TestBase
+from banchi import database, settings, db, models
+from banchi.decorators import write_operation
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine.url import make_url
+from threading import Thread
+import httplib
+import json
+import os
+import tempfile
+import time
+import unittest
+
+
+class PoolTest(unittest.TestCase):
+    ''' PoolTest
+    Tests the engine options, SQLite pragmas and connection pool metrics.
+    '''
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+
+    def tearDown(self):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def test_options(self):
+        ''' file databases get a metered pool and memory ones keep theirs
+        '''
+        from banchi import app, db
+        options = {"pool_size": 3, "max_overflow": 2}
+        db.apply_driver_hacks(app, make_url("sqlite://"), options)
+        self.assertNotIn("poolclass", options)
+        self.assertNotIn("max_overflow", options)
+
+        options = {"max_overflow": 2}
+        db.apply_driver_hacks(
+            app, make_url("postgresql://banchi@localhost/banchi"), options)
+        self.assertEqual(options, {"max_overflow": 2, "pool_size":
+                                   settings.DATABASE_POOL_SIZE,
+                                   "poolclass": database.MeteredPool})
+
+    def test_pragmas(self):
+        ''' new SQLite connections use write ahead logging
+        '''
+        engine = create_engine("sqlite:///" + self.path,
+                               poolclass=database.MeteredPool)
+        self.assertEqual(engine.execute("PRAGMA journal_mode").scalar(), "wal")
+        self.assertEqual(engine.execute("PRAGMA busy_timeout").scalar(),
+                         settings.SQLITE_PRAGMAS["busy_timeout"])
+
+    def test_waiting(self):
+        ''' checkouts waiting on an exhausted pool are counted
+        '''
+        engine = create_engine(
+            "sqlite:///" + self.path, poolclass=database.MeteredPool,
+            pool_size=1, max_overflow=0, pool_timeout=5,
+            connect_args={'check_same_thread': False})
+        held = engine.connect()
+        waiter = Thread(target=lambda: engine.connect().close())
+        waiter.start()
+        deadline = time.time() + 5
+        while engine.pool.waiting == 0 and time.time() < deadline:
+            time.sleep(0.01)
+
+        stats = database.stats(engine)
+        self.assertEqual((stats["checked_out"], stats["waiting"]), (1, 1))
+        held.close()
+        waiter.join()
+        self.assertEqual(database.stats(engine)["waiting"], 0)
+        self.assertEqual(database.stats(engine)["timeouts"], 0)
+
+
+class OutdatedTest(unittest.TestCase):
+    ''' OutdatedTest
+    Tests finding the columns of databases created by older versions.
+    '''
+
+    def test_outdated(self):
+        ''' integer addresses and missing columns are found
+        '''
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine, tables=[
+            table for table in db.metadata.sorted_tables
+            if table.name not in ("ip", "pool")])
+        self.assertEqual(database.outdated(engine, db.metadata), [])
+
+        engine.execute("CREATE TABLE ip (id INTEGER PRIMARY KEY, "
+                       "number INTEGER, vlan_id INTEGER, host_id INTEGER)")
+        engine.execute("CREATE TABLE pool (vlan_id INTEGER PRIMARY KEY, "
+                       "allocated INTEGER NOT NULL)")
+        self.assertEqual(sorted(database.outdated(engine, db.metadata)),
+                         ["ip.number", "pool.version"])
+
+
+class WriteOperationTest(TestBase):
+    ''' WriteOperationTest
+    Tests which failed writes are run again.
+    '''
+
+    def test_retries(self):
+        ''' lock failures are retried, constraint violations are not
+        '''
+        calls = []
+
+        def duplicate():
+            calls.append("duplicate")
+            db.session.add(models.Host(name="taken"))
+            db.session.flush()
+            return httplib.CREATED
+
+        def locked():
+            calls.append("locked")
+            if len(calls) < 3:
+                raise OperationalError("UPDATE pool", {},
+                                       Exception("database is locked"))
+            return httplib.ACCEPTED
+
+        backoff, settings.WRITE_BACKOFF = settings.WRITE_BACKOFF, 0
+        try:
+            with self.app.test_request_context(method="POST"):
+                self.assertEqual(write_operation(duplicate)(),
+                                 httplib.CREATED)
+                self.assertEqual(write_operation(duplicate)(),
+                                 httplib.CONFLICT)
+                self.assertEqual(calls, ["duplicate"] * 2)
+
+                del calls[:]
+                self.assertEqual(write_operation(locked)(), httplib.ACCEPTED)
+                self.assertEqual(len(calls), 3)
+        finally:
+            settings.WRITE_BACKOFF = backoff
+
+
+class DatabaseStatsTest(TestBase):
+    ''' DatabaseStatsTest
+    Tests the database stats endpoint.
+    '''
+
+    def test_stats(self):
+        ''' the pool of the engine in use is reported
+        '''
+        response = self.client.get(self.url_database_stats,
+                                   headers=self.json_header)
+        stats = json.loads(response.data)
+        self.assertEqual(stats["dialect"], "sqlite")
+        self.assertIn("pool", stats)
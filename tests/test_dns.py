@@ -0,0 +1,216 @@
+from base import TestBase
+from banchi import dns, db, settings
+import socket
+import struct
+
+
+def query(name, qtype=dns.TYPE_A, ident=1234):
+    ''' query
+    Encodes a recursive query for a name.
+    '''
+    return struct.pack('!HHHHHH', ident, dns.FLAG_RECURSION, 1, 0, 0, 0) + \
+        dns.encode_name(name.split('.')) + struct.pack('!HH', qtype, 1)
+
+
+def addresses(response):
+    ''' addresses
+    Decodes the id, response code and A (and AAAA) record addresses of a
+    response.
+    '''
+    ident, flags, questions, count = struct.unpack('!HHHH', response[:8])
+    offset = response.index('\0', 12) + 5 if questions else 12
+    ips = []
+    for _ in range(count):
+        rtype, _, _, length = struct.unpack(
+            '!HHIH', response[offset + 2:offset + 12])
+        if rtype == dns.TYPE_A:
+            ips.append(socket.inet_ntoa(response[offset + 12:offset + 16]))
+        elif rtype == dns.TYPE_AAAA:
+            ips.append(socket.inet_ntop(socket.AF_INET6,
+                                        response[offset + 12:offset + 28]))
+        offset += 12 + length
+    return ident, flags & 15, ips
+
+
+class DnsTest(TestBase):
+    ''' DnsTest
+    Tests the answers of the DNS responder.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.create_vlan(number=1, name="front", mask="10.1.0.0/24")
+        self.create_vlan(number=2, name="back", mask="10.2.0.0/24")
+        self.create_host(name="web", vlans=[1, 2])
+        self.create_host(name="db", vlans=[2])
+
+        self.index = dns.Index()
+        self.index.refresh(db.session, force=True)
+
+    def test_vlan_aware_answers(self):
+        ''' hosts resolve to their IP on the requester's vlan
+        Queries a host on two vlans from each vlan and from outside of both.
+        '''
+        ident, rcode, ips = addresses(
+            self.index.answer(query("web.banchi"), "10.1.0.200"))
+        self.assertEqual((ident, rcode, ips), (1234, dns.NOERROR,
+                                               ["10.1.0.0"]))
+
+        _, _, ips = addresses(self.index.answer(query("WEB"), "10.2.0.200"))
+        self.assertEqual(ips, ["10.2.0.0"])
+
+        _, _, ips = addresses(self.index.answer(query("web"), "192.168.0.1"))
+        self.assertEqual(sorted(ips), ["10.1.0.0", "10.2.0.0"])
+
+        _, _, ips = addresses(self.index.answer(query("db"), "10.1.0.200"))
+        self.assertEqual(ips, ["10.2.0.1"])
+
+    def test_missing_and_reverse(self):
+        ''' unknown names are NXDOMAIN and IPs resolve back to hosts
+        '''
+        _, rcode, ips = addresses(
+            self.index.answer(query("nothere"), "10.1.0.1"))
+        self.assertEqual((rcode, ips), (dns.NXDOMAIN, []))
+
+        response = self.index.answer(
+            query("1.0.2.10.in-addr.arpa", dns.TYPE_PTR), "10.1.0.1")
+        self.assertEqual(addresses(response)[1], dns.NOERROR)
+        self.assertTrue(response.endswith(dns.encode_name(["db", "banchi"])))
+
+        _, rcode, _ = addresses(self.index.answer("\x00\x01\x00\x00" * 3,
+                                                  "10.1.0.1"))
+        self.assertEqual(rcode, dns.FORMERR)
+
+    def test_ipv6(self):
+        ''' dual-stack hosts answer AAAA queries and ip6.arpa lookups
+        Only the addresses of the type asked for are answered, so hosts
+        without IPv6 addresses have no AAAA records.
+        '''
+        self.create_vlan(number=3, name="dual", mask="10.3.0.0/24",
+                         mask6="2001:db8:3::/64")
+        self.create_host(name="v6", vlans=[3])
+        self.index.refresh(db.session, force=True)
+
+        _, rcode, ips = addresses(self.index.answer(
+            query("v6", dns.TYPE_AAAA), "10.3.0.9"))
+        self.assertEqual((rcode, ips), (dns.NOERROR, ["2001:db8:3::"]))
+        _, _, ips = addresses(self.index.answer(query("v6"), "10.3.0.9"))
+        self.assertEqual(ips, ["10.3.0.0"])
+        _, _, ips = addresses(self.index.answer(
+            query("v6", dns.TYPE_ANY), "10.3.0.9"))
+        self.assertEqual(ips, ["10.3.0.0", "2001:db8:3::"])
+        _, rcode, ips = addresses(self.index.answer(
+            query("db", dns.TYPE_AAAA), "10.3.0.9"))
+        self.assertEqual((rcode, ips), (dns.NOERROR, []))
+
+        name = ".".join(reversed("20010db8000300000000000000000000")) + \
+            ".ip6.arpa"
+        response = self.index.answer(query(name, dns.TYPE_PTR), "10.3.0.9")
+        self.assertEqual(addresses(response)[1], dns.NOERROR)
+        self.assertTrue(response.endswith(dns.encode_name(["v6", "banchi"])))
+        _, rcode, _ = addresses(self.index.answer(
+            query("1.ip6.arpa", dns.TYPE_PTR), "10.3.0.9"))
+        self.assertEqual(rcode, dns.NXDOMAIN)
+
+    def test_refresh(self):
+        ''' the index picks up changes once their revision advances
+        '''
+        self.create_host(name="late", vlans=[1])
+        self.assertFalse(self.index.refresh(db.session))
+        self.index.checked = 0
+        self.assertTrue(self.index.refresh(db.session))
+
+        _, _, ips = addresses(self.index.answer(query("late"), "10.1.0.9"))
+        self.assertEqual(ips, ["10.1.0.1"])
+
+    def test_incremental(self):
+        ''' refreshes apply just the changes logged since the last one
+        Falls back to loading everything when there are too many.
+        '''
+        load, self.index.load = self.index.load, None  # never called
+        self.create_host(name="late", vlans=[1])
+        self.client.delete(self.url_hosts + "db/")
+        self.create_vlan(number=3, name="new", mask="10.3.0.0/24")
+        self.create_host(name="newer", vlans=[3])
+        self.index.checked = 0
+        self.assertTrue(self.index.refresh(db.session))
+
+        _, _, ips = addresses(self.index.answer(query("late"), "10.1.0.9"))
+        self.assertEqual(ips, ["10.1.0.1"])
+        _, rcode, _ = addresses(self.index.answer(query("db"), "10.1.0.9"))
+        self.assertEqual(rcode, dns.NXDOMAIN)
+        _, rcode, _ = addresses(self.index.answer(
+            query("1.0.2.10.in-addr.arpa", dns.TYPE_PTR), "10.1.0.1"))
+        self.assertEqual(rcode, dns.NXDOMAIN)
+        self.assertEqual(self.index.vlan_of("10.3.0.9"), 3)
+        _, _, ips = addresses(self.index.answer(query("newer"), "10.3.0.9"))
+        self.assertEqual(ips, ["10.3.0.0"])
+
+        self.index.load = load
+        default, settings.DNS_CHANGES = settings.DNS_CHANGES, 1
+        try:
+            self.client.delete(self.url_vlans + "3/")
+            self.index.checked = 0
+            self.assertTrue(self.index.refresh(db.session))
+        finally:
+            settings.DNS_CHANGES = default
+        self.assertEqual(self.index.hosts["newer"], [])
+        self.assertEqual(self.index.vlan_of("10.3.0.9"), None)
+
+    def test_server(self):
+        ''' the server answers over UDP and TCP
+        '''
+        server = dns.Server(self.index, "127.0.0.1", 0)
+        address = server.udp.getsockname()
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto(query("db", ident=7), address)
+        server.poll(1)
+        self.assertEqual(addresses(client.recv(512))[::2], (7, ["10.2.0.1"]))
+
+        stream = socket.create_connection(address)
+        message = query("web", ident=8)
+        stream.sendall(struct.pack('!H', len(message)) + message)
+        server.poll(1)
+        server.poll(1)
+        length = struct.unpack('!H', stream.recv(2))[0]
+        self.assertEqual(addresses(stream.recv(length))[0], 8)
+
+        for sock in (client, stream, server.udp, server.tcp):
+            sock.close()
+
+    def test_truncation(self):
+        ''' UDP answers are cut to whole records and flagged as truncated
+        The same query over TCP gets every answer.
+        '''
+        self.index.hosts["many"] = [(1, (10 << 24) + number)
+                                    for number in range(40)]
+        server = dns.Server(self.index, "127.0.0.1", 0)
+        address = server.udp.getsockname()
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto(query("many", ident=9), address)
+        server.poll(1)
+        response = client.recv(4096)
+        self.assertLessEqual(len(response), dns.UDP_SIZE)
+        flags = struct.unpack('!H', response[2:4])[0]
+        self.assertTrue(flags & dns.FLAG_TRUNCATED)
+        ident, rcode, ips = addresses(response)
+        self.assertEqual((ident, rcode, len(ips)), (9, dns.NOERROR, 30))
+
+        stream = socket.create_connection(address)
+        message = query("many", ident=10)
+        stream.sendall(struct.pack('!H', len(message)) + message)
+        server.poll(1)
+        server.poll(1)
+        length = struct.unpack('!H', stream.recv(2))[0]
+        response = ""
+        while len(response) < length:
+            response += stream.recv(length - len(response))
+        self.assertFalse(struct.unpack('!H', response[2:4])[0] &
+                         dns.FLAG_TRUNCATED)
+        self.assertEqual(len(addresses(response)[2]), 40)
+        self.assertEqual(dns.truncate(response, len(response)), response)
+
+        for sock in (client, stream, server.udp, server.tcp):
+            sock.close()
@@ -0,0 +1,291 @@
+from banchi import app, db, changes, feed, server, settings
+from threading import Thread
+import base
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+
+def parse(text):
+    ''' parse
+    Returns the (id, event, data) of the events of a server-sent events text,
+    skipping comments and the retry field.
+    '''
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n")
+                      if not line.startswith(":"))
+        if "id" in fields:
+            events.append((int(fields["id"]), fields["event"],
+                           json.loads(fields["data"])))
+    return events
+
+
+class FeedTest(base.TestBase):
+    ''' FeedTest
+    Tests the change log and the change feed streaming it.
+    '''
+
+    def setUp(self):
+        base.TestBase.setUp(self)
+        self.defaults = (settings.CHANGES_HEARTBEAT, settings.CHANGES_BUFFER,
+                         settings.CHANGES_SUBSCRIBERS,
+                         settings.CHANGES_COMPACT, settings.CHANGES_RETAIN,
+                         settings.CHANGES_TOMBSTONES)
+        settings.CHANGES_HEARTBEAT = 0.05
+        feed.feed = feed.Feed()
+        # closing a stream early is not an error to keep the context for
+        self.app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
+
+    def tearDown(self):
+        (settings.CHANGES_HEARTBEAT, settings.CHANGES_BUFFER,
+         settings.CHANGES_SUBSCRIBERS, settings.CHANGES_COMPACT,
+         settings.CHANGES_RETAIN, settings.CHANGES_TOMBSTONES) = self.defaults
+        self.app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = None
+        base.TestBase.tearDown(self)
+
+    def stream(self, chunks, **kwargs):
+        ''' ::stream
+        Opens the change feed and returns the events of its first `chunks`
+        chunks.
+        '''
+        response = self.client.get(self.url_stream, buffered=False, **kwargs)
+        self.assertHasStatus(response, httplib.OK)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        body = iter(response.response)
+        try:
+            return parse("".join(next(body) for _ in range(chunks)))
+        finally:
+            response.close()
+
+    def delta(self, status=httplib.OK, **args):
+        ''' ::delta
+        Requests the changes since a seq.
+        '''
+        response = self.client.get(self.url_delta, query_string=args,
+                                   headers=self.json_header)
+        self.assertHasStatus(response, status)
+        return json.loads(response.data) if status == httplib.OK else None
+
+    def test_log(self):
+        ''' writes are appended to the change log in order
+        '''
+        self.create_vlan()
+        self.create_host("www1", [20])
+        self.client.delete(self.url_vlans + "20/")
+
+        log = [(seq, event, data["kind"], data["key"]) for
+               (seq, event, data) in self.stream(2, query_string="since=0")]
+        self.assertEqual([seq for (seq, _, _, _) in log],
+                         range(1, len(log) + 1))
+        self.assertEqual([entry[1:] for entry in log], [
+            ("create", "vlan", "20"),
+            ("create", "host", "www1"),
+            ("create", "ip", "100.110.120.0"),
+            ("delete", "ip", "100.110.120.0"),
+            ("delete", "vlan", "20"),
+        ])
+
+    def test_resume(self):
+        ''' subscribers get the events after the last one they saw
+        '''
+        self.create_vlan()
+        self.assertEqual(self.stream(2), [])  # starts from the latest
+
+        self.create_host("www1", [20])
+        events = self.stream(2, query_string="since=1")
+        self.assertEqual([seq for (seq, _, _) in events], [2, 3])
+        self.assertEqual(events[1][2]["data"], {
+            "ip": "100.110.120.0", "host": "www1", "vlan": 20})
+        self.assertEqual(self.stream(2, headers=[("Last-Event-ID", "2")]),
+                         events[1:])
+
+        response = self.client.get(self.url_stream,
+                                   query_string="since=next")
+        self.assertHasStatus(response, httplib.BAD_REQUEST)
+
+    def test_catch_up(self):
+        ''' subscribers behind the buffer catch up from the change log
+        '''
+        settings.CHANGES_BUFFER = 1
+        for number in range(20, 24):
+            self.create_vlan(number, "vlan{}".format(number),
+                             "10.0.{}.0/24".format(number))
+        self.stream(1)
+        self.create_vlan(24, "vlan24", "10.0.24.0/24")
+
+        events = self.stream(3, query_string="since=0")
+        self.assertEqual([seq for (seq, _, _) in events], range(1, 6))
+        self.assertEqual(events[-1][2]["data"], {
+            "number": 24, "name": "vlan24", "range": "10.0.24.0/24"})
+
+    def test_subscribers(self):
+        ''' subscribers are limited
+        '''
+        settings.CHANGES_SUBSCRIBERS = 0
+        response = self.client.get(self.url_stream)
+        self.assertHasStatus(response, httplib.SERVICE_UNAVAILABLE)
+
+    def test_unsubscribe(self):
+        ''' closed streams are unsubscribed, even if never read
+        '''
+        settings.CHANGES_SUBSCRIBERS = 1
+        for _ in range(3):
+            response = self.client.head(self.url_stream, buffered=False)
+            self.assertHasStatus(response, httplib.OK)
+            response.close()
+            response = self.client.get(self.url_stream, buffered=False)
+            self.assertHasStatus(response, httplib.OK)
+            response.close()
+        self.assertEqual(feed.feed.subscribers, 0)
+        self.stream(2)
+        self.assertEqual(feed.feed.subscribers, 0)
+
+    def test_delta(self):
+        ''' deltas hold the latest state of the items changed since a seq
+        '''
+        self.create_vlan()
+        self.create_host("www1", [20])
+        seq = self.delta()["seq"]
+        self.assertEqual(seq, 3)
+
+        self.client.delete(self.url_hosts + "www1/")
+        self.create_host("www2", [20])
+        delta = self.delta(since=seq)
+        self.assertEqual((delta["since"], delta["seq"], delta["more"]),
+                         (3, 7, False))
+        self.assertEqual(delta["changes"], [
+            {"kind": "host", "key": "www1", "seq": 5, "deleted": True},
+            {"kind": "host", "key": "www2", "seq": 6, "deleted": False,
+             "data": {"name": "www2"}},
+            {"kind": "ip", "key": "100.110.120.0", "seq": 7,
+             "deleted": False, "data": {"ip": "100.110.120.0",
+                                        "host": "www2", "vlan": 20}},
+        ])
+        self.assertEqual(self.delta(since=7)["changes"], [])
+        self.delta(httplib.BAD_REQUEST, since="next")
+
+    def test_compaction(self):
+        ''' the change log keeps the latest event of the existing items
+        '''
+        settings.CHANGES_COMPACT, settings.CHANGES_RETAIN, \
+            settings.CHANGES_TOMBSTONES = 1, 0, 4
+        self.create_vlan()
+        self.create_host("www1", [20])
+        self.client.delete(self.url_hosts + "www1/")
+        self.create_host("www2", [20])
+        self.create_host("www3", [20])
+
+        log = self.session.execute(changes.log.select()).fetchall()
+        self.assertEqual(sorted((row.kind, row.key) for row in log), [
+            ("host", "www2"), ("host", "www3"), ("ip", "100.110.120.0"),
+            ("ip", "100.110.120.1"), ("vlan", "20")])
+        self.assertEqual(changes.horizon(self.session), 5)
+
+        self.assertEqual([(change["key"], change["deleted"]) for change in
+                          self.delta(since=5)["changes"]], [
+            ("www2", False), ("100.110.120.0", False),
+            ("www3", False), ("100.110.120.1", False)])
+        self.delta(httplib.GONE, since=4)
+        response = self.client.get(self.url_stream, query_string="since=0")
+        self.assertHasStatus(response, httplib.GONE)
+
+    def test_compaction_window(self):
+        ''' compactions run every CHANGES_COMPACT events
+        Each one removes the events superseded by the ones appended since the
+        one before it.
+        '''
+        settings.CHANGES_COMPACT, settings.CHANGES_RETAIN, \
+            settings.CHANGES_TOMBSTONES = 4, 0, 100
+        seqs = lambda: [row.seq for row in self.session.execute(
+            changes.log.select().order_by(changes.log.c.seq))]
+        self.create_vlan()
+        self.create_host("www1", [20])
+        self.assertEqual(seqs(), [1, 2, 3])
+        self.client.delete(self.url_hosts + "www1/")  # passes 4
+        self.assertEqual(seqs(), [1, 4, 5])
+        self.assertEqual(changes.current(self.session, ['compaction']),
+                         [(5, None)])
+
+        self.create_host("www2", [20])
+        self.assertEqual(seqs(), [1, 4, 5, 6, 7])
+        self.create_host("www3", [20])  # passes 8, .0 is allocated again
+        self.assertEqual(seqs(), [1, 5, 6, 7, 8, 9])
+        self.assertEqual(changes.horizon(self.session), 0)
+
+    def test_compaction_queries(self):
+        ''' compactions take the same statements however many items changed
+        '''
+        settings.CHANGES_COMPACT, settings.CHANGES_RETAIN, \
+            settings.CHANGES_TOMBSTONES = 1000, 0, 1000
+        self.create_vlan()
+        for number in range(10):
+            self.create_host("www{}".format(number), [20])
+        for number in range(5):
+            self.client.delete(self.url_hosts + "www{}/".format(number))
+
+        with self.assertMaxQueries(5):
+            self.assertEqual(changes.compact(self.session), 10)
+
+
+class FeedServerTest(unittest.TestCase):
+    ''' FeedServerTest
+    Tests the change feed served by a worker, on a database of its own.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.join(
+            self.directory, "banchi.db")
+        with app.app_context():
+            db.session.remove()
+            db.create_all()
+        feed.feed = feed.Feed()
+
+        self.sock = server.listen("127.0.0.1", 0)
+        self.worker = server.Worker(self.sock, app, threads=1)
+        self.thread = Thread(target=self.worker.run, args=(5,))
+        self.thread.start()
+
+    def tearDown(self):
+        self.worker.stop()
+        self.thread.join()
+        self.sock.close()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.uri
+        shutil.rmtree(self.directory)
+
+    def test_stream(self):
+        ''' streams get the writes of other requests as they are committed,
+        without holding the only request thread
+        '''
+        connection = httplib.HTTPConnection(*self.sock.getsockname())
+        connection.request("GET", feed.BASE_PATH + "stream/")
+        subscriber = connection.getresponse()
+        connection.sock.settimeout(5)
+        self.assertEqual(subscriber.read(2), "re")  # the retry field
+
+        writer = httplib.HTTPConnection(*self.sock.getsockname())
+        writer.request("POST", "/vlan/", "number=20&name=test&mask="
+                       "10.0.0.0/24", {"Content-Type":
+                                       "application/x-www-form-urlencoded"})
+        self.assertEqual(writer.getresponse().status, httplib.CREATED)
+        writer.close()
+
+        text = ""
+        try:
+            while "id: " not in text or \
+                    "\n\n" not in text.split("id: ", 1)[1]:
+                text += subscriber.read(1)
+        except socket.timeout:
+            self.fail("event not received: {!r}".format(text))
+        connection.close()
+        self.assertEqual(parse(text.split("\n\n", 1)[1])[0][:2],
+                         (1, "create"))
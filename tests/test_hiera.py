@@ -0,0 +1,87 @@
+from base import TestBase
+import json
+import httplib
+
+
+class HieraTest(TestBase):
+    ''' HieraTest
+    Tests the lookups of the Hiera backend endpoints.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.create_vlan(number=1, name="front", mask="10.1.0.0/24")
+        self.create_vlan(number=2, name="back_end", mask="10.2.0.0/24")
+        self.create_host(name="web_1", vlans=[1, 2])
+        self.create_host(name="db", vlans=[2])
+
+    def lookup(self, **params):
+        response = self.client.get(self.url_lookup, query_string=params,
+                                   headers=self.json_header)
+        self.assertHasStatus(response, httplib.OK)
+        return json.loads(response.data)
+
+    def test_single_key(self):
+        ''' single keys resolve to the IP of the host on the vlan
+        Both the host and the vlan have underscores in their names.
+        '''
+        response = self.client.get(self.url_lookup + "web_1_back_end_ip/")
+        self.assertHasStatus(response, httplib.OK)
+        self.assertEqual(response.data, "10.2.0.0")
+
+        response = self.client.get(self.url_lookup + "db_front_ip/")
+        self.assertHasStatus(response, httplib.NOT_FOUND)
+        response = self.client.get(self.url_lookup + "db/")
+        self.assertHasStatus(response, httplib.NOT_FOUND)
+
+    def test_batch(self):
+        ''' batches return the found keys and every key of whole hosts
+        '''
+        self.assertEqual(
+            self.lookup(key=["web_1_front_ip", "db_back_end_ip", "db_front_ip",
+                             "nothing"]),
+            {"web_1_front_ip": "10.1.0.0", "db_back_end_ip": "10.2.0.1"})
+        self.assertEqual(self.lookup(host="web_1"), {
+            "web_1_front_ip": "10.1.0.0", "web_1_back_end_ip": "10.2.0.0"})
+
+        batch = {"keys": ["db_back_end_ip"], "hosts": ["web_1"]}
+        response = self.client.post(self.url_lookup, headers=self.json_header,
+                                    content_type="application/json",
+                                    data=json.dumps(batch))
+        self.assertHasStatus(response, httplib.OK)
+        self.assertEqual(len(json.loads(response.data)), 3)
+
+        response = self.client.get(self.url_lookup)
+        self.assertHasStatus(response, httplib.BAD_REQUEST)
+        response = self.client.post(self.url_lookup, data=json.dumps([1]),
+                                    content_type="application/json")
+        self.assertHasStatus(response, httplib.BAD_REQUEST)
+
+    def test_batch_query_count(self):
+        ''' a batch is answered with a single query
+        The revision lookup of the conditional response is the only other
+        statement.
+        '''
+        with self.assertMaxQueries(2):
+            self.lookup(key=["web_1_front_ip", "db_back_end_ip"], host="db")
+
+    def test_invalidation(self):
+        ''' lookups are refreshed when the host changes
+        '''
+        self.assertEqual(self.lookup(host="new"), {})
+        self.create_host(name="new", vlans=[1])
+        self.assertEqual(self.lookup(host="new"), {"new_front_ip": "10.1.0.1"})
+
+    def test_ipv6(self):
+        ''' IPv6 addresses of dual-stack vlans have their own `_ip6` keys
+        '''
+        self.create_vlan(number=3, name="dual", mask="10.3.0.0/24",
+                         mask6="2001:db8:3::/64")
+        self.create_host(name="v6_host", vlans=[3])
+        self.assertEqual(self.lookup(host="v6_host"), {
+            "v6_host_dual_ip": "10.3.0.0", "v6_host_dual_ip6": "2001:db8:3::"})
+        self.assertEqual(
+            self.lookup(key=["v6_host_dual_ip6", "web_1_front_ip6"]),
+            {"v6_host_dual_ip6": "2001:db8:3::"})
+        response = self.client.get(self.url_lookup + "v6_host_dual_ip6/")
+        self.assertEqual(response.data, "2001:db8:3::")
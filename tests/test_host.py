@@ -1,6 +1,9 @@
 from base import TestBase
+from banchi import settings
+from banchi.decorators import encode_cursor
 import json
 import httplib
+import re
 
 
 class HostTest(TestBase):
@@ -33,6 +36,15 @@ class HostTest(TestBase):
                                    query_string={"hostname": host})
         return json.loads(response.data), response.status_code
 
+    def get_etag(self, url):
+        ''' ::get_etag
+        Helper method to retrieve the ETag of a response.
+        '''
+        response = self.client.get(url, headers=self.json_header)
+        self.assertHasStatus(response, httplib.OK)
+        response.data
+        return response.headers["ETag"]
+
     def test_create_host(self):
         ''' a created host shows up on subsequent requests
         Creating a host and then requesting a list of hosts has the recently
@@ -63,6 +75,35 @@ class HostTest(TestBase):
         self.assertEqual(len(host["ips"]), 4)
         self.assertTrue(all(host["ips"].values()))
 
+    def test_dual_stack(self):
+        ''' hosts on dual-stack vlans get an IPv4 and an IPv6 address
+        Both addresses are allocated by the one create request, the IPv6 ones
+        are listed under `ips6` and looked up like the IPv4 ones.
+        '''
+        self.create_vlan(number=1, name="dual", mask="10.0.0.0/24",
+                         mask6="2001:db8::/64")
+        self.create_vlan(number=2, name="single", mask="10.0.1.0/24")
+        host = self.create_host(name="web", vlans=[1, 2])
+        self.assertEqual(host["vlans"], [1, 2])
+
+        details = self.get_host(host)
+        self.assertEqual(details["ips"], {"1": "10.0.0.0", "2": "10.0.1.0"})
+        self.assertEqual(details["ips6"], {"1": "2001:db8::"})
+        self.assertNotIn("ips6", self.get_host(self.create_host(
+            name="old", vlans=[2])))
+        self.assertEqual(self.get_host(self.create_host(
+            name="db", vlans=[1]))["ips6"], {"1": "2001:db8::1"})
+
+        self.assertEqual(self.query_ip("2001:db8::")[0], "web_dual_ip6")
+        self.assertEqual(self.query_ip("2001:DB8::0:1")[0], "db_dual_ip6")
+        self.assertEqual(self.query_ip("2001:db8::2")[1], httplib.NOT_FOUND)
+        response = self.client.get(self.url_find_range,
+                                   query_string={"range": "2001:db8::/64"},
+                                   headers=self.json_header)
+        self.assertEqual(json.loads(response.data), [
+            {"ip": "2001:db8::", "host": "web", "vlan": 1},
+            {"ip": "2001:db8::1", "host": "db", "vlan": 1}])
+
     def test_conflict(self):
         ''' creating a host with an already used named results in an error
         Creating a host with a name that is already in use results in a
@@ -116,3 +157,167 @@ class HostTest(TestBase):
         self.assertHasStatus(response, httplib.ACCEPTED)
 
         self.assertEqual(len(self.get_hosts()), 0)
+
+    def test_bulk_create(self):
+        ''' creating many hosts at once allocates distinct IPs
+        Creates a set of hosts across multiple vlans with both the JSON and
+        form versions of the bulk request and checks every host has an IP on
+        each vlan with no IP handed out twice.
+        '''
+        for i in range(2):
+            self.create_vlan(number=i, name="vlan{}".format(i),
+                             mask="10.0.{}.0/24".format(i))
+
+        hosts = [{"name": "json{}".format(i), "vlan": [0, 1]}
+                 for i in range(5)]
+        response = self.client.post(self.url_create_hosts,
+                                    data=json.dumps(hosts),
+                                    content_type="application/json",
+                                    headers=self.json_header)
+        self.assertHasStatus(response, httplib.CREATED)
+        self.assertEqual(len(json.loads(response.data)), 5)
+
+        response = self.client.post(self.url_create_hosts, data={
+            "name": ["form0", "form1"], "vlan": [1]}, headers=self.json_header)
+        self.assertHasStatus(response, httplib.CREATED)
+
+        ips = [ip for host in self.get_hosts()
+               for ip in self.get_host(host)["ips"].values()]
+        self.assertEqual(len(ips), 12)
+        self.assertEqual(len(set(ips)), 12)
+
+    def test_bulk_all_or_nothing(self):
+        ''' a bulk request that does not fit creates nothing
+        Requests more hosts than a vlan can hold and checks that none of the
+        hosts were created, and that a conflicting name fails the batch.
+        '''
+        self.create_vlan(number=3, name="small", mask="10.0.0.0/30")
+        response = self.client.post(self.url_create_hosts, data={
+            "name": ["host{}".format(i) for i in range(5)], "vlan": [3]},
+            headers=self.json_header)
+        self.assertHasStatus(response, httplib.PRECONDITION_FAILED)
+        self.assertEqual(len(self.get_hosts()), 0)
+
+        self.create_host(name="taken")
+        response = self.client.post(self.url_create_hosts, data={
+            "name": ["free", "taken"]}, headers=self.json_header)
+        self.assertHasStatus(response, httplib.CONFLICT)
+        self.assertEqual(len(self.get_hosts()), 1)
+
+    def test_query_counts(self):
+        ''' listing and detail requests run a fixed number of statements
+        Creates hosts across several vlans and checks the host listing, host
+        details, vlan details and hostname searches do not issue a statement
+        per host or vlan.
+        '''
+        for i in range(3):
+            self.create_vlan(number=i, name="vlan{}".format(i),
+                             mask="10.0.{}.0/24".format(i))
+        for i in range(10):
+            self.create_host(name="host{}".format(i), vlans=[0, 1, 2])
+
+        with self.assertMaxQueries(4):
+            hosts = self.get_hosts()
+        self.assertEqual(len(hosts), 10)
+        self.assertTrue(all(len(host["vlans"]) == 3 for host in hosts))
+
+        with self.assertMaxQueries(3):
+            self.assertEqual(len(self.get_host(hosts[0])["ips"]), 3)
+
+        with self.assertMaxQueries(4):
+            response = self.client.get(self.url_vlans + "vlan0/",
+                                       headers=self.json_header)
+        self.assertEqual(len(json.loads(response.data)["hosts"]), 10)
+
+        with self.assertMaxQueries(4):
+            self.assertEqual(len(self.query_host("host")[0]), 10)
+
+    def test_pagination(self):
+        ''' host listings are paged with cursors
+        Walks the host listing a page at a time following the `Link` header,
+        creating a host that sorts before the current page part way through,
+        and checks every host is seen exactly once in order.
+        '''
+        for i in range(8):
+            self.create_host(name="page{}".format(i))
+
+        names, url = [], self.url_hosts + "?per_page=3"
+        while url:
+            response = self.client.get(url, headers=self.json_header)
+            self.assertHasStatus(response, httplib.OK)
+            names.extend(host["name"] for host in json.loads(response.data))
+            if len(names) == 3:
+                self.create_host(name="page0a")
+
+            links = dict((rel, link) for (link, rel) in re.findall(
+                r'<([^>]*)>; rel="(\w+)"', response.headers.get('Link', '')))
+            url = links.get('next')
+
+        self.assertEqual(names, ["page{}".format(i) for i in range(8)])
+
+        for cursor in ["notacursor", encode_cursor({"a": 1}),
+                       encode_cursor([1]), encode_cursor(None),
+                       encode_cursor(True)]:
+            response = self.client.get(self.url_hosts,
+                                       query_string={"cursor": cursor},
+                                       headers=self.json_header)
+            self.assertHasStatus(response, httplib.BAD_REQUEST)
+
+    def test_streamed_listing(self):
+        ''' host listings are streamed in windows
+        Fetches a host listing larger than the fetch window and checks the
+        streamed JSON and JSONP output match the full listing.
+        '''
+        for i in range(5):
+            self.create_host(name="stream{}".format(i))
+
+        window, settings.WINDOW_SIZE = settings.WINDOW_SIZE, 2
+        try:
+            response = self.client.get(self.url_hosts,
+                                       headers=self.json_header)
+            self.assertTrue(response.is_streamed)
+            hosts = json.loads(response.data)
+            self.assertEqual([host["name"] for host in hosts],
+                             ["stream{}".format(i) for i in range(5)])
+
+            response = self.client.get(self.url_hosts,
+                                       query_string={"callback": "cb"})
+            self.assertEqual(response.mimetype, "application/javascript")
+            self.assertEqual(response.data, "cb(" + json.dumps(
+                hosts, separators=(',', ':')) + ");")
+        finally:
+            settings.WINDOW_SIZE = window
+
+    def test_conditional_get(self):
+        ''' unchanged listings are answered with NOT_MODIFIED
+        Fetches the host and vlan listings, then repeats the requests with
+        their ETags and checks that only the listing whose data changed in
+        between is sent again, and that the others run a single statement.
+        '''
+        self.create_vlan()
+        self.create_host(name="before")
+        host_headers = self.json_header + [
+            ("If-None-Match", self.get_etag(self.url_hosts))]
+        vlan_headers = self.json_header + [
+            ("If-None-Match", self.get_etag(self.url_vlans))]
+
+        with self.assertMaxQueries(1):
+            response = self.client.get(self.url_hosts, headers=host_headers)
+        self.assertHasStatus(response, httplib.NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], host_headers[-1][1])
+
+        self.create_host(name="after")
+        response = self.client.get(self.url_hosts, headers=host_headers)
+        self.assertHasStatus(response, httplib.OK)
+        self.assertEqual(len(json.loads(response.data)), 2)
+        self.assertNotEqual(response.headers["ETag"], host_headers[-1][1])
+        self.assertIn("Last-Modified", response.headers)
+
+        response = self.client.get(self.url_vlans, headers=vlan_headers)
+        self.assertHasStatus(response, httplib.NOT_MODIFIED)
+
+        response = self.client.get(
+            self.url_vlans, query_string={"callback": "cb"},
+            headers=vlan_headers)
+        self.assertHasStatus(response, httplib.OK)
+        self.assertTrue(response.data.startswith("cb("))
@@ -0,0 +1,108 @@
+from base import TestBase
+from banchi import metrics, settings
+import httplib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+
+class MetricsTest(TestBase):
+    ''' MetricsTest
+    Tests the instrumentation of requests and its /metrics endpoint.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        metrics.install()
+        metrics.registry.clear()
+
+    def scrape(self):
+        response = self.client.get("/metrics")
+        self.assertHasStatus(response, httplib.OK)
+        self.assertTrue(response.mimetype.startswith("text/plain"))
+        return response.data
+
+    def value(self, text, series):
+        match = re.search(r"^{} (\S+)$".format(re.escape(series)), text,
+                          re.MULTILINE)
+        self.assertIsNotNone(match, "{} not in:\n{}".format(series, text))
+        return float(match.group(1))
+
+    def test_requests(self):
+        ''' requests are counted and timed per endpoint
+        Each request adds to its endpoint's request count, latency, response
+        size and SQL statement histograms.
+        '''
+        self.create_vlan()
+        for _ in range(2):  # streamed, so recorded once closed
+            self.client.get(self.url_vlans, headers=self.json_header).close()
+        text = self.scrape()
+
+        self.assertEqual(self.value(text, 'banchi_requests_total{endpoint='
+                                    '"vlans",method="GET",status="200"}'), 2)
+        self.assertEqual(self.value(text, 'banchi_requests_total{endpoint='
+                                    '"create_vlan",method="POST",status='
+                                    '"201"}'), 1)
+        self.assertEqual(self.value(
+            text, 'banchi_request_duration_seconds_bucket{endpoint="vlans",'
+            'method="GET",le="+Inf"}'), 2)
+        self.assertGreater(self.value(
+            text, 'banchi_response_size_bytes_sum{endpoint="create_vlan",'
+            'method="POST"}'), 0)
+        self.assertGreater(self.value(
+            text, 'banchi_sql_queries_total{endpoint="create_vlan"}'), 0)
+        self.assertGreater(self.value(
+            text, 'banchi_serialization_duration_seconds_count{endpoint='
+            '"create_vlan"}'), 0)
+
+    def test_streamed_size(self):
+        ''' streamed responses are measured once they are sent
+        '''
+        self.create_vlan()
+        response = self.client.get(self.url_vlans, headers=self.json_header)
+        size = len(response.data)
+        response.close()
+
+        self.assertEqual(self.value(self.scrape(), 'banchi_response_size_'
+                                    'bytes_sum{endpoint="vlans",method='
+                                    '"GET"}'), size)
+
+    def test_allocations(self):
+        ''' allocations are timed by operation
+        '''
+        self.create_vlan()
+        self.create_host(vlans=[20])
+        self.assertEqual(self.value(
+            self.scrape(), 'banchi_allocation_duration_seconds_count'
+            '{operation="get_free"}'), 1)
+
+    def test_workers(self):
+        ''' the metrics of other processes are added up
+        Values written to the metrics directory by other workers are added
+        to those of the process answering.
+        '''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, settings, "METRICS_DIR", None)
+        settings.METRICS_DIR = directory
+
+        labels = (("endpoint", "hosts"), ("method", "GET"), ("status", "200"))
+        metrics.registry.inc("banchi_requests_total", labels, 3)
+        with open(os.path.join(directory, "1.json"), "w") as out:
+            json.dump(metrics.registry.snapshot(), out)
+
+        self.assertEqual(self.value(self.scrape(), 'banchi_requests_total{'
+                                    'endpoint="hosts",method="GET",status='
+                                    '"200"}'), 6)
+
+    def test_disabled(self):
+        ''' nothing is recorded or served when disabled
+        '''
+        metrics.enabled = False
+        self.addCleanup(setattr, metrics, "enabled", True)
+        self.create_vlan()
+        self.create_host(vlans=[20])
+        self.assertEqual(metrics.registry.values, {})
+        self.assertHasStatus(self.client.get("/metrics"), httplib.NOT_FOUND)
@@ -56,7 +56,7 @@ class TestModels(TestBase):
         self.assertEqual(self.cidr, vlan.get_next())
 
         for i in range(0, 5, 2):
-            ip = models.Ip(number=(i & self.cidr), vlan=vlan)
+            ip = models.Ip(number=(i | self.cidr), vlan=vlan)
             self.session.add(ip)
 
         self.assertEqual(self.cidr + 1, vlan.get_next())
@@ -0,0 +1,164 @@
+from base import TestBase
+from banchi import settings, db
+from sqlalchemy import event
+import json
+import httplib
+
+
+class BatchQueryTest(TestBase):
+    ''' BatchQueryTest
+    Tests looking up many IPs and hostnames in one request.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.create_vlan(20, "test", "10.0.0.0/24")
+        self.create_vlan(21, "other", "10.0.1.0/24")
+        for (name, vlans) in [("www1", [20, 21]), ("db1", [21]),
+                              ("lonely", [])]:
+            self.create_host(name, vlans)
+        self.hosts = dict((name, self.lookup({"hostname": name}))
+                          for name in ["www1", "db1", "lonely"])
+
+    def find(self, status=httplib.OK, **kwargs):
+        response = self.client.post(self.url_find, headers=self.json_header,
+                                    **kwargs)
+        self.assertHasStatus(response, status)
+        return json.loads(response.data) if status == httplib.OK else None
+
+    def lookup(self, params):
+        response = self.client.get(self.url_find, query_string=params,
+                                   headers=self.json_header)
+        if response.status_code != httplib.OK:
+            return response.status_code
+        return json.loads(response.data) if "hostname" in params else \
+            response.data
+
+    def test_batch(self):
+        ''' every item resolves as it would on its own
+        Including missing and malformed items, which get their status code.
+        '''
+        ips = self.hosts["www1"]["ips"].values() + \
+            self.hosts["db1"]["ips"].values() + \
+            ["10.0.0.200", "10.0.300.1", "bogus"]
+        hostnames = ["www1", "db1", "lonely", "missing"]
+        data = self.find(data={"ip": ips, "hostname": hostnames})
+
+        self.assertEqual(sorted(data.keys()), ["hostname", "ip"])
+        self.assertEqual(data["ip"], dict(
+            (ip, self.lookup({"ip": ip})) for ip in ips))
+        self.assertEqual(data["hostname"], dict(
+            (name, self.lookup({"hostname": name})) for name in hostnames))
+        self.assertEqual(data["ip"]["10.0.0.200"], httplib.NOT_FOUND)
+        self.assertEqual(data["ip"]["bogus"], httplib.BAD_REQUEST)
+        self.assertEqual(data["hostname"]["missing"], httplib.NOT_FOUND)
+
+    def test_exact(self):
+        ''' hostnames are matched exactly rather than searched for
+        '''
+        data = self.find(data={"hostname": ["www", "db*", ""]})
+        self.assertEqual(data["hostname"], {"www": httplib.NOT_FOUND,
+                                            "db*": httplib.NOT_FOUND,
+                                            "": httplib.BAD_REQUEST})
+        self.assertEqual(data["ip"], {})
+
+    def test_json(self):
+        ''' batches can be sent as JSON
+        '''
+        ip = self.hosts["db1"]["ips"]["21"]
+        data = self.find(data=json.dumps({"ip": [ip], "hostname": ["db1"]}),
+                         content_type="application/json")
+        self.assertEqual(data["ip"], {ip: "db1_other_ip"})
+        self.assertEqual(data["hostname"]["db1"], self.hosts["db1"])
+
+        for body in [[], {"ip": "10.0.0.1"}, {"hostname": [1]}, {}]:
+            self.find(httplib.BAD_REQUEST, data=json.dumps(body),
+                      content_type="application/json")
+        self.find(httplib.BAD_REQUEST, data={})
+
+    def test_queries(self):
+        ''' the statements run do not grow with the batch
+        '''
+        for i in range(30):
+            self.create_host("host{}".format(i), [20])
+        settings.WINDOW_SIZE, size = 20, settings.WINDOW_SIZE
+        try:
+            with self.assertMaxQueries(5):  # one per window of 20
+                data = self.find(data={
+                    "ip": ["10.0.0.{}".format(i) for i in range(60)],
+                    "hostname": ["host{}".format(i) for i in range(40)]})
+        finally:
+            settings.WINDOW_SIZE = size
+        self.assertEqual(len([name for name in data["hostname"].values()
+                              if name != httplib.NOT_FOUND]), 30)
+        self.assertEqual(len([name for name in data["ip"].values()
+                              if name != httplib.NOT_FOUND]), 31)  # www1
+
+
+class RangeQueryTest(TestBase):
+    ''' RangeQueryTest
+    Tests listing the allocations in a range of addresses.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.create_vlan(20, "test", "10.0.0.0/24")
+        self.create_vlan(21, "other", "10.0.1.0/24")
+        self.create_vlan(22, "far", "10.0.16.0/24")
+        for (name, vlans) in [("www1", [20, 21]), ("db1", [21, 20]),
+                              ("mail", [22]), ("lonely", [])]:
+            self.create_host(name, vlans)
+
+    def find(self, value, status=httplib.OK):
+        response = self.client.get(self.url_find_range,
+                                   query_string={"range": value},
+                                   headers=self.json_header)
+        self.assertHasStatus(response, status)
+        return json.loads(response.data) if status == httplib.OK else None
+
+    def test_cidr(self):
+        ''' a CIDR lists its allocations in address order
+        '''
+        found = self.find("10.0.0.0/20")
+        self.assertEqual([(item["host"], item["vlan"]) for item in found],
+                         [("www1", 20), ("db1", 20), ("www1", 21),
+                          ("db1", 21)])
+        self.assertEqual([item["ip"] for item in found],
+                         sorted([item["ip"] for item in found]))
+        self.assertEqual(len(self.find("10.0.0.0/8")), 5)
+        self.assertEqual(self.find("10.0.2.0/23"), [])
+        self.assertEqual(len(self.find("10.0.1.77/24")), 2)  # host bits
+
+    def test_range(self):
+        ''' ranges and single addresses are inclusive
+        '''
+        found = self.find("10.0.0.0/20")
+        first, last = found[1]["ip"], found[2]["ip"]
+        self.assertEqual(self.find("{}-{}".format(first, last)), found[1:3])
+        self.assertEqual(self.find(first), found[1:2])
+        for value in ["", "10.0.0.0/33", "10.0.0.0/x", "10.0.0.256/24",
+                      "10.0.1.0-10.0.0.0", "bogus", "10.0.0.1-"]:
+            self.find(value, httplib.BAD_REQUEST)
+
+    def test_index(self):
+        ''' the range is read with a scan of the index on IP numbers
+        '''
+        engine = db.get_engine(self.app)
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            if "BETWEEN" in statement:
+                statements.append((statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            self.find("10.0.0.0/20")
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        self.assertEqual(len(statements), 1)
+        statement, parameters = statements[0]
+        plan = " ".join(list(row)[-1] for row in engine.execute(
+            "EXPLAIN QUERY PLAN " + statement, parameters).fetchall())
+        self.assertIn("USING INDEX ix_ip_number", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
@@ -0,0 +1,88 @@
+from base import TestBase
+from banchi import search, db
+import json
+import httplib
+
+
+class SearchTest(TestBase):
+    ''' SearchTest
+    Tests the hostname search and its trigram index.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        for name in ["web", "web1", "web10", "db-web", "Webcache", "db1",
+                     "mail_1"]:
+            self.create_host(name=name)
+
+    def find(self, hostname, status=httplib.OK, **params):
+        params["hostname"] = hostname
+        response = self.client.get(self.url_find, query_string=params,
+                                   headers=self.json_header)
+        self.assertHasStatus(response, status)
+        if status != httplib.OK:
+            return None
+
+        data = json.loads(response.data)
+        return [data["name"]] if isinstance(data, dict) else \
+            [host["name"] for host in data]
+
+    def test_pattern(self):
+        ''' terms become glob patterns with the trigrams they need
+        '''
+        self.assertEqual(search.pattern("Web"), (set(["web"]), "%web%",
+                                                 "web"))
+        self.assertEqual(search.pattern("db"), (set(["  d", " db"]), "db%",
+                                                "db"))
+        self.assertEqual(search.pattern("w?b*1"), (set(["  w"]), "w_b%1",
+                                                   "w"))
+        self.assertEqual(search.pattern("50%_"), (set(["50%", "0%_"]),
+                                                  "%50\\%\\_%", "50\\%\\_"))
+
+    def test_ranking(self):
+        ''' substring matches rank exact, then prefix, then shortest names
+        '''
+        self.assertEqual(self.find("web"), ["web", "web1", "web10",
+                                            "Webcache", "db-web"])
+        self.assertEqual(self.find("web", limit=2), ["web", "web1"])
+        self.assertEqual(self.find("WEB1"), ["web1", "web10"])
+        self.find("nothing", httplib.NOT_FOUND)
+        self.find("web", httplib.BAD_REQUEST, limit="many")
+
+    def test_short_and_glob(self):
+        ''' short terms match prefixes and globs match whole names
+        '''
+        self.assertEqual(self.find("db"), ["db1", "db-web"])
+        self.assertEqual(self.find("w"), ["web", "web1", "web10", "Webcache"])
+        self.assertEqual(self.find("web?"), ["web1"])
+        self.assertEqual(self.find("*web"), ["web", "db-web"])
+        self.assertEqual(self.find("*_*"), ["mail_1"])
+        self.assertEqual(self.find("*1"), ["db1", "web1", "mail_1"])
+
+    def test_index_maintenance(self):
+        ''' the index follows renamed and deleted hosts
+        '''
+        host = self.client.get(self.url_hosts + "web1/",
+                               headers=self.json_header)
+        self.assertHasStatus(host, httplib.OK)
+        response = self.client.delete(self.url_hosts + "web1/")
+        self.assertHasStatus(response, httplib.ACCEPTED)
+        self.assertEqual(self.find("web1"), ["web10"])
+
+        from banchi.models import Host
+        Host.query.filter(Host.name == "db1").first().name = "renamed"
+        db.session.commit()
+        self.assertEqual(self.find("db"), ["db-web"])
+        self.assertEqual(self.find("ename"), ["renamed"])
+
+        rows = db.session.execute(search.trigrams.select()).fetchall()
+        search.rebuild(db.session)
+        self.assertEqual(
+            sorted(rows),
+            sorted(db.session.execute(search.trigrams.select()).fetchall()))
+
+    def test_single_query(self):
+        ''' a search is a single statement (before loading relationships)
+        '''
+        with self.assertMaxQueries(4):
+            self.assertEqual(len(self.find("web")), 5)
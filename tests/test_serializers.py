@@ -0,0 +1,90 @@
+from base import TestBase
+from banchi import db, models, serializers
+from banchi.decorators import keyset
+from flask import url_for
+import httplib
+import json
+
+
+class SerializersTest(TestBase):
+    ''' SerializersTest
+    Tests that the projection serializers produce the same output as the
+    serializers of the models.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.create_vlan(20, "test", "10.0.0.0/24")
+        self.create_vlan(21, "other vlan", "10.0.1.0/24")
+        self.create_vlan(22, "dual", "10.0.2.0/24", "2001:db8::/64")
+        for (name, vlans) in [("www1", [20, 21]), ("some host", [21]),
+                              ("lonely", []), ("twice", [20, 20]),
+                              ("a/b?c", [21, 20]), ("v6", [22, 20])]:
+            self.client.post(self.url_hosts, data={"name": name,
+                                                   "vlan": vlans})
+        self.client.post("/vlan/20/block/", data={"size": 8, "name": "b"})
+        self.client.post("/vlan/20/block/", data={"size": 4})
+
+    def same(self, projected, modeled):
+        self.assertEqual(json.dumps(projected), json.dumps(modeled))
+
+    def test_hosts(self):
+        ''' host listings and details are unchanged
+        Including hosts without IPs, with two IPs on a vlan, with IPv6
+        addresses and with names that need quoting in URLs.
+        '''
+        hosts = models.Host.query.order_by(models.Host.name).all()
+        with self.app.test_request_context():
+            self.same(list(serializers.host_listing(
+                serializers.host_query().order_by(models.Host.name))),
+                [host.__simple__() for host in hosts])
+            for host in hosts:
+                self.same(serializers.host_details(host.name),
+                          host.__full__())
+                self.same(serializers.host_details(host_id=host.id),
+                          host.__full__())
+            self.assertIsNone(serializers.host_details("missing"))
+
+    def test_vlans(self):
+        ''' vlan listings and details are unchanged
+        '''
+        vlans = models.Vlan.query.order_by(models.Vlan.id).all()
+        with self.app.test_request_context():
+            self.same(list(serializers.vlan_listing(
+                serializers.vlan_query().order_by(models.Vlan.id))),
+                [vlan.__simple__() for vlan in vlans])
+            for vlan in vlans:
+                self.same(serializers.vlan_details(number=vlan.number),
+                          vlan.__full__())
+                self.same(serializers.vlan_details(name=vlan.name),
+                          vlan.__full__())
+                self.same(serializers.block_listing(vlan.id, vlan.name),
+                          [block.__simple__() for block in vlan.blocks])
+            self.assertIsNone(serializers.vlan_details(number=99))
+
+    def test_urls(self):
+        ''' built URLs match url_for
+        '''
+        with self.app.test_request_context():
+            build = serializers.url_builder("host_info", "host_name")
+            for name in ["plain", "with space", u"\xfcml", "a%b", "x:y"]:
+                self.assertEqual(build(name),
+                                 url_for("host_info", host_name=name))
+            build = serializers.url_builder("release_block", "block_id",
+                                            vlan_name="other vlan")
+            self.assertEqual(build(7), url_for(
+                "release_block", vlan_name="other vlan", block_id=7))
+
+    def test_queries(self):
+        ''' listings use a fixed number of queries
+        '''
+        with self.assertMaxQueries(4):
+            response = self.client.get(self.url_hosts + "?per_page=100",
+                                       headers=self.json_header)
+            self.assertHasStatus(response, httplib.OK)
+            self.assertEqual(len(json.loads(response.data)), 6)
+
+        self.assertHasStatus(self.client.get("/host/missing/"),
+                             httplib.NOT_FOUND)
+        self.assertHasStatus(self.client.get("/vlan/missing/"),
+                             httplib.NOT_FOUND)
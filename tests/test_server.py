@@ -0,0 +1,175 @@
+from banchi import server
+from flask import Flask, Response, request
+from multiprocessing import Process
+from threading import Thread
+import httplib
+import os
+import signal
+import subprocess
+import sys
+import time
+import unittest
+
+app = Flask(__name__)
+
+
+@app.route("/pid/")
+def pid():
+    return str(os.getpid())
+
+
+@app.route("/stream/")
+def stream():
+    return Response(str(i) for i in range(int(request.args.get('n', 3))))
+
+
+@app.route("/slow/")
+def slow():
+    time.sleep(0.5)
+    return "done"
+
+
+def run_master(sock, workers):
+    server.Master(app, sock, workers).run()
+
+
+class WorkerTest(unittest.TestCase):
+    ''' WorkerTest
+    Tests a worker serving requests from a thread of the test.
+    '''
+
+    def setUp(self):
+        self.sock = server.listen("127.0.0.1", 0)
+        self.worker = server.Worker(self.sock, app, threads=2)
+        self.thread = Thread(target=self.worker.run, args=(5,))
+        self.thread.start()
+        self.connection = httplib.HTTPConnection(*self.sock.getsockname())
+
+    def tearDown(self):
+        self.connection.close()
+        self.worker.stop()
+        self.thread.join()
+        self.sock.close()
+
+    def get(self, url):
+        self.connection.request("GET", url)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        ''' connections are kept open between requests
+        Responses with a length and streamed ones alike leave the connection
+        open for the next request.
+        '''
+        response, body = self.get("/pid/")
+        self.assertEqual(response.status, httplib.OK)
+        self.assertEqual(body, str(os.getpid()))
+        sock = self.connection.sock
+
+        response, body = self.get("/stream/?n=5")
+        self.assertEqual(response.getheader('transfer-encoding'), 'chunked')
+        self.assertEqual(body, "01234")
+        response, body = self.get("/missing/")
+        self.assertEqual(response.status, httplib.NOT_FOUND)
+        self.assertIs(self.connection.sock, sock)
+
+    def test_http10_stream(self):
+        ''' streams to HTTP/1.0 clients are not chunked
+        Without chunked encoding the end of the response is marked by closing
+        the connection.
+        '''
+        self.connection._http_vsn, self.connection._http_vsn_str = \
+            10, 'HTTP/1.0'
+        response, body = self.get("/stream/")
+        self.assertIsNone(response.getheader('transfer-encoding'))
+        self.assertEqual(body, "012")
+
+
+class MasterTest(unittest.TestCase):
+    ''' MasterTest
+    Tests the master process forking, restarting and stopping workers.
+    '''
+
+    def setUp(self):
+        self.sock = server.listen("127.0.0.1", 0)
+        self.address = self.sock.getsockname()
+        self.master = Process(target=run_master, args=(self.sock, 2))
+        self.master.start()
+
+    def tearDown(self):
+        if self.master.is_alive():
+            os.kill(self.master.pid, signal.SIGTERM)
+        self.master.join(10)
+        self.sock.close()
+
+    def get(self, url, timeout=5):
+        deadline = time.time() + timeout
+        while True:
+            connection = httplib.HTTPConnection(*self.address)
+            try:
+                connection.request("GET", url)
+                return connection.getresponse().read()
+            except Exception:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+            finally:
+                connection.close()
+
+    def pids(self, count=20):
+        return set(int(self.get("/pid/")) for _ in range(count))
+
+    def test_restart(self):
+        ''' SIGHUP replaces the workers
+        Requests are answered by workers other than the master, and after a
+        restart only by new ones.
+        '''
+        before = self.pids()
+        self.assertNotIn(self.master.pid, before)
+
+        os.kill(self.master.pid, signal.SIGHUP)
+        deadline = time.time() + 10
+        while self.pids() & before:
+            self.assertLess(time.time(), deadline, "old workers still serve")
+            time.sleep(0.1)
+
+    def test_graceful_stop(self):
+        ''' SIGTERM lets requests in progress finish
+        A request started before the master is told to stop is still
+        answered, and the master exits once its workers did.
+        '''
+        self.pids()
+        connection = httplib.HTTPConnection(*self.address)
+        connection.request("GET", "/slow/")
+        time.sleep(0.1)
+        os.kill(self.master.pid, signal.SIGTERM)
+
+        self.assertEqual(connection.getresponse().read(), "done")
+        connection.close()
+        self.master.join(10)
+        self.assertEqual(self.master.exitcode, 0)
+
+
+class EnvironmentTest(unittest.TestCase):
+    ''' EnvironmentTest
+    Tests the settings of each environment.
+    '''
+
+    def debug(self, environment):
+        env = dict(os.environ, BANCHI_ENV=environment)
+        return subprocess.check_output([
+            sys.executable, "-c",
+            "from banchi import setup; print(setup().debug)"], env=env,
+            stderr=subprocess.STDOUT).strip()
+
+    def test_production_debug(self):
+        ''' debug mode is never on in production
+        '''
+        self.assertEqual(self.debug("development"), "True")
+        self.assertEqual(self.debug("production"), "False")
+
+    def test_unknown_environment(self):
+        ''' unknown environments are refused
+        '''
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.debug("staging")
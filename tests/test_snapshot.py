@@ -0,0 +1,158 @@
+from base import TestBase
+from banchi import db, changes, settings
+import json
+import httplib
+
+
+class SnapshotTest(TestBase):
+    ''' SnapshotTest
+    Tests exporting and importing snapshots of the database.
+    '''
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.create_vlan(number=1, name="front", mask="10.1.0.0/24")
+        self.create_vlan(number=2, name="back", mask="10.2.0.0/24")
+        self.create_host(name="web", vlans=[1, 2])
+        self.create_host(name="db", vlans=[2])
+        self.create_host(name="spare")
+        response = self.client.post(self.url_vlans + "front/block/",
+                                    data={"size": 4, "name": "vips"},
+                                    headers=self.json_header)
+        self.assertHasStatus(response, httplib.CREATED)
+
+    def export(self):
+        response = self.client.get(self.url_export)
+        self.assertHasStatus(response, httplib.OK)
+        return response.data
+
+    def restore(self, data, status=httplib.CREATED):
+        response = self.client.post(self.url_export, data=data,
+                                    content_type="application/x-ndjson",
+                                    headers=self.json_header)
+        self.assertHasStatus(response, status)
+        return json.loads(response.data) if response.data else None
+
+    def test_export(self):
+        ''' exports list every record, one per line
+        '''
+        records = [json.loads(line) for line in self.export().splitlines()]
+        self.assertEqual(records, [
+            ["snapshot", 1],
+            ["vlan", 1, "front", "10.1.0.0/24"],
+            ["vlan", 2, "back", "10.2.0.0/24"],
+            ["block", 1, "vips", "10.1.0.1", 4],
+            ["host", "web"],
+            ["host", "db"],
+            ["host", "spare"],
+            ["ip", "web", 1, "10.1.0.0"],
+            ["ip", "web", 2, "10.2.0.0"],
+            ["ip", "db", 2, "10.2.0.1"],
+        ])
+
+    def test_round_trip(self):
+        ''' an export imports into an empty database unchanged
+        The addresses (and reserved block) are kept and the allocator carries
+        on after them, with the records written over several batches.
+        '''
+        snapshot = self.export()
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        batch, settings.SNAPSHOT_BATCH = settings.SNAPSHOT_BATCH, 2
+        try:
+            counts = self.restore(snapshot)
+        finally:
+            settings.SNAPSHOT_BATCH = batch
+        self.assertEqual(counts, {"vlan": 2, "block": 1, "host": 3, "ip": 3})
+        self.assertEqual(self.export(), snapshot)
+        log = db.session.execute(changes.log.select().order_by(
+            changes.log.c.seq)).fetchall()
+        self.assertEqual([(row.kind, row.key) for row in log], [
+            ("vlan", "1"), ("vlan", "2"), ("host", "web"), ("host", "db"),
+            ("host", "spare"), ("ip", "10.1.0.0"), ("ip", "10.2.0.0"),
+            ("ip", "10.2.0.1")])
+
+        self.create_host(name="new", vlans=[1, 2])
+        response = self.client.get(self.url_hosts + "new/",
+                                   headers=self.json_header)
+        self.assertEqual(json.loads(response.data)["ips"],
+                         {"1": "10.1.0.5", "2": "10.2.0.2"})
+
+    def test_merge(self):
+        ''' imports add to the existing data and refresh cached responses
+        '''
+        response = self.client.get(self.url_hosts + "web/",
+                                   headers=self.json_header)
+        self.assertEqual(len(json.loads(response.data)["ips"]), 2)
+
+        self.restore("\n".join([
+            '["vlan",3,"mgmt","10.3.0.0/24"]',
+            '["ip","web",3,"10.3.0.9"]',
+        ]))
+        response = self.client.get(self.url_hosts + "web/",
+                                   headers=self.json_header)
+        self.assertEqual(json.loads(response.data)["ips"]["3"], "10.3.0.9")
+
+    def test_large_merge(self):
+        ''' imports changing more than the cache holds refresh all of it
+        '''
+        url = self.url_hosts + "web/"
+        response = self.client.get(url, headers=self.json_header)
+        self.assertEqual(len(json.loads(response.data)["ips"]), 2)
+
+        size, settings.CACHE_SIZE = settings.CACHE_SIZE, 2
+        try:
+            self.restore("\n".join([
+                '["vlan",3,"mgmt","10.3.0.0/24"]',
+                '["host","new"]',
+                '["ip","new",3,"10.3.0.8"]',
+                '["ip","web",3,"10.3.0.9"]',
+            ]))
+        finally:
+            settings.CACHE_SIZE = size
+        response = self.client.get(url, headers=self.json_header)
+        self.assertEqual(json.loads(response.data)["ips"]["3"], "10.3.0.9")
+
+    def test_dual_stack(self):
+        ''' IPv6 prefixes and addresses are exported and imported
+        '''
+        self.restore("\n".join([
+            '["vlan",3,"dual","10.3.0.0/24","2001:db8:3::/64"]',
+            '["host","v6"]',
+            '["ip","v6",3,"10.3.0.1"]',
+            '["ip","v6",3,"2001:db8:3::9"]',
+        ]))
+        records = [json.loads(line) for line in self.export().splitlines()]
+        self.assertIn(["vlan", 3, "dual", "10.3.0.0/24", "2001:db8:3::/64"],
+                      records)
+        self.assertIn(["ip", "v6", 3, "2001:db8:3::9"], records)
+
+        host = self.create_host(name="next", vlans=[3])
+        response = self.client.get(host["url"], headers=self.json_header)
+        self.assertEqual(json.loads(response.data)["ips6"],
+                         {"3": "2001:db8:3::"})
+
+        for data in ['["ip","web",3,"2001:db8:4::1"]',
+                     '["ip","web",1,"2001:db8:3::2"]',
+                     '["vlan",4,"bad","10.4.0.0/24","10.5.0.0/24"]']:
+            self.restore(data, httplib.BAD_REQUEST)
+
+    def test_invalid(self):
+        ''' nothing is imported from a snapshot with a bad record
+        '''
+        snapshot = self.export()
+        for data in [
+                '["host","new"]\n["ip","web",1,"10.1.0.0"]',
+                '["host","new"]\n["ip","new",1,"10.2.0.5"]',
+                '["host","new"]\n["ip","new",9,"10.9.0.5"]',
+                '["host","new"]\n["ip","nobody",1,"10.1.0.5"]',
+                '["vlan",1,"other","10.1.0.0/24"]',
+                '["vlan",5,"front","10.5.0.0/24"]',
+                '["vlan",6,"stats","10.6.0.0/24"]',
+                '["host","new"]\n["host"]',
+                '["snapshot",2]',
+                'nonsense']:
+            self.restore(data, httplib.BAD_REQUEST)
+        self.assertEqual(self.export(), snapshot)
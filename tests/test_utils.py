@@ -60,3 +60,50 @@ class UtilsTest(unittest.TestCase):
 
         for test in bad_tests:
             self.assertFalse(utils.isip(test))
+
+    def test_parse_range(self):
+        ''' ranges are converted into their first and last IP numbers
+        CIDRs cover their whole block, whatever their host bits, and ranges
+        are inclusive.
+        '''
+        ip = utils.ip2int
+        self.assertEqual(utils.parse_range("10.0.0.0/20"),
+                         (ip("10.0.0.0"), ip("10.0.15.255")))
+        self.assertEqual(utils.parse_range("10.0.3.7/22"),
+                         (ip("10.0.0.0"), ip("10.0.3.255")))
+        self.assertEqual(utils.parse_range("0.0.0.0/0"),
+                         (0, ip("255.255.255.255")))
+        self.assertEqual(utils.parse_range("10.0.0.5-10.0.0.9"),
+                         (ip("10.0.0.5"), ip("10.0.0.9")))
+        self.assertEqual(utils.parse_range("10.0.0.5"),
+                         (ip("10.0.0.5"), ip("10.0.0.5")))
+        for text in ["10.0.0.0/33", "10.0.0.0/", "10.0.0.9-10.0.0.5",
+                     "300.0.0.0/8", "10.0.0.0-x", "-", ""]:
+            self.assertIsNone(utils.parse_range(text))
+
+    def test_ipv6(self):
+        ''' IPv6 addresses convert to and from their 128 bit numbers
+        Addresses are formatted in their canonical compressed form, and the
+        ones in ::/96 are rejected as their numbers are IPv4 addresses.
+        '''
+        for ip in ["2001:db8::1", "fe80::", "::ffff:10.0.0.1",
+                   "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"]:
+            self.assertTrue(utils.isip(ip))
+            self.assertEqual(ip, utils.int2ip(utils.ip2int(ip)))
+            self.assertEqual(6, utils.version(utils.ip2int(ip)))
+        self.assertEqual(0x20010db8 << 96 | 1,
+                         utils.ip2int("2001:0DB8:0:0::0001"))
+        for ip in ["::1", "::", "2001:db8::g", "2001::db8::1", ":"]:
+            self.assertFalse(utils.isip(ip))
+            self.assertIsNone(utils.ip2int(ip))
+
+        self.assertEqual(utils.ip2int("2001:db8::"),
+                         utils.cidr2mask("2001:db8::1:2:3/64"))
+        self.assertEqual(utils.parse_range("2001:db8::/64"),
+                         (utils.ip2int("2001:db8::"),
+                          utils.ip2int("2001:db8::ffff:ffff:ffff:ffff")))
+        self.assertEqual(utils.parse_range("2001:db8::5-2001:db8::9"),
+                         (utils.ip2int("2001:db8::5"),
+                          utils.ip2int("2001:db8::9")))
+        for text in ["2001:db8::/129", "10.0.0.1-2001:db8::1"]:
+            self.assertIsNone(utils.parse_range(text))
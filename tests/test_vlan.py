@@ -1,4 +1,5 @@
 from base import TestBase
+from banchi import models, allocator
 import json
 import httplib
 
@@ -29,6 +30,27 @@ class VlanTest(TestBase):
         self.assertEqual(len(vlans), 1)
         self.assertEqual(vlans[0]['number'], 35)
 
+    def test_dual_stack(self):
+        ''' vlans can be given an IPv6 prefix as well
+        The prefix is normalized and listed as `range6`, vlans without one are
+        listed as before and malformed prefixes are rejected.
+        '''
+        vlan = self.create_vlan(number=6, name="dual",
+                                mask6="2001:DB8:6::1/64")
+        self.assertEqual(vlan["range6"], "2001:db8:6::/64")
+        self.create_vlan(number=4, name="single")
+        self.assertEqual([v.get("range6") for v in self.get_vlans()],
+                         ["2001:db8:6::/64", None])
+
+        response = self.client.get(vlan["url"], headers=self.json_header)
+        self.assertEqual(json.loads(response.data)["range6"],
+                         "2001:db8:6::/64")
+        for mask6 in ["2001:db8::/129", "10.0.0.0/8", "::/64", "2001:db8::"]:
+            response = self.client.post(self.url_vlans, data={
+                'number': 7, 'name': "bad", 'mask': "10.0.0.0/24",
+                'mask6': mask6}, headers=self.json_header)
+            self.assertHasStatus(response, httplib.BAD_REQUEST)
+
     def test_conflict(self):
         ''' creating a conflicting vlan results in an error
         Creates another vlan with the same name ornumber, returns the
@@ -83,3 +105,129 @@ class VlanTest(TestBase):
         self.assertHasStatus(response, httplib.OK)
         host = json.loads(response.data)
         self.assertEqual(len(host['ips']), 0)
+
+    def reserve_block(self, vlan, **block):
+        ''' ::reserve_block
+        Helper method to reserve a block of addresses on a vlan.
+        '''
+        url = vlan["url"] + "block/"
+        return self.client.post(url, data=block, headers=self.json_header)
+
+    def test_reserve_block(self):
+        ''' reserved blocks are contiguous and kept away from hosts
+        Reserves an aligned block after a host has been allocated, checks it
+        starts on the requested boundary and that the next host skips over it
+        only once the free space before it is used up.
+        '''
+        vlan = self.create_vlan(mask="10.1.0.0/24")
+        self.create_host(name="first", vlans=[vlan["number"]])
+
+        response = self.reserve_block(vlan, size=64, align=64, name="pool")
+        self.assertHasStatus(response, httplib.CREATED)
+        block = json.loads(response.data)
+        self.assertEqual(block["start"], "10.1.0.64")
+        self.assertEqual(block["end"], "10.1.0.127")
+
+        response = self.reserve_block(vlan, size=3)
+        self.assertHasStatus(response, httplib.CREATED)
+        self.assertEqual(json.loads(response.data)["start"], "10.1.0.1")
+
+        response = self.reserve_block(vlan, size=200)
+        self.assertHasStatus(response, httplib.PRECONDITION_FAILED)
+
+        response = self.client.get(vlan["url"], headers=self.json_header)
+        self.assertEqual(len(json.loads(response.data)["blocks"]), 2)
+
+    def test_release_block(self):
+        ''' releasing a block returns its addresses to the vlan
+        Reserves the whole of a small vlan, checks a host cannot be allocated
+        on it, then releases the block and allocates the host.
+        '''
+        vlan = self.create_vlan(mask="10.2.0.0/30")
+        response = self.reserve_block(vlan, size=4)
+        self.assertHasStatus(response, httplib.CREATED)
+        block = json.loads(response.data)
+
+        host_data = {'name': 'blocked', 'vlan': [vlan["number"]]}
+        response = self.client.post(self.url_hosts, data=host_data,
+                                    headers=self.json_header)
+        self.assertHasStatus(response, httplib.PRECONDITION_FAILED)
+
+        response = self.client.delete(block["url"])
+        self.assertHasStatus(response, httplib.ACCEPTED)
+        response = self.client.delete(block["url"])
+        self.assertHasStatus(response, httplib.NOT_FOUND)
+
+        self.create_host(name="unblocked", vlans=[vlan["number"]])
+
+    def test_stats(self):
+        ''' vlan utilization
+        Allocated IPs and reserved blocks count against the vlan, the stats
+        follow allocations and releases and come from a fixed number of
+        queries.
+        '''
+        self.create_vlan(20, "test", "10.0.0.0/24")
+        self.create_vlan(21, "small", "10.0.1.0/29")
+        for name in ["www1", "www2", "www3"]:
+            self.create_host(name, [20])
+        self.client.post("/vlan/20/block/", data={"size": 16, "align": 16})
+        self.create_host("db1", [21])
+
+        response = self.client.get(self.url_vlan_stats,
+                                   headers=self.json_header)
+        self.assertHasStatus(response, httplib.OK)
+        stats = json.loads(response.data)
+        self.assertEqual([vlan["name"] for vlan in stats], ["test", "small"])
+        self.assertEqual(stats[0], {
+            "name": "test", "number": 20, "range": "10.0.0.0/24",
+            "size": 256, "allocated": 19, "free": 237, "used": 7.42,
+            "largest_free": 224})
+        self.assertEqual((stats[1]["size"], stats[1]["allocated"],
+                          stats[1]["largest_free"]), (8, 1, 7))
+
+        response = self.client.get("/vlan/small/stats/",
+                                   headers=self.json_header)
+        self.assertEqual(json.loads(response.data), stats[1])
+        self.client.delete("/host/www2/")
+        response = self.client.get("/vlan/20/stats/",
+                                   headers=self.json_header)
+        self.assertEqual(json.loads(response.data)["allocated"], 18)
+        self.assertHasStatus(self.client.get("/vlan/99/stats/"),
+                             httplib.NOT_FOUND)
+        response = self.client.post(self.url_vlans, data={
+            "number": 22, "name": "stats", "mask": "10.0.2.0/24"})
+        self.assertHasStatus(response, httplib.BAD_REQUEST)
+
+        for number in range(30, 40):
+            self.create_vlan(number, "vlan{}".format(number),
+                             "10.1.{}.0/24".format(number))
+        with self.assertMaxQueries(4):
+            response = self.client.get(self.url_vlan_stats,
+                                       headers=self.json_header)
+            self.assertEqual(len(json.loads(response.data)), 12)
+
+    def test_stats_unindexed(self):
+        ''' vlan utilization without a free space index
+        Vlans that predate the index are counted from their IPs and blocks,
+        reading the stats never builds it.
+        '''
+        self.create_vlan(21, "small", "10.0.1.0/29")
+        self.create_host("db1", [21])
+        self.client.post("/vlan/21/block/", data={"size": 2, "align": 2})
+        vlan_id = models.Vlan.query.filter_by(number=21).one().id
+        allocator.drop(self.session, [vlan_id])
+        self.session.commit()
+
+        response = self.client.get("/vlan/21/stats/",
+                                   headers=self.json_header)
+        stats = json.loads(response.data)
+        self.assertEqual((stats["allocated"], stats["largest_free"]),
+                         (3, None))
+        self.assertEqual(self.session.execute(
+            allocator.pools.count()).scalar(), 0)
+
+        allocator.build(self.session)
+        self.session.commit()
+        response = self.client.get(self.url_vlan_stats,
+                                   headers=self.json_header)
+        self.assertEqual(json.loads(response.data)[0]["largest_free"], 4)